@@ -28,6 +28,11 @@ grf_chi_3d_los1d
     Generate a 1D, 'Line-Of-Sight' \chi_e^2 GRF from the power spectrum 
     generated for a 3D \chi_e^2 GRF.
 
+pk_los1d
+    Tabulate the exact 1D power spectrum of line-of-sight strips through an isotropic 3D GRF.
+grf_los1d
+    Generate a batch of 1D line-of-sight strips of an isotropic 3D GRF.
+
 gauss_var
     Generates a complex Gaussian random variable in Fourier space with zero mean and unit variance.
 dealiasx
@@ -40,7 +45,10 @@ TODO
 Change the numpy random seed generation to the new, recommended method.
 """
 
+from functools import lru_cache
+
 import numpy as np
+from scipy import integrate
 
 ############################################################
 #
@@ -423,6 +431,111 @@ def grf_chi_3d_los1d(N, pk_amp, pk_R, pk_B=0.0, seed=None):
 
 
 
+############################################################
+#
+# Exact 1D Line-of-Sight Strips of 3D GRFs:
+#
+############################################################
+@lru_cache(maxsize=32)
+def pk_los1d(N, pk_3d=pk_primordial_3d, pk_args=(1.0, 1.0), order=16):
+    r"""Tabulate the exact 1D power spectrum of line-of-sight strips through an isotropic 3D GRF.
+
+    Parameters
+    ----------
+    N : int
+        Size of the real space strips.
+    pk_3d : callable, optional
+        3D power spectrum, called as pk_3d(k, *pk_args) on arrays of wavenumbers
+        (e.g. pk_primordial_3d or pk_chi_3d).
+    pk_args : tuple, optional
+        Extra arguments of pk_3d.
+    order : int, optional
+        Number of Gauss-Legendre nodes per unit interval of k.
+
+    Returns
+    -------
+    pk
+        The 1D power spectrum on the N//2+1 rfft modes (read-only, cached per arguments).
+
+    Notes
+    -----
+    A strip along the line of sight only sees the transverse integral of the 3D spectrum,
+
+        P_1D(k) = (1/2pi) \int_k^\infty P_3D(q) q dq,
+
+    with k in the same integer grid units as the other generators of this module. The integral
+    is split into unit intervals [k, k+1], each done with Gauss-Legendre quadrature, and
+    accumulated from the tail, which is integrated with scipy.integrate.quad. The k = 0 mode is
+    set to zero (mean-free strips).
+    """
+    k = np.arange(1, N//2 + 1)
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    q = k[:, None] + 0.5 * (nodes + 1)
+    segments = (pk_3d(q, *pk_args) * q) @ (0.5 * weights)
+    tail, _ = integrate.quad(lambda x: float(pk_3d(np.array([x]), *pk_args)[0] * x), N//2 + 1, np.inf)
+
+    pk = np.zeros(N//2 + 1)
+    pk[1:] = (np.cumsum(segments[::-1])[::-1] + tail) / (2*np.pi)
+    pk.flags.writeable = False
+
+    return pk
+
+def grf_los1d(N, num_strips, pk_3d=pk_primordial_3d, pk_args=(1.0, 1.0), seed=None, normalize=True):
+    r"""Generate a batch of 1D line-of-sight strips of an isotropic 3D GRF.
+
+    Parameters
+    ----------
+    N : int
+        Size of the real space strips.
+    num_strips : int
+        Number of independent strips to generate.
+    pk_3d : callable, optional
+        3D power spectrum, see pk_los1d.
+    pk_args : tuple, optional
+        Extra arguments of pk_3d, e.g. (pk_amp, pk_ns) for pk_primordial_3d or
+        (pk_amp, pk_R, pk_B) for pk_chi_3d.
+    seed : optional
+        Seed (or np.random.Generator) for np.random.default_rng.
+    normalize : bool, optional
+        If True (default), scale the strips to unit variance using the variance of the
+        spectrum, so the normalization is the same for every strip.
+
+    Returns
+    -------
+    strips
+        Array of shape (num_strips, N).
+
+    Notes
+    -----
+    Unlike grf_zeta_3d_los1d and grf_chi_3d_los1d, which put P_3D itself on the 1D grid, the
+    strips have the spectrum P_1D of pk_los1d, i.e. they have the statistics of 1D slices of a
+    3D box (Slicer1D) without generating any 3D field.
+    """
+    if normalize:
+        amp = _los1d_amplitude(N, pk_3d, tuple(pk_args))
+    else:
+        amp = np.sqrt(pk_los1d(N, pk_3d, tuple(pk_args)))
+    rng = np.random.default_rng(seed)
+
+    strips = rng.standard_normal((num_strips, N))
+    sk = np.fft.rfft(strips, axis=-1)
+    sk *= amp
+    
+    return np.fft.irfft(sk, N, axis=-1, out=strips)
+
+@lru_cache(maxsize=32)
+def _los1d_amplitude(N, pk_3d, pk_args):
+    """Fourier amplitudes of grf_los1d scaled to give unit-variance strips."""
+    pk = pk_los1d(N, pk_3d, pk_args)
+    # variance of irfft(rfft(white noise) * sqrt(pk)): sum of pk over the full (Hermitian) spectrum / N
+    var = (pk[0] + 2*pk[1:].sum() - (pk[-1] if N % 2 == 0 else 0)) / N
+    amp = np.sqrt(pk / var)
+    amp.flags.writeable = False
+
+    return amp
+
+
+
 ############################################################
 #
 # Helper functions:
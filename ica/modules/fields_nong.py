@@ -13,6 +13,8 @@ png_asymsinh
     Generate Asymmetric Sinh Non-Gaussianity (only the FNG component, not the full NG field).
 png_map_asymsinh
     Map a GRF to an Asymmetric $\sinh$ Non-Gaussian component.
+png_map_chisq
+    Map a GRF to a Chi_e^2 Non-Gaussian component.
 kth_root
     Return the kth root of x.
 
@@ -26,11 +28,19 @@ png_field_asymsinh_uncorr
 png_field
     Helper function to generate the full Non-Gaussian Field for a given PNG component.
 
+png_param_grid
+    Build the grid of all combinations of the given parameter values.
+png_ensemble
+    Generate the non-Gaussian components of a whole parameter scan over a range of seeds.
+
 Notes
 -----
 The 'ng_chisq' non-G component is uncorrelated to both 'zng1' and 'zng2'
 """
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import ica.modules.fields_gauss as grf
 
@@ -85,7 +95,7 @@ def png_chisq(N, Achi=10**(-10), Rchi=0.04, Bchi=0.0, Fng=1.0, kmaxknyq_ratio=2/
     # FINAL CHI_e^2 NON-G COMPONENT
     #
     grf_chisq = grf.grf_chi_1d(N, Achi, Rchi, Bchi, kmaxknyq_ratio=kmnr, seed=seedchi)
-    ng_chisq = Fng * (grf_chisq)**2
+    ng_chisq = png_map_chisq(grf_chisq, Fng)
     ng_chisq = grf.dealiasx(ng_chisq, kmaxknyq_ratio=kmnr)
 
     # s = np.std(ng_chisq)
@@ -98,7 +108,7 @@ def png_chisq(N, Achi=10**(-10), Rchi=0.04, Bchi=0.0, Fng=1.0, kmaxknyq_ratio=2/
 
 
 ## Generate asymmetric sinh non-G component.
-def png_asymsinh(zg, nu=2, alpha=1.0, c=2, w=0.2):
+def png_asymsinh(zg, nu=2, alpha=1.0, c=2, w=0.2, out=None):
     """Generate Asymmetric Sinh Non-Gaussianity (only the FNG component, not the full NG field).
 
     Parameters
@@ -113,6 +123,8 @@ def png_asymsinh(zg, nu=2, alpha=1.0, c=2, w=0.2):
         ???
     w : float
         ???
+    out : array, optional
+        Buffer of the same shape as zg to write the result into; must not be zg.
 
     Returns
     -------
@@ -132,12 +144,13 @@ def png_asymsinh(zg, nu=2, alpha=1.0, c=2, w=0.2):
     #
     # FINAL ASYMMETRIC SINH NON-G COMPONENT
     #
-    ng_asymsinh = png_map_asymsinh(zg, nu*s, alpha) - zg
+    ng_asymsinh = png_map_asymsinh(zg, nu*s, alpha, out=out)
+    np.subtract(ng_asymsinh, zg, out=ng_asymsinh)
 
     return ng_asymsinh
 
 ## Map input GRF to asymmetric sinh non-G
-def png_map_asymsinh(x, w, alpha):
+def png_map_asymsinh(x, w, alpha, out=None, block=2**14):
     r"""Map a GRF to an Asymmetric $\sinh$ Non-Gaussian component.
     
     Parameters
@@ -145,24 +158,83 @@ def png_map_asymsinh(x, w, alpha):
     x
         The input GRF
     w
-        The width of the distribution
+        The width of the distribution (w > 0)
     alpha
         The power of the $\sinh$ function
+    out : array, optional
+        Buffer of the same shape as x to write the result into; may be x itself. A
+        non-contiguous buffer is filled from a contiguous scratch copy.
+    block : int, optional
+        Number of elements processed at a time.
     
     Returns
     -------
     y
         The value of y, which is the value of x if x is less than 0, and the value of w *
     kth_root(np.sinh((x / w)**alpha), alpha) if x is greater than 0.
+
+    Notes
+    -----
+    Evaluated as a fused chain of in-place ufuncs on cache-sized blocks of `out`,
+    so no full-size temporaries are allocated. For x >= 0 kth_root is just the
+    positive root, and the x < 0 branch (the identity) is copied back in at the
+    end of each block. This is faster than restricting the chain with `where=`,
+    whose masked loops are not vectorized.
     """
-    
-    y = np.where(x<0, x, w * kth_root(np.sinh((x / w)**alpha), alpha))
+    x = np.asarray(x, dtype=float)
+    # a non-contiguous out can't be flattened in place, so fill it from a contiguous copy
+    dst = out
+    if out is None or not out.flags.c_contiguous:
+        out = np.empty(x.shape)
+    x_flat = x.reshape(-1)
+    out_flat = out.reshape(-1)
+    saved = np.empty(min(block, x_flat.size))
+    neg = np.empty(saved.size, dtype=bool)
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        for start in range(0, x_flat.size, block):
+            xb = saved[:x_flat[start:start+block].size]
+            yb = out_flat[start:start+xb.size]
+            np.copyto(xb, x_flat[start:start+xb.size])
+            nb = np.less(xb, 0, out=neg[:xb.size])
+            np.divide(xb, w, out=yb)
+            if alpha != 1:
+                np.power(yb, alpha, out=yb)
+            np.sinh(yb, out=yb)
+            if alpha != 1:
+                np.power(yb, 1/alpha, out=yb)
+            np.multiply(yb, w, out=yb)
+            np.copyto(yb, xb, where=nb)
+
+    if dst is not None and dst is not out:
+        np.copyto(dst, out)
+        return dst
+    return out #- np.mean(y)
+
+def png_map_chisq(x, Fng=1.0, out=None):
+    """Map a GRF to a Chi_e^2 Non-Gaussian component, Fng * x**2.
+
+    Parameters
+    ----------
+    x : array
+        The input GRF.
+    Fng : float
+        Amplitude of the non-Gaussian component.
+    out : array, optional
+        Buffer of the same shape as x to write the result into; may be x itself.
 
-    return y #- np.mean(y)
+    Returns
+    -------
+    array
+        Fng * x**2 (not dealiased).
+    """
+    out = np.multiply(x, x, out=out)
+    out *= Fng
+    return out
 
 ### Asymmetric $\sinh$ non-Gaussianity
 ## ???
-def kth_root(x, n):
+def kth_root(x, n, out=None):
     """Return the kth root of x.
 
     Parameters
@@ -171,6 +243,8 @@ def kth_root(x, n):
         The number/array of numbers to take the root of.
     n : float
         The power of the root.
+    out : array, optional
+        Buffer of the same shape as x to write the result into; may be x itself.
 
     Returns
     -------
@@ -179,10 +253,17 @@ def kth_root(x, n):
     
     Notes
     -----
-    Used in png_map_asymsinh above.
+    Used in png_map_asymsinh above. Computed as sign(x) * |x|**(1/n), so only
+    one power is evaluated per element.
     """
-    
-    return np.where(x<0, -(-x)**(1/n), x**(1/n)).real
+    x = np.asarray(x, dtype=float)
+    neg = x < 0
+    if out is None:
+        out = np.empty_like(x)
+    np.abs(x, out=out)
+    np.power(out, 1/n, out=out)
+    np.negative(out, out=out, where=neg)
+    return out
 
 
 
@@ -262,4 +343,189 @@ def png_field(g, ng, FNL=1.0):
     #
     fieldng = g + FNL*ng
     
-    return fieldng
\ No newline at end of file
+    return fieldng
+
+
+############################################################
+#
+# Non-Gaussian Field Ensembles:
+# 
+## <b>Generate whole parameter scans of non-Gaussian components over a range of seeds in one call.</b>
+#
+############################################################
+PNG_PARAMS = {
+    'chisq': {'Achi': 10**(-10), 'Rchi': 0.04, 'Bchi': 0.0, 'Fng': 1.0},
+    'asymsinh': {'nu': 2, 'alpha': 1.0},
+}
+"""Parameters (and their defaults) of each kind of non-Gaussianity in png_ensemble."""
+
+def png_param_grid(kind, **values):
+    """Build the grid of all combinations of the given parameter values.
+
+    Parameters
+    ----------
+    kind : {'chisq', 'asymsinh'}
+        Kind of non-Gaussianity, see PNG_PARAMS for its parameters.
+    **values : float or sequence of float
+        Values of each parameter to scan; parameters not given are fixed to their defaults.
+
+    Returns
+    -------
+    params : np.ndarray, shape (n_params,)
+        Structured array with one float field per parameter, the last parameter varying fastest.
+
+    Examples
+    --------
+    >>> params = png_param_grid('chisq', Rchi=[0.02, 0.04], Fng=[0.5, 1.0, 2.0])
+    >>> params.shape
+    (6,)
+    """
+    if kind not in PNG_PARAMS:
+        raise ValueError("Invalid kind: {}. Must be one of {}.".format(kind, list(PNG_PARAMS)))
+    defaults = PNG_PARAMS[kind]
+    unknown = set(values) - set(defaults)
+    if unknown:
+        raise ValueError("Unknown parameters for {}: {}".format(kind, sorted(unknown)))
+
+    axes = [np.atleast_1d(np.asarray(values.get(name, default), dtype=float))
+            for name, default in defaults.items()]
+    mesh = np.meshgrid(*axes, indexing='ij')
+    params = np.empty(mesh[0].size, dtype=[(name, float) for name in defaults])
+    for name, m in zip(defaults, mesh):
+        params[name] = m.ravel()
+
+    return params
+
+def png_ensemble(N, kind, params, seeds, out_dir=None, ng_seed_offset=None, chunk_size=64, num_workers=1,
+                 pk_amp=1.0, pk_ns=1.0, kmaxknyq_ratio=2/3):
+    r"""Generate the non-Gaussian components of a whole parameter scan over a range of seeds.
+
+    Parameters
+    ----------
+    N : int
+        Number of grid points.
+    kind : {'chisq', 'asymsinh'}
+        Kind of non-Gaussianity.
+    params : np.ndarray
+        Parameter grid from png_param_grid(kind, ...).
+    seeds : sequence of int
+        Seeds of the Gaussian \zeta fields (see grf.grf_zeta_1d).
+    out_dir : str, optional
+        If given, stream the ensemble chunk by chunk to "zg.npy", "ng.npy" and "params.npy"
+        in this directory and return read-only memory maps of them. By default the ensemble is
+        returned in memory.
+    ng_seed_offset : int, optional
+        Seed offset of the GRFs the non-Gaussian components are built from. If None (default) they
+        are built from the \zeta fields themselves ('chisq': a \chi_e^2 GRF with the same seed;
+        'asymsinh': the \zeta field), i.e. correlated as in png_field_asymsinh_corr. Otherwise
+        seed + ng_seed_offset is used, as in png_field_chisq and png_field_asymsinh_uncorr.
+    chunk_size : int, optional
+        Number of seeds generated at a time, which bounds the memory to about
+        (n_params + 2) * chunk_size * N floats per worker.
+    num_workers : int, optional
+        Number of processes the seed chunks are spread over.
+    pk_amp, pk_ns, kmaxknyq_ratio : float, optional
+        Parameters of the Gaussian \zeta fields (and of the dealiasing of the \chi_e^2 components).
+
+    Returns
+    -------
+    zg : np.ndarray, shape (n_seeds, N)
+        Gaussian \zeta fields.
+    ng : np.ndarray, shape (n_params, n_seeds, N)
+        Non-Gaussian components; the full fields are png_field(zg, ng).
+
+    Notes
+    -----
+    Each base GRF is generated once per seed and shared by all parameter values that only change
+    the mapping applied to it ('chisq': Fng; 'asymsinh': all parameters), while the mapping itself
+    is applied to all seeds of a chunk at once. Seeding goes through the global numpy state as in
+    fields_gauss, so every chunk reproduces exactly the fields of the single-field functions.
+    """
+    if kind not in PNG_PARAMS:
+        raise ValueError("Invalid kind: {}. Must be one of {}.".format(kind, list(PNG_PARAMS)))
+    params = np.asarray(params)
+    if params.dtype.names != tuple(PNG_PARAMS[kind]):
+        raise ValueError("params must be a parameter grid from png_param_grid('{}', ...).".format(kind))
+    seeds = [int(seed) for seed in seeds]
+    N = int(N)
+    shapes = {'zg': (len(seeds), N), 'ng': (params.size, len(seeds), N)}
+    chunks = [(start, seeds[start:start+chunk_size]) for start in range(0, len(seeds), chunk_size)]
+    args = (N, kind, params, ng_seed_offset, pk_amp, pk_ns, kmaxknyq_ratio)
+
+    if out_dir is None:
+        out = {name: np.empty(shape) for name, shape in shapes.items()}
+    else:
+        os.makedirs(out_dir, exist_ok=True)
+        np.save(os.path.join(out_dir, 'params.npy'), params)
+        for name, shape in shapes.items():
+            np.lib.format.open_memmap(os.path.join(out_dir, name + '.npy'), mode='w+', shape=shape).flush()
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            futures = [pool.submit(_png_ensemble_chunk, start, chunk, out_dir, *args) for start, chunk in chunks]
+            for (start, chunk), future in zip(chunks, futures):
+                result = future.result()
+                if out_dir is None:
+                    _store_chunk(out, start, *result)
+    else:
+        for start, chunk in chunks:
+            result = _png_ensemble_chunk(start, chunk, out_dir, *args)
+            if out_dir is None:
+                _store_chunk(out, start, *result)
+
+    if out_dir is not None:
+        out = {name: np.load(os.path.join(out_dir, name + '.npy'), mmap_mode='r') for name in shapes}
+
+    return out['zg'], out['ng']
+
+def _png_ensemble_chunk(start, seeds, out_dir, N, kind, params, ng_seed_offset, pk_amp, pk_ns, kmaxknyq_ratio):
+    """Generate one chunk of seeds of png_ensemble, writing it to out_dir if given (else returning it)."""
+    kmnr = kmaxknyq_ratio
+    zg = np.stack([grf.grf_zeta_1d(N, pk_amp, pk_ns, kmaxknyq_ratio=kmnr, seed=seed) for seed in seeds])
+    ng = np.empty((params.size, len(seeds), N))
+    ng_seeds = seeds if ng_seed_offset is None else [seed + ng_seed_offset for seed in seeds]
+
+    if kind == 'chisq':
+        # the \chi_e^2 GRF depends on (Achi, Rchi, Bchi) only, Fng just scales its dealiased square
+        base = {}
+        for i, p in enumerate(params):
+            key = (p['Achi'], p['Rchi'], p['Bchi'])
+            if key not in base:
+                g = np.stack([grf.grf_chi_1d(N, *key, kmaxknyq_ratio=kmnr, seed=seed) for seed in ng_seeds])
+                base[key] = _dealias_rows(png_map_chisq(g, out=g), kmnr)
+            np.multiply(base[key], p['Fng'], out=ng[i])
+    else:
+        # png_asymsinh(x, nu, alpha) = s * png_map_asymsinh(x / s, nu, alpha) - x, with s = std(x)
+        if ng_seed_offset is None:
+            x = zg
+        else:
+            x = np.stack([grf.grf_zeta_1d(N, pk_amp, pk_ns, kmaxknyq_ratio=kmnr, seed=seed) for seed in ng_seeds])
+        s = x.std(axis=-1, keepdims=True)
+        u = x / s
+        for i, p in enumerate(params):
+            png_map_asymsinh(u, p['nu'], p['alpha'], out=ng[i])
+            ng[i] *= s
+            ng[i] -= x
+
+    if out_dir is None:
+        return zg, ng
+    stop = start + len(seeds)
+    zg_out = np.load(os.path.join(out_dir, 'zg.npy'), mmap_mode='r+')
+    ng_out = np.load(os.path.join(out_dir, 'ng.npy'), mmap_mode='r+')
+    zg_out[start:stop] = zg
+    ng_out[:, start:stop] = ng
+    zg_out.flush()
+    ng_out.flush()
+
+def _store_chunk(out, start, zg, ng):
+    """Copy one chunk of png_ensemble into the in-memory output arrays."""
+    out['zg'][start:start+len(zg)] = zg
+    out['ng'][:, start:start+len(zg)] = ng
+
+def _dealias_rows(f, kmaxknyq_ratio=(2/3)):
+    """grf.dealiasx applied to each row of f (last axis)."""
+    N = f.shape[-1]
+    kmax = int( kmaxknyq_ratio * (N//2) )
+    fk = np.fft.rfft(f, axis=-1)
+    fk[..., kmax+1:] = 0
+    return np.fft.irfft(fk, N, axis=-1)
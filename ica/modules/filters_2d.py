@@ -0,0 +1,234 @@
+#
+# Created by Jibran Haider.
+#
+"""This module contains functions for band-filtering 2D fields in k-space and performing ICA on the filtered bands.
+
+The 2D analogue of filters.py: the filters are annuli in |k| on the rfft2 grid, all fields are
+transformed once, and every band is separated with FastICA treating the pixels as samples.
+
+Routine Listings
+----------------
+kmag_2d(shape)
+    Return |k| on the rfft2 grid of a 2D field.
+band_indices_2d(shape, kbins, window='hann', dc=False)
+    Precompute the rfft2 cells and weights of every annular k-band.
+filter_bank_2d(fields, kbins, window='hann', dc=False, workers=None)
+    Band-filter 2D fields with an annular filter bank, one band at a time.
+filterbank_ica_2d(field_g, field_ng, kbins, window='hann', dc=False, workers=None,
+            max_iter=1e4, tol=1e-5, fun='logcosh', whiten='unit-variance', algo='parallel')
+    Mix two 2D fields and perform ICA on the full mixture and on each of its k-bands.
+
+Notes
+-----
+Wavenumbers are in grid units (fftfreq(N) * N), as in filters.py. For the Hann bank `kbins` are
+the band centres and neighbouring bands overlap so that the windows sum to one between
+kbins[0] and kbins[-1] (the continuous version of filters.window_hann); for the top-hat bank
+`kbins` are the band edges, band i covering kbins[i] < |k| <= kbins[i+1].
+"""
+
+import itertools
+from functools import lru_cache
+
+import numpy as np
+import scipy.fft
+
+from ica.modules.ica_1d import fastica_run, ica_match
+
+############################################################
+#
+# K-SPACE BANDS
+#
+############################################################
+@lru_cache(maxsize=8)
+def kmag_2d(shape):
+    """Return |k| on the rfft2 grid of a 2D field.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        (H, W) shape of the real space field.
+
+    Returns
+    -------
+    kmag : np.ndarray, shape (H, W//2 + 1)
+        Magnitude of the wavevector in grid units (read-only, cached per shape).
+    """
+    H, W = shape
+    ky = np.fft.fftfreq(H) * H
+    kx = np.fft.rfftfreq(W) * W
+    kmag = np.sqrt(ky[:, None]**2 + kx[None, :]**2)
+    kmag.flags.writeable = False
+
+    return kmag
+
+@lru_cache(maxsize=16)
+def band_indices_2d(shape, kbins, window='hann', dc=False):
+    """Precompute the rfft2 cells and weights of every annular k-band.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        (H, W) shape of the real space field.
+    kbins : tuple of float
+        Band centres ('hann') or band edges ('tophat'), increasing.
+    window : {'hann', 'tophat'}, optional
+        Shape of the bands. The default is 'hann'.
+    dc : bool, optional
+        Whether to keep the k = 0 mode in every band. The default is False.
+
+    Returns
+    -------
+    bands : tuple of (np.ndarray, np.ndarray)
+        For every band, the flat indices of its nonzero rfft2 cells and the window values there.
+    """
+    kmag = kmag_2d(shape).ravel()
+    kbins = np.asarray(kbins, dtype=float)
+    if kbins.ndim != 1 or kbins.size < 2 or np.any(np.diff(kbins) <= 0):
+        raise ValueError("kbins must be an increasing sequence of at least two values.")
+
+    bands = []
+    if window == 'hann':
+        # cos^2 rolloff from each centre to its neighbours; the end bands are half windows
+        for i, kc in enumerate(kbins):
+            klow = kbins[i-1] if i > 0 else kc
+            khigh = kbins[i+1] if i < kbins.size-1 else kc
+            idx = np.flatnonzero((kmag > klow) & (kmag < khigh) | (kmag == kc))
+            k = kmag[idx]
+            width = np.where(k < kc, kc - klow, khigh - kc)
+            weights = np.cos(0.5*np.pi * np.abs(k - kc) / np.where(width > 0, width, 1))**2
+            bands.append((idx, weights))
+    elif window == 'tophat':
+        for klow, khigh in zip(kbins[:-1], kbins[1:]):
+            idx = np.flatnonzero((kmag > klow) & (kmag <= khigh))
+            bands.append((idx, np.ones(idx.size)))
+    else:
+        raise ValueError("Invalid window: {}. Must be 'hann' or 'tophat'.".format(window))
+
+    out = []
+    for idx, weights in bands:
+        keep = kmag[idx] != 0
+        idx, weights = idx[keep], weights[keep]
+        if dc:
+            idx, weights = np.append(idx, 0), np.append(weights, 1.)
+        idx.flags.writeable = weights.flags.writeable = False
+        out.append((idx, weights))
+
+    return tuple(out)
+
+def filter_bank_2d(fields, kbins, window='hann', dc=False, workers=None):
+    """Band-filter 2D fields with an annular filter bank, one band at a time.
+
+    Parameters
+    ----------
+    fields : np.ndarray, shape (..., H, W)
+        Real 2D fields; all leading axes are filtered together.
+    kbins : sequence of float
+        Band centres ('hann') or band edges ('tophat'), see band_indices_2d.
+    window : {'hann', 'tophat'}, optional
+        Shape of the bands. The default is 'hann'.
+    dc : bool, optional
+        Whether to keep the k = 0 mode in every band. The default is False.
+    workers : int, optional
+        Number of threads used by scipy.fft.
+
+    Yields
+    ------
+    filtered : np.ndarray, shape (..., H, W)
+        The fields restricted to each band, in the order of the bands.
+
+    Notes
+    -----
+    The fields are transformed once with rfft2; each band only scatters its own cells into a
+    zeroed spectrum and takes one irfft2.
+    """
+    fields = np.asarray(fields)
+    shape = fields.shape[-2:]
+    bands = band_indices_2d(tuple(shape), tuple(np.asarray(kbins, dtype=float)), window, dc)
+
+    fk = scipy.fft.rfft2(fields, workers=workers)
+    fk_flat = fk.reshape(-1, fk.shape[-2] * fk.shape[-1])
+    band_k = np.zeros_like(fk)
+    band_flat = band_k.reshape(fk_flat.shape)
+
+    for idx, weights in bands:
+        band_flat[:, idx] = fk_flat[:, idx] * weights
+        yield scipy.fft.irfft2(band_k, s=shape, workers=workers)
+        band_flat[:, idx] = 0
+
+
+
+############################################################
+#
+# FILTERED ICA
+#
+############################################################
+def filterbank_ica_2d(field_g, field_ng, kbins, window='hann', dc=False, workers=None,
+                    max_iter=1e4, tol=1e-5, fun='logcosh', whiten='unit-variance', algo='parallel'):
+    """Mix two 2D fields and perform ICA on the full mixture and on each of its k-bands.
+
+    Parameters
+    ----------
+    field_g : np.ndarray, shape (H, W)
+        Gaussian source field.
+    field_ng : np.ndarray, shape (H, W)
+        Non-Gaussian source field.
+    kbins : sequence of float
+        Band centres ('hann') or band edges ('tophat'), see band_indices_2d.
+    window : {'hann', 'tophat'}, optional
+        Shape of the bands. The default is 'hann'.
+    dc : bool, optional
+        Whether to keep the k = 0 mode in every band. The default is False.
+    workers : int, optional
+        Number of threads used by scipy.fft.
+    max_iter, tol, fun, whiten, algo : optional
+        FastICA parameters, see ica_1d.fastica_run.
+
+    Returns
+    -------
+    src : np.ndarray, shape (nbands+1, 2, H, W)
+        Source components (non-Gaussian first); index 0 is unfiltered, then one entry per band.
+    ica_src : np.ndarray, shape (nbands+1, 2, H, W)
+        Matched (swapped, scaled and sign-corrected) ICA components.
+    max_amps : np.ndarray, shape (nbands+1, 2, 3)
+        Maximum amplitudes of the source and ICA components, see ica_1d.ica_scaleoffset.
+    mix_signal : np.ndarray, shape (2, H, W)
+        The unfiltered mixtures.
+
+    Notes
+    -----
+    Filtering is linear, so the sources and the mixtures are filtered together (one rfft2 of
+    the four fields) and the mixing matrix is the same in every band. The pixels are the ICA
+    samples: each band is passed to FastICA as a (2, H*W) view of the filtered fields.
+    """
+    shape = field_g.shape
+    if field_ng.shape != shape or len(shape) != 2:
+        raise ValueError("field_g and field_ng must be 2D arrays of the same shape.")
+
+    # mix the sources as ica_1d.ica_setup does
+    source_comps = np.stack([field_ng, field_g])
+    mix_matrix = (1.0+np.random.random((2, 2)))/2.0
+    mix_signal = np.tensordot(mix_matrix, source_comps, axes=1)
+
+    nbands = len(band_indices_2d(tuple(shape), tuple(np.asarray(kbins, dtype=float)), window, dc))
+    src = np.empty((nbands+1, 2) + shape)
+    ica_src = np.empty((nbands+1, 2) + shape)
+    max_amps = np.empty((nbands+1, 2, 3))
+
+    fields = np.concatenate([source_comps, mix_signal])
+    bands = filter_bank_2d(fields, kbins, window=window, dc=dc, workers=workers)
+    for count, filtered in enumerate(itertools.chain([fields], bands)):
+        if count == 0:
+            print(f"Processing unfiltered field...")
+        else:
+            print(f"Processing k-bin number:    {count} ...")
+
+        src_flat = filtered[:2].reshape(2, -1)
+        mix_flat = filtered[2:].reshape(2, -1)
+        ica_src_og = fastica_run(mix_flat, 2, max_iter=max_iter, tol=tol, fun=fun, whiten=whiten, algo=algo)
+        ica_matched, src_max, ica_max = ica_match(src_flat, ica_src_og)
+
+        src[count] = filtered[:2]
+        ica_src[count] = ica_matched.reshape((2,) + shape)
+        max_amps[count] = src_max, ica_max
+
+    return src, ica_src, max_amps, mix_signal
@@ -11,6 +11,8 @@ ICA
 Notes
 -----
 """
+import time
+
 import numpy as np
 from sklearn.decomposition import FastICA
 
@@ -33,6 +35,16 @@ class ICAProcessor:
         Whether to prewhiten the data before running ICA.
     wbin_size : int
         The size of the bins to use for prewhitening.
+    backend : str
+        The separation backend, 'fastica' or 'rica'.
+    rica_patch_size : int
+        Length of the windows the RICA filters act on; 1 is plain (pointwise) unmixing.
+    rica_lambda : float
+        Weight of the RICA reconstruction cost.
+    rica_kwargs : dict
+        Extra options for rica.rica_1d.train_rica (num_filters, num_epochs, optimizer, ...).
+    sep_time : float
+        Wall-clock time in seconds of the last separation run by ica_all.
     src_max : ndarray
         The maximum values of the source components.
     ica_max : ndarray
@@ -44,6 +56,8 @@ class ICAProcessor:
         Set up signal mixture for ICA.
     fastica_run(mix, num_comps)
         Initialize FastICA with given params.
+    rica_run(mix, num_comps)
+        Separate the mixture with 1D reconstruction ICA (RICA).
     ica_all(field_g, field_ng)
         Preprocess signals, run ICA, and perform postprocessing on the given fields.
     match_rescale_ica(src_comps, ica_comps)
@@ -53,7 +67,8 @@ class ICAProcessor:
     find_max(src_comps, ica_comps)
         Find maximum amplitude values (positive or negative) for both source and ICA-separated data.
     """
-    def __init__(self, max_iter=1e4, tol=1e-5, fun='logcosh', whiten='unit-variance', algo='parallel', prewhiten=False, wbin_size=None):
+    def __init__(self, max_iter=1e4, tol=1e-5, fun='logcosh', whiten='unit-variance', algo='parallel', prewhiten=False, wbin_size=None,
+                 backend='fastica', rica_patch_size=1, rica_lambda=10., rica_kwargs=None):
         self.max_iter = max_iter
         self.tol = tol
         self.fun = fun
@@ -61,6 +76,11 @@ class ICAProcessor:
         self.algo = algo
         self.prewhiten = prewhiten
         self.wbin_size = wbin_size
+        self.backend = backend
+        self.rica_patch_size = rica_patch_size
+        self.rica_lambda = rica_lambda
+        self.rica_kwargs = rica_kwargs
+        self.sep_time = None
         self.src_max = None
         self.ica_max = None
 
@@ -133,6 +153,47 @@ class ICAProcessor:
         
         return sources.T
 
+    def rica_run(self, mix, num_comps):
+        """Separate the mixture with 1D reconstruction ICA (RICA).
+
+        The mixtures are centred and whitened, and RICA filters are learned
+        on the periodic windows of length `rica_patch_size` around every
+        pixel (all mixtures concatenated) with minibatch Adam on CPU by
+        default. Each filter applied to the windows gives one component.
+        With rica_patch_size=1 and num_filters=num_comps this is ordinary
+        (complete) ICA; more filters than components give an overcomplete
+        set from which match_rescale_ica picks the best matches.
+
+        Parameters
+        ----------
+        mix : np.ndarray, shape (n, m)
+            nxm numpy array containing the mixed/observed signals.
+        num_comps : int
+            Number of components to extract, unless rica_kwargs sets num_filters.
+
+        Returns
+        -------
+        sources : np.ndarray, shape (num_filters, m)
+            num_filters x m numpy array containing the extracted components.
+        """
+        # torch is only needed for this backend
+        import torch
+        from rica.rica_1d import strip_windows, train_rica
+
+        # centre and whiten to unit variance, as FastICA does
+        mix_c = mix - mix.mean(axis=1, keepdims=True)
+        evals, evecs = np.linalg.eigh(np.cov(mix_c))
+        mix_white = (evecs / np.sqrt(evals)).T @ mix_c
+
+        windows = strip_windows(torch.as_tensor(mix_white, dtype=torch.float32), self.rica_patch_size)
+        opts = dict(num_filters=num_comps, num_epochs=100, batch_size=256, optimizer='adam', lr=1e-2,
+                    seed=np.random.randint(2**31 - 1), verbose=False)
+        opts.update(self.rica_kwargs or {})
+        weight, _ = train_rica(windows, [self.rica_lambda], **opts)
+
+        sources = windows @ weight[0]
+        return sources.numpy().T.astype(mix.dtype)
+
     def match_rescale_ica(self, src_comps, ica_comps):
         """Match and rescale ICA components to the original source components.
 
@@ -262,7 +323,14 @@ class ICAProcessor:
         else:
             mix_signal = mix_signal_pre
 
-        ica_src_og = self.fastica_run(mix_signal, num_comps)
+        tic = time.time()
+        if self.backend == 'rica':
+            ica_src_og = self.rica_run(mix_signal, num_comps)
+        elif self.backend == 'fastica':
+            ica_src_og = self.fastica_run(mix_signal, num_comps)
+        else:
+            raise ValueError("Unknown ICA backend '{}'".format(self.backend))
+        self.sep_time = time.time() - tic
         
         # Convert source components to a dictionary with labels for PNG and GRF
         # The default order in create_comps_dict is PNG, GRF
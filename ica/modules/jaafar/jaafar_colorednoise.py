@@ -2,6 +2,9 @@
 Copyright (c) 2014-2017 Felix Patzelt
 """
 
+from functools import lru_cache
+
+import numpy as np
 from numpy import sqrt, newaxis
 from numpy.fft import irfft, rfftfreq
 from numpy.random import normal
@@ -96,3 +99,102 @@ def powerlaw_psd_gaussian(exponent, size, fmin=0):
     y = irfft(s, n=samples, axis=-1) / sigma
     
     return y
+
+
+@lru_cache(maxsize=32)
+def psd_scaling(exponent, samples, fmin=0):
+    """Frequency scaling vector and output standard deviation of
+    powerlaw_psd_gaussian, cached per (exponent, samples, fmin).
+    Returns
+    -------
+    s_scale : array
+        Read-only (samples // 2 + 1,) amplitude scaling of each frequency.
+    sigma : float
+        Theoretical standard deviation of the unnormalised output.
+    """
+    f = rfftfreq(samples)
+    fmin = max(fmin, 1./samples) # Low frequency cutoff
+    ix   = npsum(f < fmin)   # Index of the cutoff
+    if ix and ix < len(f):
+        f[:ix] = f[ix]
+    s_scale = f**(-exponent/2.)
+
+    w      = s_scale[1:].copy()
+    w[-1] *= (1 + (samples % 2)) / 2. # correct f = +-0.5
+    sigma = 2 * sqrt(npsum(w**2)) / samples
+
+    s_scale.flags.writeable = False
+    return s_scale, sigma
+
+
+class ColoredNoiseGenerator:
+    """Batches of Gaussian (1/f)**beta noise, as powerlaw_psd_gaussian.
+
+    The frequency scaling is computed once (see psd_scaling) and samples are
+    drawn from independent numpy.random.Generator streams spawned from one
+    seed, e.g. one stream per ensemble member or worker. Every call draws a
+    whole (B, samples) batch with a single irfft along the last axis, reusing
+    a spectrum buffer per batch size and optionally writing into `out`.
+    Parameters:
+    -----------
+    exponent : float
+        The power-spectrum of the generated noise is proportional to
+        S(f) = (1 / f)**beta, see powerlaw_psd_gaussian.
+    samples : int
+        Length of every time series.
+    fmin : float, optional
+        Low-frequency cutoff, see powerlaw_psd_gaussian.
+    seed : int or SeedSequence, optional
+        Entropy from which the streams are spawned.
+    num_streams : int, optional
+        Number of independent streams. Default: 1.
+    Examples:
+    ---------
+    >>> gen = ColoredNoiseGenerator(1, 1024, seed=42, num_streams=4)
+    >>> y = gen(10000, stream=2)              # (10000, 1024) pink noise
+    >>> gen(10000, stream=2, out=y)           # refill y in place
+    """
+
+    def __init__(self, exponent, samples, fmin=0, seed=None, num_streams=1):
+        self.exponent = exponent
+        self.samples = samples
+        self.fmin = fmin
+        self.s_scale, self.sigma = psd_scaling(exponent, samples, fmin)
+        self.streams = [np.random.default_rng(s)
+                        for s in np.random.SeedSequence(seed).spawn(num_streams)]
+        self._spectrum = None
+
+    def __call__(self, batch_size=1, stream=0, out=None):
+        """Draw a (batch_size, samples) batch of unit-variance noise.
+        Parameters:
+        -----------
+        batch_size : int
+            Number of independent time series.
+        stream : int
+            Index of the Generator stream to draw from.
+        out : array, optional
+            (batch_size, samples) float64 array to write the noise into.
+        Returns
+        -------
+        out : array
+            The samples.
+        """
+        nf = self.s_scale.size
+        if self._spectrum is None or self._spectrum.shape[0] != batch_size:
+            self._spectrum = np.empty((batch_size, nf), dtype=complex)
+        spectrum = self._spectrum
+
+        # real and imaginary parts drawn in one go straight into the buffer
+        self.streams[stream].standard_normal(out=spectrum.view(float))
+        spectrum *= self.s_scale
+
+        # If the signal length is even, frequencies +/- 0.5 are equal
+        # so the coefficient must be real.
+        if not (self.samples % 2): spectrum[:, -1].imag = 0
+
+        # Regardless of signal length, the DC component must be real
+        spectrum[:, 0].imag = 0
+
+        out = irfft(spectrum, n=self.samples, axis=-1, out=out)
+        out /= self.sigma
+        return out
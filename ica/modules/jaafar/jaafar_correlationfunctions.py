@@ -1,4 +1,7 @@
+from functools import lru_cache
+
 import numpy as np
+import scipy.fft
 from . import jaafar_fouriertransform as ft
 # import jaafar_fouriertransform as ft
 
@@ -64,6 +67,150 @@ def k_skewness(x, BoxSize=1.0, nbins=60):
     return sk[kbins<=.5], kbins[kbins<=.5]
 
 
+
+############################################################
+#
+# RFFTN SPECTRAL STATISTICS
+#
+############################################################
+# The real-to-complex half-spectrum holds every mode of a real field once,
+# except that the conjugate partners of the kz=0 (and, for even N, kz=N/2)
+# planes are missing. Weighting those planes by 1 and the rest by 2
+# reproduces averages over the full complex spectrum.
+
+@lru_cache(maxsize=8)
+def rfft_bins(N, nbins=None):
+    """
+    Cached |k| binning of the rfftn half-spectrum of an N^3 cube.
+
+    The bins are those of power_spectrum: nbins (default int(N/2.1)) linear
+    bins between the smallest and largest |k| of the full grid, with k in
+    the units of ft.fftmodes(N) (cycles per grid cell) as in ft.fft, so the
+    binning does not depend on BoxSize.
+
+    RETURNS: ind, (N, N, N//2+1) bin index of every mode (0 and nbins+1 are
+    out of range, as in np.digitize); counts, the number of full-spectrum
+    modes per bin; kbins, the mean |k| per bin; edges, the bin edges.
+    """
+    if nbins is None:
+        nbins = int(N / 2.1)
+    kmag = rfft_kmag(N)
+    # |k| runs from 0 to that of the (-N/2, -N/2, N/2) corner, like ft.fftmodes
+    edges = np.linspace(0., np.sqrt(3) * (N//2) / N, nbins + 1)
+    ind = np.digitize(kmag, edges).astype(np.min_scalar_type(nbins + 1))
+    counts = hermitian_bin_sum(ind, None, N, nbins)
+    kbins = hermitian_bin_sum(ind, kmag, N, nbins) / counts
+    ind.flags.writeable = False
+    return ind, counts, kbins, edges
+
+def rfft_kmag(N):
+    """
+    |k| of the rfftn half-spectrum of an N^3 cube in the units of ft.fftmodes(N),
+    from broadcast 1D axis arrays.
+    """
+    kx = np.fft.fftfreq(N)
+    kz = np.fft.rfftfreq(N)
+    return np.sqrt(kx[:, None, None]**2 + kx[None, :, None]**2 + kz[None, None, :]**2)
+
+def hermitian_bin_sum(ind, q, N, nbins):
+    """
+    Sum of the real half-spectrum quantity q over each bin of ind, counting
+    every mode of the full spectrum once (q=None counts the modes).
+    """
+    def bin_sum(i, w):
+        return np.bincount(i.ravel(), weights=None if w is None else w.ravel(), minlength=nbins + 2)
+
+    s = 2 * bin_sum(ind, q)
+    s -= bin_sum(ind[..., 0], None if q is None else q[..., 0])
+    if N % 2 == 0:
+        s -= bin_sum(ind[..., -1], None if q is None else q[..., -1])
+    return s[1:-1]
+
+def rfft_field(x, BoxSize=1.0, workers=None):
+    """
+    Half-spectrum of the cube x, normalized as ft.fft (BoxSize^-3 * FFT) but without any shift.
+    """
+    return scipy.fft.rfftn(x, workers=workers) * BoxSize**-3
+
+def power_spectra_rfft(fields, BoxSize=1.0, nbins=None, workers=None):
+    """
+    All auto- and cross-power spectra of a list of (N, N, N) cubes, from one
+    forward rfftn per field and the cached binning of rfft_bins.
+
+    RETURNS: P, (n_fields, n_fields, nbins) with P[i, j] the cross spectrum of
+    fields i and j in the normalization of power_spectrum; kbins, mean |k| per bin.
+    """
+    N = fields[0].shape[0]
+    ind, counts, kbins, _ = rfft_bins(N, nbins)
+    nbins = kbins.size
+    fks = [rfft_field(x, BoxSize, workers) for x in fields]
+
+    P = np.empty((len(fks), len(fks), nbins))
+    for i in range(len(fks)):
+        for j in range(i, len(fks)):
+            pk = fks[i].real * fks[j].real
+            pk += fks[i].imag * fks[j].imag
+            P[i, j] = P[j, i] = hermitian_bin_sum(ind, pk, N, nbins) / counts * (BoxSize**6 / N**2)
+    return P, kbins
+
+def power_spectrum_rfft(x1, x2=None, BoxSize=1.0, nbins=None, workers=None):
+    """
+    Same as power_spectrum for cubes, from the rfftn half-spectrum.
+    """
+    fields = [x1] if x2 is None else [x1, x2]
+    P, kbins = power_spectra_rfft(fields, BoxSize=BoxSize, nbins=nbins, workers=workers)
+    return P[0, -1], kbins
+
+def bispectrum_rfft(x, kbin_edges, BoxSize=1.0, workers=None):
+    """
+    FFT-based binned bispectrum estimator of the cube x from one forward rfftn.
+
+    For every |k| shell i (kbin_edges[i] <= |k| < kbin_edges[i+1], k in the
+    units of ft.fftmodes(N) as in power_spectrum) the
+    shell-filtered field I_i and the shell indicator N_i are transformed back
+    to real space, and for each bin triplet
+
+        B_ijk = sum_x I_i I_j I_k / sum_x N_i N_j N_k * BoxSize^6 / N^9,
+
+    the average of d(k1) d(k2) d(k3) over all closed triangles k1+k2+k3=0
+    with one side in each shell (d the raw DFT), in the V^2/N^9 convention.
+    Triplets without triangles are NaN. Memory: 2 * len(kbin_edges) real N^3 cubes.
+
+    RETURNS: B, (nb, nb, nb) symmetric bispectrum; ntri, the number of triangles
+    of each triplet; kcenters, centres of the shells.
+    """
+    N = x.shape[0]
+    edges = np.asarray(kbin_edges, dtype=float)
+    nb = edges.size - 1
+    xk = scipy.fft.rfftn(x, workers=workers)
+    kmag = rfft_kmag(N)
+
+    I = np.empty((nb,) + x.shape)
+    Nk = np.empty((nb,) + x.shape)
+    for i in range(nb):
+        shell = (kmag >= edges[i]) & (kmag < edges[i + 1])
+        I[i] = scipy.fft.irfftn(np.where(shell, xk, 0), s=x.shape, workers=workers)
+        Nk[i] = scipy.fft.irfftn(shell.astype(float), s=x.shape, workers=workers)
+    del kmag, xk
+
+    B = np.full((nb, nb, nb), np.nan)
+    ntri = np.zeros((nb, nb, nb))
+    for i in range(nb):
+        for j in range(i, nb):
+            IJ = I[i] * I[j]
+            NJ = Nk[i] * Nk[j]
+            for k in range(j, nb):
+                # sum_x N_i N_j N_k = ntri / N^6
+                n = np.vdot(NJ, Nk[k]) * N**6
+                if n < 0.5:
+                    continue
+                b = np.vdot(IJ, I[k]) * N**6 / n * BoxSize**6 / N**9
+                for p in {(i, j, k), (i, k, j), (j, i, k), (j, k, i), (k, i, j), (k, j, i)}:
+                    B[p] = b
+                    ntri[p] = np.rint(n)
+    return B, ntri, 0.5 * (edges[1:] + edges[:-1])
+
+
 def cdf(x):
     X = np.sort(x.flatten())
     C = np.arange(len(X)) / (len(X) - 1)
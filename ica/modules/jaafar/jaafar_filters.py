@@ -2,9 +2,23 @@
 // Created by Jaafar.
 Modified by Jibran Haider. //
 
+
+**Contains the following functions**
+
+window_tophat(f, kmin, kmax):
+window_gauss_log(g, N, k_center, k_width):
+window_gauss_norm(g, N, k_center, k_width):
+window_gauss(g, N, k_center, k_width):
+filter_profile(x, y, z, s):
+ft_filter_profile(kx, ky, kz, s):
+filter_field(X, rf, BoxSize=1.0):
+rfft_axis_modes(N, BoxSize=1.0):
+filter_fields(X, rf, BoxSize=1.0, window='gaussian', workers=None):
+
 """
 
 import numpy as np
+import scipy.fft
 from . import jaafar_fouriertransform as ft
 
 def window_tophat(f, kmin, kmax):
@@ -95,4 +109,72 @@ def filter_field(X, rf, BoxSize=1.0):
     
     filtered_ft = ft1 * W
     filtered_X = ft.ifft(filtered_ft, BoxSize=BoxSize)
-    return filtered_X
\ No newline at end of file
+    return filtered_X
+
+
+############################################################
+#
+# RFFTN MULTI-SCALE FILTERING
+#
+############################################################
+
+
+def rfft_axis_modes(N, BoxSize=1.0):
+    """
+    Wavenumbers of the rfftn half-spectrum of an N^3 cube, as 1D axis arrays
+    shaped (N, 1, 1), (1, N, 1) and (1, 1, N//2+1) for broadcasting.
+
+    They are the unshifted counterparts of ft.fftmodes(N, BoxSize), so no
+    fftshift/ifftshift is needed anywhere.
+    """
+    kx = np.fft.fftfreq(N, BoxSize/N)
+    kz = np.fft.rfftfreq(N, BoxSize/N)
+    return kx[:, None, None], kx[None, :, None], kz[None, None, :]
+
+def filter_fields(X, rf, BoxSize=1.0, window='gaussian', workers=None):
+    """
+    Smooth the cube X with one or several filter radii from a single forward rfftn.
+
+    X : (N, N, N) real field.
+    rf : filter radius, or a sequence of radii.
+    BoxSize : side length of the box.
+    window : 'gaussian', the separable exp(-rf^2 k^2 / 2) of ft_filter_profile,
+        built from 1D axis factors; or 'tophat', the spherical top-hat
+        3 (sin(kr) - kr cos(kr)) / kr^3 with kr = rf |k| (1 at k=0), built
+        from broadcast 1D axis arrays one x-plane at a time.
+    workers : number of threads for scipy.fft (None for a single thread, -1 for all cores).
+
+    RETURNS: (N, N, N) real smoothed field if rf is a scalar, otherwise an
+    (len(rf), N, N, N) stack, one smoothed field per radius.
+
+    For the Gaussian window this equals filter_field(X, rf, BoxSize).real, but
+    the half-spectrum is only computed once and the windows never need a
+    full N^3 |k| grid.
+    """
+    N = X.shape[0]
+    radii = np.atleast_1d(rf)
+    Xk = scipy.fft.rfftn(X, workers=workers)
+    work = np.empty_like(Xk)
+    out = np.empty((radii.size,) + X.shape, dtype=Xk.real.dtype)
+
+    kx, ky, kz = rfft_axis_modes(N, BoxSize)
+    for j, r in enumerate(radii):
+        if window == 'gaussian':
+            # separable: exp(-r^2 k^2 / 2) = prod_i exp(-r^2 k_i^2 / 2)
+            np.multiply(Xk, np.exp(-r**2 * kx**2 / 2), out=work)
+            work *= np.exp(-r**2 * ky**2 / 2)
+            work *= np.exp(-r**2 * kz**2 / 2)
+        elif window == 'tophat':
+            k_sq_yz = (ky**2 + kz**2)[0]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for i in range(N):
+                    kr = r * np.sqrt(k_sq_yz + kx[i, 0, 0]**2)
+                    W = np.where(kr != 0, 3 * (np.sin(kr) - kr * np.cos(kr)) / kr**3, 1.)
+                    np.multiply(Xk[i], W, out=work[i])
+        else:
+            raise ValueError("Unknown window '{}'".format(window))
+        out[j] = scipy.fft.irfftn(work, s=X.shape, workers=workers, overwrite_x=True)
+
+    if np.ndim(rf) == 0:
+        return out[0]
+    return out
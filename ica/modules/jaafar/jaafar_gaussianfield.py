@@ -9,6 +9,7 @@ gauss_var(size, seed=None):
 power_array(Pk, k):
 power_array_new(k, amp, tilt=1):
 gaussian_random_field(N, BoxSize=1.0, seed=None, Pk=lambda k: k**-3):
+gaussian_random_field_rfft(N, BoxSize=1.0, seed=None, Pk=lambda k: k**-3, workers=None, dtype=np.float64, normalize=True):
 gaussian_random_field_1D(N, BoxSize=1.0, seed=None):
 window(g, N, k_low, k_up):
 window_gauss_log(g, N, k_center, k_width):
@@ -18,6 +19,7 @@ window_gauss_norm(g, N, k_center, k_width):
 
 
 import numpy as np
+import scipy.fft
 from . import jaafar_fouriertransform as ft
 
 
@@ -51,6 +53,45 @@ def gaussian_random_field(N, BoxSize=1.0, seed=None, Pk=lambda k: k**-3):
     out = ft.ifft(g, BoxSize=BoxSize).real
     s = np.sqrt(np.sum(out**2) / N**3)
     return out / s
+
+def gaussian_random_field_rfft(N, BoxSize=1.0, seed=None, Pk=lambda k: k**-3, workers=None, dtype=np.float64, normalize=True):
+    """
+    3D Gaussian random field with power spectrum Pk, generated on the rfftn half-spectrum.
+
+    Real white noise is transformed with rfftn, which already has the Hermitian
+    symmetry of a real field, so only the N x N x (N//2+1) half-spectrum is
+    stored and no imaginary part is thrown away. |k| is built from broadcast
+    1D axis vectors one x-plane at a time and sqrt(P(k)) is applied in place,
+    so the peak memory is about one N^3 real buffer plus its half-spectrum.
+
+    N : number of grid points per side.
+    BoxSize : side length of the box; k is in the units of ft.fftmodes(N, BoxSize).
+    seed : seed for np.random.default_rng.
+    Pk : power spectrum P(k), called on (N, N//2+1) planes of |k|. The k=0 mode is set to 0.
+    workers : number of threads for scipy.fft (None for a single thread, -1 for all cores).
+    dtype : np.float64 or np.float32 (the latter halves the memory).
+    normalize : if True, scale the field to unit RMS as gaussian_random_field does.
+
+    RETURNS: (N, N, N) real field.
+    """
+    rng = np.random.default_rng(seed)
+    field = rng.standard_normal((N, N, N), dtype=dtype)
+    g = scipy.fft.rfftn(field, workers=workers, overwrite_x=True)
+    del field
+
+    k_sq_x = np.fft.fftfreq(N, BoxSize/N)**2
+    k_sq_yz = (np.fft.fftfreq(N, BoxSize/N)[:, None]**2
+               + np.fft.rfftfreq(N, BoxSize/N)[None, :]**2).astype(dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(N):
+            g[i] *= np.sqrt(Pk(np.sqrt(k_sq_yz + k_sq_x[i]))).astype(dtype)
+    g[0, 0, 0] = 0
+
+    out = scipy.fft.irfftn(g, s=(N, N, N), workers=workers, overwrite_x=True)
+    del g
+    if normalize:
+        out /= np.sqrt(np.vdot(out, out) / N**3)
+    return out
     
 
 # To generate 1D gaussian random field
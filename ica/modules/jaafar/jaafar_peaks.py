@@ -4,10 +4,22 @@ Modified by Jibran Haider & Tom Morrison. //
 
 **Contains the following functions**
 
+kth_root(x, n):
+map_sinh(x, w, alpha):
+map_bypart(x, xp, a):
+map_bump(x, z1, z2):
+map_smooth_bump(x, c, a):
+sq_ng(x, f_nl, s2):
+peak_profile(x, y, z, a, s):
+add_peaks(X, L, size):
+paint_peaks(X, L, truncate=None, method='fft', workers=None):
+draw_peaks(nop, size, zp, rp, seed=None):
+
 """
 
 
 import numpy as np
+import scipy.fft
 
 
 #### Non-Gaussian Components of Fields:
@@ -16,52 +28,109 @@ import numpy as np
 
 ### Correlated peaks functions
 
-def kth_root(x, n):
+def kth_root(x, n, out=None):
     """
-    
+    sign(x) * |x|**(1/n), written into out (which may be x).
     """
     
-    return np.where(x<0, -(-x)**(1/n), x**(1/n)).real
+    x = np.asarray(x, dtype=float)
+    neg = x < 0
+    if out is None:
+        out = np.empty_like(x)
+    np.abs(x, out=out)
+    np.power(out, 1/n, out=out)
+    np.negative(out, out=out, where=neg)
+    return out
+
+def _demean(y):
+    y -= np.mean(y)
+    return y
+
+def _copy_into(x, out):
+    x = np.asarray(x, dtype=float)
+    if out is None:
+        return x.copy()
+    if out is not x:
+        np.copyto(out, x)
+    return out
 
-def map_sinh(x, w, alpha):
+# The maps below are fused: each is a chain of ufuncs writing into a single
+# output buffer `out` (which may be x itself), with `where=` so that only the
+# active branch is evaluated.
+
+def map_sinh(x, w, alpha, out=None):
     """
     
     """
     
-    y = w * kth_root(np.sinh((x / w)**alpha), alpha)
-    return y - np.mean(y)
+    out = _copy_into(x, out)
+    np.divide(out, w, out=out)
+    np.power(out, alpha, out=out)
+    np.sinh(out, out=out)
+    kth_root(out, alpha, out=out)
+    np.multiply(out, w, out=out)
+    return _demean(out)
     #return np.where(x)
 
-def map_bypart(x, xp, a):
+def map_bypart(x, xp, a, out=None):
     """
     
     """
     
-    y = np.where(x<xp, x, a*x)
-    return y - np.mean(y)
+    upper = np.asarray(x) >= xp
+    out = _copy_into(x, out)
+    np.multiply(out, a, out=out, where=upper)
+    return _demean(out)
 
-def map_bump(x, z1, z2):
+def map_bump(x, z1, z2, out=None):
     """
     
     """
     
-    y = np.where(x<z1, x, np.where(x>z2, x, z1))
-    return y - np.mean(y)
+    x = np.asarray(x)
+    flat = (x >= z1) & (x <= z2)
+    out = _copy_into(x, out)
+    np.copyto(out, z1, where=flat)
+    return _demean(out)
 
-def map_smooth_bump(x, c, a):
+def map_smooth_bump(x, c, a, out=None, block=2**16):
     """
     
     """
     
-    y = np.abs(x-c)*np.tanh((x-c)/a) + c
-    return y - np.mean(y)
+    # |x-c| tanh((x-c)/a) = (x-c) tanh(|x-c|/a) needs two values per element,
+    # so it is evaluated blockwise with block-sized scratch; a non-contiguous
+    # out can't be flattened in place, so it is filled from a contiguous copy
+    dst = out
+    out = _copy_into(x, out if out is None or out.flags.c_contiguous else None)
+    flat = out.reshape(-1)
+    work = np.empty(min(block, flat.size))
+    for start in range(0, flat.size, block):
+        y = flat[start:start+block]
+        t = work[:y.size]
+        np.subtract(y, c, out=y)
+        np.abs(y, out=t)
+        np.divide(t, a, out=t)
+        np.tanh(t, out=t)
+        np.multiply(y, t, out=y)
+        np.add(y, c, out=y)
+    _demean(out)
+    if dst is not None and dst is not out:
+        np.copyto(dst, out)
+        return dst
+    return out
 
-def sq_ng(x, f_nl, s2):
+def sq_ng(x, f_nl, s2, out=None):
     """
-    
+    Local (f_nl-type) non-Gaussianity x + f_nl*(x**2 - s2), written into out (which may be x).
     """
     
-    return x + f_nl*(x**2-s2)
+    # x**2 goes into a scratch buffer first, so x is still intact when out is x
+    x = np.asarray(x, dtype=float)
+    sq = np.multiply(x, x)
+    sq -= s2
+    sq *= f_nl
+    return np.add(x, sq, out=out)
     
 
 ### Uncorrelated peaks functions
@@ -94,6 +163,78 @@ def add_peaks(X, L, size):
                           L[i][1], L[i][2])
     return P
 
+def paint_peaks(X, L, truncate=None, method='fft', workers=None):
+    """
+    Add the Gaussian peaks of L to the cube X with periodic wrapping, without
+    evaluating every profile over the whole grid as add_peaks does.
+
+    L is a list of [[x, y, z], zp, rp] as in add_peaks (and draw_peaks), with
+    the same axis convention: x runs along axis 1, y along axis 0, z along axis 2.
+    Peaks are grouped by radius rp, and each group is added at once:
+
+    method='fft' : the peak heights are painted onto a delta field which is
+        convolved with the periodic profile in Fourier space, one rfftn/irfftn
+        pair per radius. Positions must be integers (as from draw_peaks).
+        Without truncation the kernel transform is a product of 1D FFTs.
+    method='stencil' : each profile is evaluated only on the (2R+1)^3 local
+        stencil around its peak, R = ceil(truncate * rp), and accumulated with
+        a single bincount per group. Works for non-integer positions.
+
+    truncate : profiles are cut off at |r| > truncate * rp (default: no cut-off
+        for 'fft', 4 for 'stencil').
+    workers : number of threads for scipy.fft (None for a single thread, -1 for all cores).
+
+    RETURNS: new (N, N, N) array X + peaks.
+    """
+    N = X.shape[0]
+    pos = np.array([p[0] for p in L], dtype=float).reshape(-1, 3)[:, [1, 0, 2]]
+    amp = np.array([p[1] for p in L], dtype=float)
+    rad = np.array([p[2] for p in L], dtype=float)
+
+    # C order, so that flat is a view of P whatever the layout of X
+    P = np.array(X, dtype=float, order='C')
+    flat = P.reshape(-1)
+    l = np.arange(N)
+    for r in np.unique(rad):
+        group = rad == r
+        if method == 'fft':
+            if np.any(pos[group] != np.rint(pos[group])):
+                raise ValueError("method='fft' needs integer peak positions, use method='stencil'")
+            # heights on a delta field, with periodic wrapping of the positions
+            idx = np.ravel_multi_index(tuple(pos[group].astype(int).T % N), X.shape)
+            delta = np.bincount(idx, weights=amp[group], minlength=N**3).reshape(X.shape)
+
+            # profile centred on the origin, at minimum image distances
+            d = np.minimum(l, N - l)
+            g = np.exp(-.5 * d**2 / r**2)
+            if truncate is None:
+                gk = np.fft.fft(g).real
+                kernel_k = gk[:, None, None] * gk[None, :, None] * gk[None, None, :N//2+1]
+            else:
+                kernel = g[:, None, None] * g[None, :, None] * g[None, None, :]
+                kernel *= (d[:, None, None]**2 + d[None, :, None]**2 + d[None, None, :]**2) <= (truncate * r)**2
+                kernel_k = scipy.fft.rfftn(kernel, workers=workers)
+            delta_k = scipy.fft.rfftn(delta, workers=workers)
+            delta_k *= kernel_k
+            P += scipy.fft.irfftn(delta_k, s=X.shape, workers=workers)
+        elif method == 'stencil':
+            R = int(np.ceil((4. if truncate is None else truncate) * r))
+            offsets = np.arange(-R, R + 1)
+            for chunk in np.array_split(np.flatnonzero(group), max(1, group.sum() * (2*R+1)**3 // 2**24)):
+                base = np.floor(pos[chunk]).astype(int)
+                cells = base[:, :, None] + offsets                   # (n, 3, 2R+1) stencil coordinates
+                g = np.exp(-.5 * (cells - pos[chunk][:, :, None])**2 / r**2)
+                vals = amp[chunk, None, None, None] * g[:, 0, :, None, None] * g[:, 1, None, :, None] * g[:, 2, None, None, :]
+                if truncate is not None:
+                    dist_sq = ((cells - pos[chunk][:, :, None])**2)
+                    vals *= (dist_sq[:, 0, :, None, None] + dist_sq[:, 1, None, :, None] + dist_sq[:, 2, None, None, :]) <= (truncate * r)**2
+                cells %= N
+                idx = (cells[:, 0, :, None, None] * N + cells[:, 1, None, :, None]) * N + cells[:, 2, None, None, :]
+                flat += np.bincount(idx.ravel(), weights=vals.ravel(), minlength=N**3)
+        else:
+            raise ValueError("Unknown method '{}'".format(method))
+    return P
+
 def draw_peaks(nop, size, zp, rp, seed=None):
     """
     
@@ -0,0 +1,182 @@
+#
+# Created by Jibran Haider.
+#
+r"""Lazy, memory-mapped access to the chunked 2D Peak-Patch \zeta fields in ica/data/pkp_2d_zeta_fields.
+
+Each realization is stored as two directories of chunk files, one for the Gaussian field and one
+for the non-Gaussian field, e.g.::
+
+    z_ching6_statex424_chunk16/z2d_chunk01of16_statex424_chi_ng6.npy
+    zng_ching6_statex424_chunk16/zng2d_chunk01of16_statex424_chi_ng6.npy
+
+Only the .npy files are read (the .mat files are duplicates for MATLAB). Every chunk is opened
+with np.load(mmap_mode='r'), so nothing is read from disk until it is indexed.
+
+Classes
+-------
+ChunkedField
+    One set of chunk files presented as a single (n_chunks, H, W) array.
+PkpZeta2D
+    The aligned z/zng chunk sets of one realization.
+
+Notes
+-----
+The chunks are the tiles of one plane in row-major order (chunk 2 continues chunk 1 to the
+right, chunk 1+sqrt(n) continues it below); ChunkedField.plane reassembles it.
+"""
+
+import re
+from pathlib import Path
+
+import numpy as np
+
+DATA_DIR = Path(__file__).resolve().parents[1] / 'data' / 'pkp_2d_zeta_fields'
+"""Default location of the chunked 2D fields."""
+
+CHUNK_PATTERN = re.compile(r'^(?P<field>[a-z]+)2d_chunk(?P<idx>\d+)of(?P<n>\d+)_(?P<tag>.+)\.npy$')
+"""File name scheme of the chunks: <field>2d_chunk<XX>of<NN>_<tag>.npy."""
+
+
+class ChunkedField:
+    """One set of chunk files presented as a single (n_chunks, H, W) array.
+
+    Attributes
+    ----------
+    directory : Path
+        Directory holding the chunk files.
+    field : str
+        Field name from the file names ('z' or 'zng').
+    tag : str
+        Realization tag from the file names, e.g. 'statex424_chi_ng6'.
+    paths : list of Path
+        Chunk files, ordered by chunk number.
+    chunks : list of np.memmap
+        The memory-mapped chunks, in the same order.
+    shape : tuple of int
+        (n_chunks, H, W).
+    dtype : np.dtype
+        Data type of the chunks.
+
+    Methods
+    -------
+    __getitem__(key)
+        Index the set as one array; the first index selects chunks.
+    __iter__()
+        Iterate over the memory-mapped chunks.
+    plane()
+        Assemble the chunks into the full plane they tile.
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+        matches = []
+        for path in self.directory.glob('*.npy'):
+            match = CHUNK_PATTERN.match(path.name)
+            if match:
+                matches.append((int(match['idx']), path, match))
+        if not matches:
+            raise FileNotFoundError("No '<field>2d_chunkXXofNN_<tag>.npy' files in {}".format(self.directory))
+        matches.sort(key=lambda m: m[0])
+
+        names = {(m['field'], m['n'], m['tag']) for _, _, m in matches}
+        if len(names) > 1:
+            raise ValueError("Mixed chunk sets in {}: {}".format(self.directory, sorted(names)))
+        self.field, n_total, self.tag = names.pop()
+        indices = [idx for idx, _, _ in matches]
+        if indices != list(range(1, int(n_total) + 1)):
+            raise ValueError("Expected chunks 1 to {} in {}, found {}".format(n_total, self.directory, indices))
+
+        self.paths = [path for _, path, _ in matches]
+        self.chunks = [np.load(path, mmap_mode='r') for path in self.paths]
+        shapes = {chunk.shape for chunk in self.chunks}
+        if len(shapes) > 1:
+            raise ValueError("Chunks in {} have different shapes: {}".format(self.directory, sorted(shapes)))
+        self.shape = (len(self.chunks),) + shapes.pop()
+        self.dtype = self.chunks[0].dtype
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __getitem__(self, key):
+        """Index the set as one (n_chunks, H, W) array.
+
+        An integer first index returns (a view of) one memory-mapped chunk; any other first
+        index (slice, index array or mask) reads the selected chunks into a new array.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, (int, np.integer)):
+            return self.chunks[range(len(self.chunks))[first]][rest]
+        return np.stack([self.chunks[i][rest] for i in np.arange(len(self.chunks))[first]])
+
+    def plane(self):
+        """Assemble the chunks into the full plane they tile (read into memory).
+
+        Returns
+        -------
+        plane : np.ndarray, shape (sqrt(n_chunks) * H, sqrt(n_chunks) * W)
+            The chunks laid out in row-major order.
+        """
+        nside = int(round(np.sqrt(len(self.chunks))))
+        if nside**2 != len(self.chunks):
+            raise ValueError("{} chunks do not tile a square plane".format(len(self.chunks)))
+        return np.block([self.chunks[i*nside:(i+1)*nside] for i in range(nside)])
+
+    def __repr__(self):
+        return "ChunkedField('{}', shape={}, dtype={})".format(self.directory, self.shape, self.dtype)
+
+
+class PkpZeta2D:
+    r"""The aligned z/zng chunk sets of one realization.
+
+    Attributes
+    ----------
+    run : str
+        Name of the realization, e.g. 'ching6_statex424_chunk16'.
+    z : ChunkedField
+        Gaussian \zeta chunks, from '<root>/z_<run>'.
+    zng : ChunkedField
+        Non-Gaussian \zeta chunks, from '<root>/zng_<run>'.
+    shape : tuple of int
+        (n_chunks, H, W) shape shared by both sets.
+
+    Methods
+    -------
+    __getitem__(key)
+        Index both sets at once, returning (z, zng).
+    __iter__()
+        Iterate over aligned (z, zng) chunk pairs.
+    runs(root=DATA_DIR)
+        List the realizations available under root.
+    """
+    def __init__(self, run='ching6_statex424_chunk16', root=DATA_DIR):
+        root = Path(root)
+        self.run = run
+        self.z = ChunkedField(root / ('z_' + run))
+        self.zng = ChunkedField(root / ('zng_' + run))
+        if self.z.shape != self.zng.shape:
+            raise ValueError("z and zng chunks of {} do not match: {} vs {}".format(run, self.z.shape, self.zng.shape))
+        self.shape = self.z.shape
+
+    def __len__(self):
+        return len(self.z)
+
+    def __iter__(self):
+        return zip(self.z, self.zng)
+
+    def __getitem__(self, key):
+        return self.z[key], self.zng[key]
+
+    @staticmethod
+    def runs(root=DATA_DIR):
+        """List the realizations (with both a z_ and a zng_ directory) available under root."""
+        root = Path(root)
+        return sorted(d.name[2:] for d in root.glob('z_*')
+                      if d.is_dir() and (root / ('zng_' + d.name[2:])).is_dir())
+
+    def __repr__(self):
+        return "PkpZeta2D('{}', shape={}, dtype={})".format(self.run, self.shape, self.z.dtype)
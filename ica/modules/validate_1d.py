@@ -23,6 +23,18 @@ biweight_midcorrelation(x, y)
     Calculate the biweight midcorrelation between the source field and the estimated field.
 rescale_extracted_field(true_field, extracted_field)
     Rescale the extracted field to match the true field.
+calculate_all_metrics_batch(true_fields, extracted_fields, norm=True, relative=True)
+    Calculate the scalar metrics of calculate_all_metrics for a whole ensemble of field pairs at once.
+calculate_residuals_batch(x, y, norm=True, relative=True)
+    Scalar residuals of calculate_residuals along the last axis.
+calculate_residuals_ica_batch(x, y, norm=True, relative=True)
+    Scalar residuals of calculate_residuals_ica along the last axis.
+calculate_pearson_coefficient_batch(x, y)
+    Pearson correlation coefficients along the last axis.
+biweight_midcorrelation_batch(x, y)
+    Biweight midcorrelations along the last axis.
+rescale_extracted_fields(true_fields, extracted_fields)
+    Rescale each extracted field to match the standard deviation of its true field.
 
 See Also
 --------
@@ -571,6 +583,9 @@ def biweight_midcorrelation(x, y):
 
     Notes
     -----
+        The medians and median absolute deviations (MADs) are found with np.partition in O(N),
+        see biweight_midcorrelation_batch.
+
         Keep in mind that this method assumes that your data is reasonably well-behaved (i.e., the majority of the data points are not outliers), as extreme cases with a large number of outliers can still affect the biweight midcorrelation. If you think your data might have a high percentage of outliers or other peculiarities, consider exploring other robust correlation methods as well.
     """
     if x is None or y is None:
@@ -578,43 +593,9 @@ def biweight_midcorrelation(x, y):
     if len(x) == 0 or len(y) == 0:
         raise ValueError("Invalid input field(s): Field must have a nonzero size/length.")
     
-    # Normalize y by mean-subtraction and std-division and rescale by x's std
-    y = rescale_extracted_field(x, y)
-    
-    # Calculate the medians of the input arrays
-    # These are used as central values to compute the biweight midvariances
-    median_x = np.median(x)
-    median_y = np.median(y)
-
-    # Calculate the scaling factors for each input array (x and y)
-    # The scaling factor is based on the median absolute deviation (MAD)
-    # The MAD is multiplied by 9 to obtain a more robust estimate of the spread
-    scaling_factor_x = 9 * np.median(np.abs(x - median_x))
-    scaling_factor_y = 9 * np.median(np.abs(y - median_y))
-
-    # Compute the u values for each input array
-    # u is the scaled distance of each data point from the median
-    u_x = (x - median_x) / scaling_factor_x
-    u_y = (y - median_y) / scaling_factor_y
-
-    # Calculate the biweight midcorrelation
-    # We only consider data points with |u| < 1 to reduce the impact of outliers
-    mask = (np.abs(u_x) < 1) & (np.abs(u_y) < 1)
-    
-    # Calculate the numerator of the biweight midcorrelation formula
-    # This is the sum of the product of the differences between each data point and the median
-    # The product is weighted by (1 - u^2)^2 for both x and y to down-weight the contribution of outliers
-    numerator = np.sum((x[mask] - median_x) * (y[mask] - median_y) * (1 - u_x[mask]**2)**2 * (1 - u_y[mask]**2)**2)
-    
-    # Calculate the denominator of the biweight midcorrelation formula
-    # The denominator is the product of the sum of squared differences between each data point and the median
-    # The sum is weighted by (1 - u^2)^2 for both x and y to down-weight the contribution of outliers
-    denominator_x = np.sum((x[mask] - median_x)**2 * (1 - u_x[mask]**2)**2)
-    denominator_y = np.sum((y[mask] - median_y)**2 * (1 - u_y[mask]**2)**2)
-
-    # Calculate the biweight midcorrelation by dividing the numerator by the square root of the product of the denominators
-    correlation = numerator / np.sqrt(denominator_x * denominator_y)
-    return correlation
+    # Rescaling y (as in the other metrics) does not change u or the correlation, so it is skipped;
+    # medians and MADs are found by selection (np.partition) instead of sorting
+    return biweight_midcorrelation_batch(x, y)[0]
 
 
 
@@ -669,6 +650,240 @@ def rescale_extracted_field(true_field, extracted_field):
     return extracted_field
 
 
+
+
+
+
+############################################################
+#
+# BATCHED (ENSEMBLE) METRICS
+#
+############################################################
+METRICS_DTYPE = np.dtype([
+    ("residual_scalar", np.float64),
+    ("projection_residual", np.float64),
+    ("pearson", np.float64),
+    ("biweight_midcorrelation", np.float64),
+])
+
+def _check_batch_fields(x, y):
+    """Check a pair of (B, N) field arrays and return them as float arrays of at least 2 dims."""
+    if x is None or y is None:
+        raise ValueError("Invalid input field(s): Field must be a vector/array, not None.")
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    if x.shape != y.shape:
+        raise ValueError(f"Invalid input field(s): Shapes {x.shape} and {y.shape} do not match.")
+    if x.shape[-1] == 0:
+        raise ValueError("Invalid input field(s): Field must have a nonzero size/length.")
+    return x, y
+
+def calculate_all_metrics_batch(true_fields, extracted_fields, norm=True, relative=True):
+    r"""Calculate the scalar metrics of calculate_all_metrics for a whole ensemble of field pairs at once.
+
+    Every metric is computed with reductions along the last axis, so scoring an
+    ensemble is a few vectorized passes instead of a Python loop over realizations.
+    Nothing is printed, and the vector residual is not returned.
+
+    Parameters
+    ----------
+    true_fields : np.ndarray, shape (B, N)
+        The true fields, one realization per row. A single (N,) field is treated as B=1.
+    extracted_fields : np.ndarray, shape (B, N)
+        The extracted fields. Must be same shape as true_fields.
+    norm : bool, optional
+        If True, normalize the fields before calculating the residuals. If False, do not normalize the fields.
+    relative : bool, optional
+        If True, calculate the relative residuals. If False, calculate the absolute residuals.
+
+    Returns
+    -------
+    metrics : np.ndarray, shape (B,)
+        Structured array with fields "residual_scalar", "projection_residual", "pearson"
+        and "biweight_midcorrelation" (see METRICS_DTYPE).
+    """
+    x, y = _check_batch_fields(true_fields, extracted_fields)
+    metrics = np.empty(x.shape[:-1], dtype=METRICS_DTYPE)
+    metrics["residual_scalar"] = calculate_residuals_batch(x, y, norm=norm, relative=relative)
+    metrics["projection_residual"] = calculate_residuals_ica_batch(x, y, norm=norm, relative=relative)
+    metrics["pearson"] = calculate_pearson_coefficient_batch(x, y)
+    metrics["biweight_midcorrelation"] = biweight_midcorrelation_batch(x, y)
+    return metrics
+
+def calculate_residuals_batch(x, y, norm=True, relative=True):
+    r"""Scalar residuals of calculate_residuals along the last axis.
+
+    Parameters
+    ----------
+    x : np.ndarray, shape (B, N)
+        True fields $x$. Must be same shape as $y$.
+    y : np.ndarray, shape (B, N)
+        Extracted fields $y$. Must be same shape as $x$.
+    norm : bool, optional
+        If True, rescale each $y$ to the standard deviation of its $x$ first.
+    relative : bool, optional
+        If True, measure the residuals in units of $|x|$.
+
+    Returns
+    -------
+    rs : np.ndarray, shape (B,)
+        Scalar residuals $|y - (y.x / x.x) x|$ (divided by $|x|$ if relative).
+    """
+    x, y = _check_batch_fields(x, y)
+    if norm:
+        y = rescale_extracted_fields(x, y)
+
+    ydotx = np.einsum("...i,...i->...", y, x)
+    xdotx = np.einsum("...i,...i->...", x, x)
+    rv = y - (ydotx / xdotx)[..., None] * x
+    rs = np.sqrt(np.einsum("...i,...i->...", rv, rv))
+    if relative:
+        rs = rs / np.sqrt(xdotx)
+    return np.abs(rs)
+
+def calculate_residuals_ica_batch(x, y, norm=True, relative=True):
+    r"""Scalar residuals of calculate_residuals_ica along the last axis.
+
+    Parameters
+    ----------
+    x : np.ndarray, shape (B, N)
+        True fields $x$. Must be same shape as $y$.
+    y : np.ndarray, shape (B, N)
+        Extracted fields $y$. Must be same shape as $x$.
+    norm : bool, optional
+        If True, rescale each $y$ to the standard deviation of its $x$ first.
+    relative : bool, optional
+        If True, rs = 1 - |y.x| / x.x, otherwise rs = 1 - y.x / |x|.
+
+    Returns
+    -------
+    rs : np.ndarray, shape (B,)
+        Absolute values of the scalar residuals.
+    """
+    x, y = _check_batch_fields(x, y)
+    if norm:
+        y = rescale_extracted_fields(x, y)
+
+    ydotx = np.einsum("...i,...i->...", y, x)
+    mag_x = np.sqrt(np.einsum("...i,...i->...", x, x))
+    scalar_proj_xy = ydotx / mag_x
+    if not relative:
+        rs = 1 - scalar_proj_xy
+    else:
+        rs = 1 - np.abs(scalar_proj_xy) / mag_x
+    return np.abs(rs)
+
+def calculate_pearson_coefficient_batch(x, y):
+    r"""Pearson correlation coefficients along the last axis.
+
+    Rescaling $y$ by a positive factor leaves $r$ unchanged, so unlike
+    calculate_pearson_coefficient the extracted fields are not rescaled first.
+
+    Parameters
+    ----------
+    x : np.ndarray, shape (B, N)
+        The true fields.
+    y : np.ndarray, shape (B, N)
+        The extracted fields.
+
+    Returns
+    -------
+    correlation_coefficient : np.ndarray, shape (B,)
+    """
+    x, y = _check_batch_fields(x, y)
+    xm = x - x.mean(axis=-1, keepdims=True)
+    ym = y - y.mean(axis=-1, keepdims=True)
+    numerator = np.einsum("...i,...i->...", xm, ym)
+    denominator = np.sqrt(np.einsum("...i,...i->...", xm, xm) * np.einsum("...i,...i->...", ym, ym))
+    return numerator / denominator
+
+def biweight_midcorrelation_batch(x, y, chunk_size=2**16):
+    r"""Biweight midcorrelations along the last axis.
+
+    Same estimator as biweight_midcorrelation. The medians and MADs are found
+    by selection (np.partition, O(N)) in a single work buffer, and the weights
+    $(1 - u^2)^2$ are formed and reduced chunk by chunk, so apart from the work
+    buffer no full-size temporaries are allocated. The extracted fields are
+    not rescaled since $u$ and the correlation are invariant under positive
+    rescaling of $y$.
+
+    Parameters
+    ----------
+    x : np.ndarray, shape (B, N)
+        The true fields.
+    y : np.ndarray, shape (B, N)
+        The extracted fields.
+    chunk_size : int, optional
+        Number of samples per chunk in the weighted sums. The default is 2**16.
+
+    Returns
+    -------
+    correlation_coefficient : np.ndarray, shape (B,)
+    """
+    x, y = _check_batch_fields(x, y)
+
+    # medians and scaling factors (9 * MAD) of both fields, sharing one work buffer
+    work = np.empty_like(x)
+    median_x, scale_x = _median_and_scale(x, work)
+    median_y, scale_y = _median_and_scale(y, work)
+    del work
+
+    numerator = np.zeros(x.shape[:-1])
+    denominator_x = np.zeros(x.shape[:-1])
+    denominator_y = np.zeros(x.shape[:-1])
+    for start in range(0, x.shape[-1], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        dev_x = x[..., chunk] - median_x
+        dev_y = y[..., chunk] - median_y
+        w_x = _biweights(dev_x, scale_x)
+        w_y = _biweights(dev_y, scale_y)
+
+        # only points with |u| < 1 in both fields contribute, as in biweight_midcorrelation
+        numerator += np.einsum("...i,...i,...i,...i->...", dev_x, dev_y, w_x, w_y)
+        np.multiply(w_x, w_y > 0, out=w_x)
+        np.multiply(w_y, w_x > 0, out=w_y)
+        denominator_x += np.einsum("...i,...i,...i->...", dev_x, dev_x, w_x)
+        denominator_y += np.einsum("...i,...i,...i->...", dev_y, dev_y, w_y)
+
+    return numerator / np.sqrt(denominator_x * denominator_y)
+
+def _median_inplace(work):
+    """Median along the last axis by selection; partially reorders `work` in place."""
+    n = work.shape[-1]
+    k = n // 2
+    if n % 2:
+        work.partition(k, axis=-1)
+        return work[..., k:k+1].copy()
+    # for even n the lower middle element is the largest of the lower partition,
+    # which is much cheaper than partitioning on both middle indices
+    work.partition(k, axis=-1)
+    return 0.5 * (work[..., :k].max(axis=-1, keepdims=True) + work[..., k:k+1])
+
+def _median_and_scale(a, work):
+    """Median and 9 * MAD of `a` along the last axis (keepdims), using `work` as scratch space."""
+    np.copyto(work, a)
+    median = _median_inplace(work)
+    np.subtract(a, median, out=work)
+    np.abs(work, out=work)
+    return median, 9 * _median_inplace(work)
+
+def _biweights(dev, scale):
+    """Biweights (1 - u^2)^2 with u = dev / scale, zero where |u| >= 1, in a single buffer."""
+    w = np.divide(dev, scale)
+    np.multiply(w, w, out=w)
+    np.subtract(1, w, out=w)
+    np.maximum(w, 0, out=w)
+    np.multiply(w, w, out=w)
+    return w
+
+def rescale_extracted_fields(true_fields, extracted_fields):
+    """Rescale each extracted field to match the standard deviation of its true field.
+
+    Batched version of rescale_extracted_field; standard deviations are taken along the last axis.
+    """
+    return extracted_fields * (np.std(true_fields, axis=-1, keepdims=True)
+                               / np.std(extracted_fields, axis=-1, keepdims=True))
+
 # if __name__ == "__main__":
 #     # Run the test function
 #     test_calculate_residuals()
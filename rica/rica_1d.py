@@ -0,0 +1,337 @@
+#
+# Created by Jibran Haider.
+#
+"""Reconstruction ICA (RICA) on 1D zeta strips with PyTorch, on CPU.
+
+Sliding windows of the strips are taken as a strided `unfold` view that is
+never copied as a whole. Minibatches of randomly drawn windows are gathered
+from that view one at a time. A whole list of `lambdas` is trained in one
+pass by stacking one independent weight matrix per lambda along a leading
+axis.
+
+Routine Listings
+----------------
+set_num_threads(num_threads=None)
+    Set the number of CPU threads torch uses for intra-op parallelism.
+load_strips(path, standardize=True, dtype=torch.float32)
+    Load an (n_strips, n_pixels) ensemble of 1D strips into a tensor.
+strip_patches(strips, patch_size, stride=1)
+    All sliding windows of the strips, as an (n_strips, n_windows, patch_size) view.
+strip_windows(mix, patch_size)
+    Periodic windows centred on every pixel of a set of strips, channels concatenated.
+iter_minibatches(patches, batch_size, shuffle=True, generator=None)
+    Yield minibatches of patches gathered from a patch tensor or view.
+init_weights(n_lambdas, weight_size, num_filters, generator=None)
+    Random initial weights, one (weight_size, num_filters) matrix per lambda.
+rica_losses(weight, patches, lambdas)
+    RICA losses of a minibatch for a stack of weights.
+train_rica(patches, lambdas, num_filters=None, num_epochs=200, batch_size=1000,
+        optimizer='rmsprop', lr=None, momentum=0.9, num_threads=None, seed=0,
+        init_weight=None, callback=None, verbose=True)
+    Train one RICA weight matrix per lambda, all in a single pass over the data.
+
+Notes
+-----
+The RICA objective for a single lambda is
+
+    lambda * mean((W W^T x - x)^2) + mean(|W^T x|),
+
+see Le et al. (2011), "ICA with Reconstruction Cost for Efficient
+Overcomplete Feature Learning". The losses of the different lambdas are
+summed before the backward pass; since every weight slice only enters its
+own term and RMSprop/Adam act elementwise, the slices are trained exactly
+as if they were trained one after another. L-BFGS couples them through its
+line search, so use it with a single lambda.
+"""
+
+import math
+
+import numpy as np
+import torch
+from torch.nn import Parameter
+
+
+def set_num_threads(num_threads=None):
+    """Set the number of CPU threads torch uses for intra-op parallelism.
+
+    Parameters
+    ----------
+    num_threads : int, optional
+        Number of threads. If None, torch's default is kept.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(int(num_threads))
+
+
+def load_strips(path, standardize=True, dtype=torch.float32):
+    """Load an (n_strips, n_pixels) ensemble of 1D strips into a tensor.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to a .npy file holding the strips, or a single 1D strip.
+    standardize : bool, optional
+        If True, shift and scale the ensemble to zero mean and unit variance.
+        The default is True.
+    dtype : torch.dtype, optional
+        Floating point type of the returned tensor. The default is torch.float32.
+
+    Returns
+    -------
+    strips : torch.Tensor, shape (n_strips, n_pixels)
+        Contiguous tensor of strips.
+    """
+    strips = np.atleast_2d(np.load(path))
+    if standardize:
+        strips = (strips - strips.mean()) / strips.std()
+    return torch.as_tensor(strips, dtype=dtype).contiguous()
+
+
+def strip_patches(strips, patch_size, stride=1):
+    """All sliding windows of the strips, as an (n_strips, n_windows, patch_size) view.
+
+    The windows are taken with `Tensor.unfold`, which is a strided view of
+    `strips`; flattening it to (n_patches, patch_size) would copy every
+    pixel patch_size/stride times, so it is returned as is and
+    `iter_minibatches` gathers each batch from it.
+
+    Parameters
+    ----------
+    strips : torch.Tensor, shape (n_strips, n_pixels)
+        Tensor of 1D strips.
+    patch_size : int
+        Length of each window (the RICA weight size).
+    stride : int, optional
+        Offset between the starts of consecutive windows. The default is 1.
+
+    Returns
+    -------
+    patches : torch.Tensor, shape (n_strips, n_windows, patch_size)
+        View of the windows of every strip.
+    """
+    if strips.size(-1) < patch_size:
+        raise ValueError("patch_size {} is larger than the strip length {}"
+                         .format(patch_size, strips.size(-1)))
+    return strips.unfold(-1, patch_size, stride)
+
+
+def strip_windows(mix, patch_size):
+    """Periodic windows centred on every pixel of a set of strips, channels concatenated.
+
+    Unlike `strip_patches`, which treats every strip as an independent
+    sample, this keeps the strips aligned as channels of a single field:
+    row t holds the windows of all channels around pixel t, so a filter
+    applied to the rows yields one value per pixel.
+
+    Parameters
+    ----------
+    mix : torch.Tensor, shape (n_channels, n_pixels)
+        Aligned strips, e.g. the observed mixtures of a field.
+    patch_size : int
+        Length of each window. With patch_size=1 the rows are just the
+        channel values at each pixel.
+
+    Returns
+    -------
+    windows : torch.Tensor, shape (n_pixels, n_channels * patch_size)
+        Windows of all channels, channel by channel.
+    """
+    n_channels, n_pixels = mix.shape
+    left = (patch_size - 1) // 2
+    # the fields are periodic, so wrap the strips instead of zero padding
+    padded = torch.cat([mix[:, n_pixels-left:], mix, mix[:, :patch_size-1-left]], dim=-1)
+    # (n_channels, n_pixels, patch_size) view
+    windows = padded.unfold(-1, patch_size, 1)
+    return windows.transpose(0, 1).reshape(n_pixels, n_channels * patch_size)
+
+
+def iter_minibatches(patches, batch_size, shuffle=True, generator=None):
+    """Yield minibatches of patches gathered from a patch tensor or view.
+
+    Shuffling draws a random permutation of all patches, so every epoch
+    sees different batches; each batch is gathered from `patches` on its
+    own, so only batch_size patches are ever copied at a time. A trailing
+    partial batch is dropped.
+
+    Parameters
+    ----------
+    patches : torch.Tensor
+        Patches of shape (n_patches, patch_size) or (n_strips, n_windows, patch_size),
+        e.g. the view from `strip_patches` or the rows from `strip_windows`.
+    batch_size : int
+        Number of patches per minibatch. Capped at the number of patches.
+    shuffle : bool, optional
+        If True, draw the patches in random order. The default is True.
+    generator : torch.Generator, optional
+        Random number generator for the shuffling.
+
+    Yields
+    ------
+    batch : torch.Tensor, shape (batch_size, patch_size)
+        Patches of the minibatch.
+    """
+    n_patches = patches[..., 0].numel()
+    batch_size = min(int(batch_size), n_patches)
+    num_batches = n_patches // batch_size
+    if shuffle:
+        order = torch.randperm(n_patches, generator=generator)
+    else:
+        order = torch.arange(n_patches)
+    for batch in order[:num_batches * batch_size].split(batch_size):
+        if patches.dim() == 2:
+            yield patches.index_select(0, batch)
+        else:
+            # the unfold view can't be flattened without a copy, index strip and window
+            n_windows = patches.size(1)
+            yield patches[batch // n_windows, batch % n_windows]
+
+
+def init_weights(n_lambdas, weight_size, num_filters, generator=None):
+    """Random initial weights, one (weight_size, num_filters) matrix per lambda.
+
+    Parameters
+    ----------
+    n_lambdas : int
+        Number of independent weight matrices.
+    weight_size : int
+        Number of pixels in a patch.
+    num_filters : int
+        Number of filters; num_filters > weight_size is overcomplete.
+    generator : torch.Generator, optional
+        Random number generator.
+
+    Returns
+    -------
+    weight : torch.Tensor, shape (n_lambdas, weight_size, num_filters)
+        Gaussian weights with standard deviation 1/sqrt(weight_size).
+    """
+    weight = torch.randn(n_lambdas, weight_size, num_filters, generator=generator)
+    return weight / math.sqrt(weight_size)
+
+
+def rica_losses(weight, patches, lambdas):
+    """RICA losses of a minibatch for a stack of weights.
+
+    Parameters
+    ----------
+    weight : torch.Tensor, shape (n_lambdas, weight_size, num_filters)
+        Stacked weights.
+    patches : torch.Tensor, shape (batch_size, weight_size)
+        Minibatch of patches, shared by all weights.
+    lambdas : torch.Tensor, shape (n_lambdas,)
+        Reconstruction weight of each weight matrix.
+
+    Returns
+    -------
+    loss : torch.Tensor, shape (n_lambdas,)
+        Total loss, lambda * loss_recon + loss_latent.
+    loss_recon : torch.Tensor, shape (n_lambdas,)
+        Mean squared reconstruction error.
+    loss_latent : torch.Tensor, shape (n_lambdas,)
+        Mean absolute latent activation (sparsity penalty).
+    """
+    # (n_lambdas, batch_size, num_filters)
+    latents = torch.matmul(patches, weight)
+    # (n_lambdas, batch_size, weight_size)
+    output = torch.matmul(latents, weight.transpose(-2, -1))
+    diff = output - patches
+    loss_recon = (diff * diff).mean(dim=(-2, -1))
+    loss_latent = latents.abs().mean(dim=(-2, -1))
+    loss = lambdas * loss_recon + loss_latent
+    return loss, loss_recon, loss_latent
+
+
+def train_rica(patches, lambdas, num_filters=None, num_epochs=200, batch_size=1000,
+        optimizer='rmsprop', lr=None, momentum=0.9, num_threads=None, seed=0,
+        init_weight=None, callback=None, verbose=True):
+    """Train one RICA weight matrix per lambda, all in a single pass over the data.
+
+    Parameters
+    ----------
+    patches : torch.Tensor
+        Patches of shape (n_patches, weight_size) or (n_strips, n_windows, weight_size),
+        see `iter_minibatches`.
+    lambdas : sequence of float
+        Reconstruction weights to sweep.
+    num_filters : int, optional
+        Number of filters. The default is weight_size (complete ICA).
+    num_epochs : int, optional
+        Number of passes over the patches. The default is 200.
+    batch_size : int, optional
+        Number of patches per minibatch. The default is 1000.
+    optimizer : str, optional
+        One of 'rmsprop', 'adam' or 'lbfgs'. L-BFGS takes a few iterations
+        with a strong Wolfe line search on each minibatch. The default is 'rmsprop'.
+    lr : float, optional
+        Learning rate. The default is 1e-3 for 'rmsprop' and 'adam' and 1 for 'lbfgs'.
+    momentum : float, optional
+        RMSprop momentum, unused by the other optimizers. The default is 0.9.
+    num_threads : int, optional
+        Number of CPU threads for torch. If None, torch's default is kept.
+    seed : int, optional
+        Seed for the weight initialization and minibatch order. The default is 0.
+    init_weight : torch.Tensor, optional
+        Initial (n_lambdas, weight_size, num_filters) weights. If None, they
+        are drawn with `init_weights`.
+    callback : callable, optional
+        Called as callback(epoch, weight, losses) after every epoch, with the
+        detached weights and the (3, n_lambdas) epoch-mean losses.
+    verbose : bool, optional
+        If True, print the mean losses after every epoch. The default is True.
+
+    Returns
+    -------
+    weight : torch.Tensor, shape (n_lambdas, weight_size, num_filters)
+        Trained weights, in the order of `lambdas`.
+    history : np.ndarray, shape (num_epochs, 3, n_lambdas)
+        Epoch-mean total, reconstruction and latent losses.
+    """
+    set_num_threads(num_threads)
+    generator = torch.Generator().manual_seed(seed)
+
+    weight_size = patches.size(-1)
+    if num_filters is None:
+        num_filters = weight_size
+    lambdas = torch.as_tensor(lambdas, dtype=patches.dtype)
+    n_lambdas = lambdas.numel()
+
+    if init_weight is None:
+        init_weight = init_weights(n_lambdas, weight_size, num_filters, generator)
+    weight = Parameter(init_weight.to(patches.dtype).clone())
+    if optimizer == 'rmsprop':
+        optimizer = torch.optim.RMSprop([weight], lr or 1e-3, momentum=momentum)
+    elif optimizer == 'adam':
+        optimizer = torch.optim.Adam([weight], lr or 1e-3)
+    elif optimizer == 'lbfgs':
+        optimizer = torch.optim.LBFGS([weight], lr or 1., max_iter=5, history_size=10,
+                                      line_search_fn='strong_wolfe')
+    else:
+        raise ValueError("Unknown optimizer '{}'".format(optimizer))
+
+    history = np.zeros((num_epochs, 3, n_lambdas))
+    for epoch in range(num_epochs):
+        epoch_losses = torch.zeros(3, n_lambdas, dtype=patches.dtype)
+        num_batches = 0
+        for batch in iter_minibatches(patches, batch_size, generator=generator):
+            batch_losses = []
+
+            def closure():
+                # the lambdas are independent, so the summed loss gives each slice its
+                # own gradient
+                optimizer.zero_grad()
+                losses = rica_losses(weight, batch, lambdas)
+                losses[0].sum().backward()
+                batch_losses.append(torch.stack(losses).detach())
+                return losses[0].sum()
+
+            optimizer.step(closure)
+            epoch_losses += batch_losses[0]
+            num_batches += 1
+        history[epoch] = (epoch_losses / num_batches).numpy()
+
+        if verbose:
+            print(epoch, *history[epoch].mean(axis=-1))
+        if callback is not None:
+            callback(epoch, weight.detach(), history[epoch])
+
+    return weight.detach(), history
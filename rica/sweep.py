@@ -0,0 +1,140 @@
+#
+# Created by Jibran Haider.
+#
+"""Regularization path sweep for 1D reconstruction ICA.
+
+All lambdas are trained together by `rica_1d.train_rica` as one stacked
+weight tensor, so the whole sweep takes about as long as a single run.
+This module adds the bookkeeping around it: every lambda gets its own
+directory holding its checkpoint and loss curve.
+
+Routine Listings
+----------------
+lambda_dir(out_dir, lambd)
+    Output directory of a single lambda.
+save_lambda_ckpt(path, epoch, lambd, weight)
+    Atomically save the checkpoint of a single lambda.
+load_lambda_ckpt(path)
+    Load the checkpoint of a single lambda.
+run_sweep(patches, lambdas, out_dir, ckpt_freq=10, **train_kwargs)
+    Train all lambdas in one pass, writing per-lambda checkpoints and loss curves.
+
+Notes
+-----
+Layout of `out_dir`:
+
+    lambda_<lambd>/ckpt.npz         latest weights ("epoch", "lambd", "weight")
+    lambda_<lambd>/loss_curve.txt   epoch-mean total, reconstruction and latent losses
+    lambda_<lambd>/filters.npy      final filters, shape (num_filters, weight_size)
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+from rica_1d import train_rica
+
+
+def lambda_dir(out_dir, lambd):
+    """Output directory of a single lambda."""
+    return os.path.join(out_dir, "lambda_{:.2f}".format(lambd))
+
+
+def save_lambda_ckpt(path, epoch, lambd, weight):
+    """Atomically save the checkpoint of a single lambda.
+
+    Parameters
+    ----------
+    path : str
+        Destination .npz file.
+    epoch : int
+        Last completed epoch.
+    lambd : float
+        Reconstruction weight.
+    weight : np.ndarray, shape (weight_size, num_filters)
+        RICA weight matrix.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, epoch=epoch, lambd=lambd, weight=weight)
+        os.replace(tmp, path)
+    except BaseException:
+        # don't leave a partial file behind in the checkpoint directory
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def load_lambda_ckpt(path):
+    """Load the checkpoint of a single lambda.
+
+    Returns
+    -------
+    epoch : int
+        Last completed epoch.
+    lambd : float
+        Reconstruction weight.
+    weight : np.ndarray, shape (weight_size, num_filters)
+        RICA weight matrix.
+    """
+    with np.load(path) as ckpt:
+        return int(ckpt["epoch"]), float(ckpt["lambd"]), ckpt["weight"]
+
+
+def run_sweep(patches, lambdas, out_dir, ckpt_freq=10, **train_kwargs):
+    """Train all lambdas in one pass, writing per-lambda checkpoints and loss curves.
+
+    Parameters
+    ----------
+    patches : torch.Tensor, shape (n_strips, n_windows, weight_size)
+        Patch view from `rica_1d.strip_patches`.
+    lambdas : sequence of float
+        Reconstruction weights to sweep.
+    out_dir : str
+        Root output directory; see the module notes for its layout.
+    ckpt_freq : int, optional
+        Checkpoint every `ckpt_freq` epochs (and after the last one). The default is 10.
+    **train_kwargs
+        Passed on to `rica_1d.train_rica` (num_filters, num_epochs, batch_size, ...).
+
+    Returns
+    -------
+    weight : torch.Tensor, shape (n_lambdas, weight_size, num_filters)
+        Trained weights, in the order of `lambdas`.
+    history : np.ndarray, shape (num_epochs, 3, n_lambdas)
+        Epoch-mean total, reconstruction and latent losses.
+    """
+    lambdas = [float(l) for l in lambdas]
+    dirs = [lambda_dir(out_dir, l) for l in lambdas]
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+
+    # loss curves are appended line by line so they can be followed during training
+    curves = [open(os.path.join(d, "loss_curve.txt"), "w") for d in dirs]
+    for f in curves:
+        f.write("# epoch loss loss_recon loss_latent\n")
+
+    def log_and_ckpt(epoch, weight, losses):
+        for i, f in enumerate(curves):
+            f.write("{} {:.8e} {:.8e} {:.8e}\n".format(epoch, *losses[:, i]))
+            f.flush()
+        if (epoch + 1) % ckpt_freq == 0:
+            weight = weight.numpy()
+            for i, (l, d) in enumerate(zip(lambdas, dirs)):
+                save_lambda_ckpt(os.path.join(d, "ckpt.npz"), epoch, l, weight[i])
+
+    try:
+        weight, history = train_rica(patches, lambdas, callback=log_and_ckpt, **train_kwargs)
+    finally:
+        for f in curves:
+            f.close()
+
+    last_epoch = len(history) - 1
+    for i, (l, d) in enumerate(zip(lambdas, dirs)):
+        w = weight[i].numpy()
+        save_lambda_ckpt(os.path.join(d, "ckpt.npz"), last_epoch, l, w)
+        np.save(os.path.join(d, "filters.npy"), w.T)
+        print('Finished lambda={:.2f}'.format(l))
+    return weight, history
@@ -1,19 +1,26 @@
+import os
 import pdb
 
 from jax.config import config
 config.update("jax_enable_x64", True)
 
+from functools import partial
 
+import numpy as np
+import jax
 from jax import jit, vmap
 from jax.lax import scan
 import jax.numpy as jnp
 from jax.numpy.linalg import inv
+from jax.scipy.linalg import solve_triangular
 import jax.random as jrandom
 import matplotlib.pyplot as plt
 
 from func_estimators import init_nica_params, nica_mlp
-from utils import gaussian_sample_from_mu_prec, invmp, tree_prepend
-from utils import multi_tree_stack
+from utils import invmp, multi_tree_stack, atomic_savez
+
+# bump when the sampler changes so that cached datasets are regenerated
+DATA_VERSION = 1
 
 def ar2_lds(alpha, beta, mu, vz, vz0, vx):
     B = jnp.array([[1 + alpha - beta, -alpha], [1.0, .0]])
@@ -60,31 +67,20 @@ def generate_slds(K, key):
 
 
 def gen_markov_chain(pi, A, num_steps, samplekey):
-    def make_mc_step(A, num_states):
-        @jit
-        def sample_mc_step(cur_state, key):
-            p = A[cur_state]
-            new_state = jrandom.choice(key, jnp.arange(num_states), p=p)
-            return new_state, new_state
-        return sample_mc_step
-
+    # inverse cdf sampling with all uniforms drawn in one call, the scan
+    # only looks up the transition cdf of the current state
     K = pi.shape[0]
-    keys = jrandom.split(samplekey, num_steps)
-    start_state = jrandom.choice(keys[0], jnp.arange(K), p=pi)
-    mc_step = make_mc_step(A, K)
-    _, states = scan(mc_step, start_state, keys[1:])
-    states = jnp.concatenate([start_state.reshape((1,)), states])
-    return states
+    u = jrandom.uniform(samplekey, (num_steps,))
+    A_cdf = jnp.cumsum(A, -1)
 
+    def mc_step(cur_state, u_t):
+        new_state = jnp.minimum(jnp.sum(u_t >= A_cdf[cur_state]), K-1)
+        return new_state, new_state
 
-def make_slds_sampler(B, b, Q):
-    @jit
-    def sample_slds(z_prev, state_with_key):
-        state, key = state_with_key
-        z_mu = B[state]@z_prev + b[state]
-        z = gaussian_sample_from_mu_prec(z_mu, Q[state], key)
-        return z, (z, z_mu)
-    return sample_slds
+    start_state = jnp.minimum(jnp.sum(u[0] >= jnp.cumsum(pi)), K-1)
+    _, states = scan(mc_step, start_state, u[1:])
+    states = jnp.concatenate([start_state.reshape((1,)), states])
+    return states
 
 
 def gen_slds(T, K, d, paramkey, samplekey):
@@ -97,20 +93,31 @@ def gen_slds(T, K, d, paramkey, samplekey):
     # generate hidden markov chain
     states = gen_markov_chain(pi, A, T, s_hmmkey)
 
-    # sample slds
-    s_ldskeys = jrandom.split(s_ldskey, T)
-    z_init = gaussian_sample_from_mu_prec(b_init[states[0]],
-                                          Q_init[states[0]], s_ldskeys[0])
-    sample_func = make_slds_sampler(B, b, Q)
-    z, z_mu = tree_prepend((z_init, b_init[states[0]]),
-                           scan(sample_func, z_init,
-                                (states[1:], s_ldskeys[1:]))[1])
+    # draw all driving noise at once, scaled by the state's cholesky factor
+    eps = jrandom.normal(s_ldskey, (T, d))
+    L_init = jnp.linalg.cholesky(Q_init[states[0]])
+    z_init = b_init[states[0]]+solve_triangular(L_init.T, eps[0], lower=False)
+    L_Q = jnp.linalg.cholesky(Q)[states[1:]]
+    noise = vmap(lambda L, e: solve_triangular(L.T, e, lower=False))(
+        L_Q, eps[1:])
+
+    # only the linear recursion z_t = B_t z_{t-1} + b_t + noise_t is serial
+    def slds_step(z_prev, B_c):
+        B_t, c_t = B_c
+        z = B_t@z_prev + c_t
+        return z, z
+    B_t = B[states[1:]]
+    _, z = scan(slds_step, z_init, (B_t, b[states[1:]]+noise))
+    z = jnp.concatenate([z_init[None], z])
+    z_mu = jnp.concatenate([b_init[states[0]][None],
+                            (B_t@z[:-1, :, None])[..., 0]+b[states[1:]]])
     hmm_params = (pi, A)
     lds_params = (b_init, Q_init, B, b, Q)
     return z, z_mu, states, lds_params, hmm_params
 
 
-def gen_slds_nica(N, M, T, K, d, L, paramkey, samplekey, repeat_layers=False):
+@partial(jit, static_argnums=(0, 1, 2, 3, 4, 5, 8))
+def _gen_slds_nica(N, M, T, K, d, L, paramkey, samplekey, repeat_layers):
     # generate several slds
     paramkeys = jrandom.split(paramkey, N+1)
     samplekeys = jrandom.split(samplekey, N+1)
@@ -125,13 +132,85 @@ def gen_slds_nica(N, M, T, K, d, L, paramkey, samplekey, repeat_layers=False):
     # add appropriately scaled output noise (R is precision!)
     R = inv(jnp.eye(M)*jnp.diag(jnp.cov(f))*0.15)
     likelihood_params = (nica_params, R)
-    x_keys = jrandom.split(samplekeys[0], T)
-    x = vmap(gaussian_sample_from_mu_prec, (1, None, 0), 1)(f, R, x_keys)
+    x_noise = jrandom.normal(samplekeys[0], (M, T))
+    x = f+solve_triangular(jnp.linalg.cholesky(R).T, x_noise, lower=False)
     # double-check variance levels on output noise
     Rxvar_ratio = jnp.mean(jnp.diag(invmp(R, jnp.eye(R.shape[0]))
                                     / jnp.cov(x)))
+    return (x, f, z, z_mu, states, likelihood_params, lds_params,
+            hmm_params), Rxvar_ratio
+
+
+def gen_slds_nica(N, M, T, K, d, L, paramkey, samplekey, repeat_layers=False):
+    data, Rxvar_ratio = _gen_slds_nica(N, M, T, K, d, L, paramkey, samplekey,
+                                       repeat_layers)
     print(' *inv(R)/xvar: ', Rxvar_ratio)
-    return x, f, z, z_mu, states, likelihood_params, lds_params, hmm_params
+    return data
+
+
+def gen_slds_nica_rejection(N, M, T, K, d, L, paramkey, samplekey,
+                            repeat_layers=False, var_ratio_range=(0.08, 0.15),
+                            num_candidates=4):
+    """Redraws parameters and data until the observation noise to data
+        variance ratio is in var_ratio_range. Candidates follow the same
+        key sequence as the sequential loop but are generated in batches
+        of num_candidates and the first accepted one is returned.
+    """
+    gen_batch = vmap(partial(_gen_slds_nica, N, M, T, K, d, L,
+                             repeat_layers=repeat_layers))
+    while True:
+        paramkeys, samplekeys = [], []
+        for i in range(num_candidates):
+            paramkeys.append(paramkey)
+            samplekeys.append(samplekey)
+            paramkey, _ = jrandom.split(paramkey)
+            samplekey, _ = jrandom.split(samplekey)
+        data, Rxvar_ratios = gen_batch(jnp.stack(paramkeys),
+                                       jnp.stack(samplekeys))
+        print(' *inv(R)/xvar: ', Rxvar_ratios)
+        accepted = ((Rxvar_ratios >= var_ratio_range[0])
+                    & (Rxvar_ratios <= var_ratio_range[1]))
+        if accepted.any():
+            idx = int(jnp.argmax(accepted))
+            return jax.tree_map(lambda a: a[idx], data)
+
+
+def load_or_gen_slds_nica(N, M, T, K, d, L, param_seed, data_seed,
+                          repeat_layers=False, cache_dir=None,
+                          var_ratio_range=None):
+    """gen_slds_nica (or gen_slds_nica_rejection if var_ratio_range is
+        given) for integer seeds, cached as .npz in cache_dir.
+    """
+    paramkey = jrandom.PRNGKey(param_seed)
+    samplekey = jrandom.PRNGKey(data_seed)
+    if var_ratio_range is None:
+        gen = partial(gen_slds_nica, repeat_layers=repeat_layers)
+    else:
+        gen = partial(gen_slds_nica_rejection, repeat_layers=repeat_layers,
+                      var_ratio_range=var_ratio_range)
+    if cache_dir is None:
+        return gen(N, M, T, K, d, L, paramkey, samplekey)
+
+    file_id = "slds_nica_n{}_m{}_t{}_k{}_d{}_l{}_ps{}_ds{}_rep{}".format(
+        N, M, T, K, d, L, param_seed, data_seed, int(repeat_layers))
+    if var_ratio_range is not None:
+        file_id += "_vr{}-{}".format(*var_ratio_range)
+    path = os.path.join(cache_dir, file_id+"_v{}.npz".format(DATA_VERSION))
+    treedef = jax.tree_structure(jax.eval_shape(
+        lambda pk, sk: _gen_slds_nica(N, M, T, K, d, L, pk, sk,
+                                      repeat_layers)[0],
+        paramkey, samplekey))
+    if os.path.exists(path):
+        with np.load(path, allow_pickle=False) as cached:
+            leaves = [jnp.asarray(cached["leaf_%05d" % i])
+                      for i in range(treedef.num_leaves)]
+        return jax.tree_unflatten(treedef, leaves)
+
+    data = gen(N, M, T, K, d, L, paramkey, samplekey)
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_savez(path, **{"leaf_%05d" % i: np.asarray(l)
+                          for i, l in enumerate(jax.tree_leaves(data))})
+    return data
 
 
 if __name__ == "__main__":
@@ -21,7 +21,7 @@ from jax.experimental import optimizers, host_callback
 from jax.config import config
 config.update("jax_enable_x64", True)
 
-from data_generation import gen_slds_linear_ica, gen_slds_nica
+from data_generation import gen_slds_linear_ica, load_or_gen_slds_nica
 from func_estimators import nica_mlp
 # from train_artificial import train
 # from full_train_artificial import full_train
@@ -112,6 +112,9 @@ def parse():
                         help="save checkpoint every _ epoch")
     parser.add_argument('--out-dir', type=str, default="output/",
                         help="location where data is saved")
+    parser.add_argument('--data-cache-dir', type=str,
+                        default="output/data_cache/",
+                        help="location of cached simulated data")
     args = parser.parse_args()
     return args
 
@@ -133,15 +136,14 @@ def main():
             param_key, _ = jrandom.split(param_key)
             data_key, _ = jrandom.split(data_key)
     elif args.l > 0:
-        # generate nonlinear ICA data
+        # generate nonlinear ICA data (batched rejection on the obs noise
+        # ratio, cached on disk so that it matches the training run)
         # !BEWARE d=2 fixed in datageneration
-        var_ratio = 0.
-        while not (0.08 <= var_ratio <= 0.15):
-            print("Generating data with good obs noise ratio...")
-            x, z, z_mu, states, *params, var_ratio = gen_slds_nica(
-                args.n, args.m, args.t, args.k, args.d, args.l, param_key, data_key)
-            param_key, _ = jrandom.split(param_key)
-            data_key, _ = jrandom.split(data_key)
+        print("Generating data with good obs noise ratio...")
+        x, f, z, z_mu, states, *params = load_or_gen_slds_nica(
+            args.n, args.m, args.t, args.k, args.d, args.l, args.param_seed,
+            args.data_seed, cache_dir=args.data_cache_dir,
+            var_ratio_range=(0.08, 0.15))
 
     # GT decoders
     if args.l == 0:
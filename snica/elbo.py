@@ -8,20 +8,22 @@ from jax.experimental import host_callback
 from jax.lax import scan
 import jax.numpy as jnp
 import jax.random as jrandom
-from jax.scipy.stats import multivariate_normal as gaussian
 import matplotlib.pyplot as plt
 from numpy import newaxis
 
 from func_estimators import decoder_mlp, encoder_mlp
-from inference import make_inference
+from inference import make_inference_runner
 from utils import (
+    gaussian_entropy_from_chol,
+    gaussian_logpdf_from_chol,
+    gaussian_sample_from_chol,
     gaussian_sample_from_mu_prec,
     get_hmm_natparams,
     get_prec_mat,
     get_prior_natparams,
     get_rhos,
     get_transition_natparams,
-    invmp,
+    invcholp,
 )
 
 config.update("jax_enable_x64", True)
@@ -32,10 +34,11 @@ def sample_fwd_step(z_prev, pw_posterior_with_key):
     qzlag_z, key = pw_posterior_with_key
     mu_pw, prec_pw = qzlag_z
     d = z_prev.shape[0]
-    mu_cond = mu_pw[d:]-invmp(prec_pw[d:, d:],
-                              prec_pw[d:, :d]@(z_prev-mu_pw[:d]))
-    prec_cond = prec_pw[d:, d:]
-    z_new = gaussian_sample_from_mu_prec(mu_cond, prec_cond, key)
+    # factor conditional precision once for both the mean and the sample
+    L_cond = jnp.linalg.cholesky(prec_pw[d:, d:])
+    mu_cond = mu_pw[d:]-invcholp(L_cond,
+                                 prec_pw[d:, :d]@(z_prev-mu_pw[:d]))
+    z_new = gaussian_sample_from_chol(mu_cond, L_cond, key)
     return z_new, z_new
 
 
@@ -51,9 +54,7 @@ def sample_forward(lds_posteriors, key):
 
 #@jit
 def gaussian_entropy(prec):
-    d = prec.shape[0]
-    V = invmp(prec, jnp.eye(prec.shape[0]))
-    return 0.5*(jnp.linalg.slogdet(V)[1]+d*jnp.log(2*jnp.pi*jnp.e))
+    return gaussian_entropy_from_chol(jnp.linalg.cholesky(prec))
 
 
 #@jit
@@ -84,15 +85,30 @@ def KL_qp_u(hmm_natparams, qu, quu):
 def E_sampling_likelihood(x, s_sample, theta, R):
     x_sample_mu = vmap(vmap(lambda a: decoder_mlp(theta, a),
                             in_axes=-1, out_axes=-1))(s_sample)
-    V = invmp(R, jnp.eye(R.shape[0]))
-    E_logp_xs = vmap(lambda a: vmap(gaussian.logpdf, in_axes=(-1, -1, None),
-                     out_axes=-1)(x, a, V))(x_sample_mu)
+    # factor output precision once instead of per-timestep covariances
+    L_R = jnp.linalg.cholesky(R)
+    E_logp_xs = vmap(lambda a: vmap(gaussian_logpdf_from_chol,
+                                    in_axes=(-1, -1, None),
+                                    out_axes=-1)(x, a, L_R))(x_sample_mu)
     return E_logp_xs.sum(1).mean()
 
 
-@partial(jit, static_argnums=(8, 9,))
 def ELBO(x, R, lds_params, log_hmm_params, phi, theta, nu, key,
-         inference_iters, num_samples):
+         inference_iters, num_samples, parallel_inference=False,
+         max_inference_iters=None):
+    # inference_iters is traced and bounded by max_inference_iters, so
+    # iteration schedules reuse one compiled executable
+    if max_inference_iters is None:
+        max_inference_iters = int(inference_iters)
+    return _ELBO(x, R, lds_params, log_hmm_params, phi, theta, nu, key,
+                 inference_iters, num_samples, parallel_inference,
+                 max_inference_iters)
+
+
+@partial(jit, static_argnums=(9, 10, 11,))
+def _ELBO(x, R, lds_params, log_hmm_params, phi, theta, nu, key,
+          inference_iters, num_samples, parallel_inference,
+          max_inference_iters):
     # transform into natural parameter form
     M, T = x.shape
     N, K = log_hmm_params[0].shape
@@ -133,11 +149,13 @@ def ELBO(x, R, lds_params, log_hmm_params, phi, theta, nu, key,
     qzlag_z = (qzlagz_mu, qzlagz_prec)
 
     # run inference
-    inference_runner = make_inference(hmm_natparams, prior_natparams,
-                                      transition_natparams,
-                                      likelihood_natparams)
-    qz, qzlag_z, qu, quu = scan(inference_runner, (qz, qzlag_z, qu, quu),
-                                jnp.arange(inference_iters))[0]
+    inference_runner = make_inference_runner(hmm_natparams, prior_natparams,
+                                             transition_natparams,
+                                             likelihood_natparams,
+                                             max_inference_iters,
+                                             parallel=parallel_inference)
+    qz, qzlag_z, qu, quu = inference_runner((qz, qzlag_z, qu, quu),
+                                            inference_iters)
 
     # sample
     key, samplekey = jrandom.split(key)
@@ -161,15 +179,18 @@ def ELBO(x, R, lds_params, log_hmm_params, phi, theta, nu, key,
 
 #@partial(jit, static_argnums=(7, 8,))
 def avg_neg_ELBO(x, mix_params, lds_params, hmm_params, phi, theta, nu,
-                 key, inference_iters, num_samples, minibatch=False):
+                 key, inference_iters, num_samples, minibatch=False,
+                 parallel_inference=False, max_inference_iters=None):
     if minibatch:
         keys = jrandom.split(key, x.shape[0])
         elbo, posteriors = vmap(
             lambda a, b: ELBO(a, mix_params, lds_params, hmm_params,
-                              phi, theta, nu, b, inference_iters, num_samples)
+                              phi, theta, nu, b, inference_iters, num_samples,
+                              parallel_inference, max_inference_iters)
         )(x, keys)
         elbo = elbo.mean()
     else:
         elbo, posteriors = ELBO(x, mix_params, lds_params, hmm_params, phi,
-                                theta, nu, key, inference_iters, num_samples)
+                                theta, nu, key, inference_iters, num_samples,
+                                parallel_inference, max_inference_iters)
     return -elbo, posteriors
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import queue
+import threading
+import multiprocessing as mp
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from jax import vmap, jit
+from scipy.optimize import linear_sum_assignment
+from func_estimators import decoder_mlp
+
+
+@jit
+def device_metrics(qz_mu, z_mu, f, theta):
+    """Source and denoising correlations computed on device.
+    Args:
+        qz_mu (array): (N, T) posterior means of the first latent dim.
+        z_mu (array): (N, T) true latent means.
+        f (array): (M, T) true noiseless observations.
+        theta (list): decoder parameters.
+    Returns:
+        corr (array): (N, N) correlations between true and estimated sources.
+        denoise_mcc (float): mean abs corr. of decoded posterior means and f.
+    """
+    N = z_mu.shape[0]
+    M = f.shape[0]
+    corr = jnp.corrcoef(z_mu, qz_mu)[:N, N:]
+    f_mu_est = vmap(decoder_mlp, in_axes=(None, -1), out_axes=-1)(theta, qz_mu)
+    denoise_mcc = jnp.abs(jnp.diag(jnp.corrcoef(f_mu_est, f)[:M, M:])).mean()
+    return corr, denoise_mcc
+
+
+@jit
+def multi_device_metrics(qz_mu, z_mu, f, theta):
+    """device_metrics mapped over the leading seed axis of qz_mu and theta,
+        z_mu and f are shared by all seeds.
+    """
+    return vmap(device_metrics, in_axes=(0, None, None, 0))(qz_mu, z_mu,
+                                                            f, theta)
+
+
+@jit
+def select_seeds(better, new, old):
+    """Takes the entries of new along the leading seed axis where better is
+        True and those of old elsewhere.
+    """
+    def select(n, o):
+        return jnp.where(better.reshape(better.shape+(1,)*(n.ndim-1)), n, o)
+    return jax.tree_map(select, new, old)
+
+
+def print_record(record):
+    line = "*Epoch: [{epoch}/{num_epochs}]\t"
+    if "num_minibs" in record:
+        line += "Minibatch: [{iter}/{num_minibs}]\t"
+    line += ("ELBO: {elbo}\t"
+             "mcc: {mcc: .2f}\t"
+             "denoise mcc: {denoise_mcc: .2f}\t"
+             "num. infernce iters: {inference_iters}\t"
+             "eseed: {est_seed}\t"
+             "pseed: {param_seed}")
+    print(line.format(**record))
+
+
+def print_seed_summary(records):
+    print("*Epoch: [{0}/{1}]\t"
+          "mean ELBO: {2}\t"
+          "mcc: {mcc: .2f} +- {mcc_sd: .2f}\t"
+          "denoise mcc: {dmcc: .2f}\t"
+          "num. infernce iters: {3}\t"
+          "seeds: {4}\t"
+          "pseed: {ps}".format(records[0]["epoch"], records[0]["num_epochs"],
+                               np.mean([r["elbo"] for r in records]),
+                               records[0]["inference_iters"], len(records),
+                               mcc=np.mean([r["mcc"] for r in records]),
+                               mcc_sd=np.std([r["mcc"] for r in records]),
+                               dmcc=np.mean([r["denoise_mcc"]
+                                             for r in records]),
+                               ps=records[0]["param_seed"]))
+
+
+class MetricsLogger:
+    """Appends one JSON record per evaluation to a .jsonl file."""
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record)+"\n")
+
+
+def _plot_worker(snapshots, plot_dir, N):
+    # runs in its own process so that rendering never blocks training
+    import matplotlib.pyplot as plt
+    from utils import plot_ic
+    plt.switch_backend("Agg")
+    fig, ax = plt.subplots(2, N, figsize=(10 * N, 6), squeeze=False,
+                           gridspec_kw={'height_ratios': [1, 2]})
+    ax2 = ax.copy()
+    for n in range(N):
+        ax2[1, n] = ax[1, n].twinx()
+    while True:
+        snap = snapshots.get()
+        if snap is None:
+            break
+        epoch, it, u, z_mu, qu, qz_mu, qz_prec = snap
+        for n in range(N):
+            plot_ic(u[n], z_mu[n], qu[n], qz_mu[n], qz_prec[n],
+                    ax[0, n], ax[1, n], ax2[1, n])
+        fig.savefig(os.path.join(plot_dir,
+                                 "epoch{:06d}_it{:06d}.png".format(epoch, it)))
+    plt.close(fig)
+
+
+class AsyncEvaluator:
+    """Evaluation hooks run off the training thread.
+
+    The training loop only dispatches steps and calls `submit` with the
+    (still being computed) outputs. A worker thread waits on them, tracks
+    the best ELBO, checkpoints every step, computes metrics on device, passes
+    the resulting record to every hook and sends plotting snapshots to a
+    separate process which writes figures to `plot_dir`.
+    """
+    def __init__(self, f, z_mu, states, ckpt, hooks=(), plot_dir=None,
+                 plot_len=500, max_pending=4, **record_fields):
+        self.f = f
+        self.z_mu = z_mu[:, :, 0]
+        self.z_mu_full = z_mu
+        self.states = states
+        self.ckpt = ckpt
+        self.hooks = list(hooks)
+        self.record_fields = record_fields
+        T = z_mu.shape[1]
+        self.plot_window = slice(int(T/2), int(T/2)+plot_len)
+
+        self.best_elbo = -jnp.inf
+        self.best_params = None
+        self.best_posters = None
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._worker = threading.Thread(target=self._eval_loop, daemon=True)
+        self._worker.start()
+
+        self._plotter = None
+        if plot_dir is not None:
+            os.makedirs(plot_dir, exist_ok=True)
+            ctx = mp.get_context("spawn")
+            self._snapshots = ctx.Queue(maxsize=max_pending)
+            self._plotter = ctx.Process(target=_plot_worker, daemon=True,
+                                        args=(self._snapshots, plot_dir,
+                                              z_mu.shape[0]))
+            self._plotter.start()
+
+    def submit(self, epoch, it, n_elbo, niters, params, opt_state,
+               posteriors, evaluate=True, plot=False):
+        """Queue a step for evaluation; blocks only if the evaluator has
+            fallen `max_pending` steps behind.
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((epoch, it, n_elbo, niters, params, opt_state,
+                         posteriors, evaluate, plot))
+
+    def close(self):
+        """Drain pending evaluations and return the best found so far."""
+        self._queue.put(None)
+        self._worker.join()
+        if self._plotter is not None:
+            if self._plotter.is_alive():
+                self._snapshots.put(None)
+                self._plotter.join()
+            # don't hang at exit on snapshots a dead plotter never read
+            self._snapshots.cancel_join_thread()
+        if self._error is not None:
+            raise self._error
+        return self.best_params, self.best_posters, self.best_elbo
+
+    def _eval_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._evaluate(*item)
+            except Exception as e:
+                self._error = e
+
+    def _evaluate(self, epoch, it, n_elbo, niters, params, opt_state,
+                  posteriors, evaluate, plot):
+        elbo = -float(n_elbo)
+        is_best = elbo > self.best_elbo
+        if is_best:
+            self.best_elbo = elbo
+            self.best_params = params
+            self.best_posters = posteriors
+        # periodic checkpoint of the current state, also between bests
+        self.ckpt.save(epoch, params, opt_state, is_best=is_best)
+
+        qz, qzlag_z, qu, quu = posteriors
+        if evaluate:
+            corr, denoise_mcc = device_metrics(qz[0][:, :, 0], self.z_mu,
+                                               self.f, params[1][1])
+            corr = np.asarray(corr)
+            ridx, cidx = linear_sum_assignment(-np.abs(corr))
+            mcc = float(np.abs(corr[ridx, cidx]).mean())
+            record = dict(self.record_fields, epoch=epoch, iter=it,
+                          elbo=elbo, mcc=mcc, denoise_mcc=float(denoise_mcc),
+                          inference_iters=int(niters), time=time.time())
+            for hook in self.hooks:
+                hook(record)
+
+        if plot and self._plotter is not None and self._plotter.is_alive():
+            if not evaluate:
+                corr, _ = device_metrics(qz[0][:, :, 0], self.z_mu,
+                                         self.f, params[1][1])
+                _, cidx = linear_sum_assignment(-np.abs(np.asarray(corr)))
+            w = self.plot_window
+            snap = (epoch, it, np.asarray(self.states[:, w]),
+                    np.asarray(self.z_mu_full[:, w]),
+                    np.exp(np.asarray(qu[cidx][:, w])),
+                    np.asarray(qz[0][cidx][:, w]),
+                    np.asarray(qz[1][cidx][:, w]))
+            self._snapshots.put(snap)
+
+
+class MultiSeedEvaluator(AsyncEvaluator):
+    """AsyncEvaluator for models trained with a leading seed axis.
+
+    The current state of all seeds is checkpointed every step, while the
+    best ELBO, epoch, params and posteriors of each seed are tracked on
+    device and the best params are written to "best_params.npz" next to
+    the checkpoints. Hooks receive one record per seed and a summary over
+    seeds is printed. `best` = (params, epoch, elbo) continues the best
+    tracking of a resumed run; the posteriors of seeds that don't improve
+    after resuming are those of the first evaluated step.
+    """
+    def __init__(self, f, z_mu, states, ckpt, est_seeds, hooks=(),
+                 best=None, max_pending=4, **record_fields):
+        super().__init__(f, z_mu, states, ckpt, hooks=hooks,
+                         max_pending=max_pending, **record_fields)
+        self.est_seeds = list(est_seeds)
+        self.best_elbo = np.full(len(self.est_seeds), -np.inf)
+        self.best_epoch = np.full(len(self.est_seeds), -1)
+        if best is not None:
+            self.best_params, best_epoch, best_elbo = best
+            self.best_epoch = np.asarray(best_epoch)
+            self.best_elbo = np.asarray(best_elbo, dtype=float)
+
+    def _evaluate(self, epoch, it, n_elbo, niters, params, opt_state,
+                  posteriors, evaluate, plot):
+        elbo = -np.asarray(n_elbo, dtype=float)
+        better = elbo > self.best_elbo
+        if self.best_params is None:
+            self.best_params = params
+        if self.best_posters is None:
+            self.best_posters = posteriors
+        if better.any():
+            self.best_elbo = np.where(better, elbo, self.best_elbo)
+            self.best_epoch = np.where(better, epoch, self.best_epoch)
+            self.best_params = select_seeds(better, params, self.best_params)
+            self.best_posters = select_seeds(better, posteriors,
+                                             self.best_posters)
+            self.ckpt.save_tree("best_params", self.best_params,
+                                epoch=self.best_epoch, elbo=self.best_elbo)
+        # the checkpoint holds the current state of all seeds so that it
+        # can be resumed from, the best params of each seed are separate
+        self.ckpt.save(epoch, params, opt_state)
+
+        if evaluate:
+            qz = posteriors[0]
+            corr, denoise_mcc = multi_device_metrics(
+                qz[0][:, :, :, 0], self.z_mu, self.f, params[1][1])
+            corr = np.asarray(corr)
+            denoise_mcc = np.asarray(denoise_mcc)
+            records = []
+            for i, s in enumerate(self.est_seeds):
+                ridx, cidx = linear_sum_assignment(-np.abs(corr[i]))
+                mcc = float(np.abs(corr[i][ridx, cidx]).mean())
+                record = dict(self.record_fields, epoch=epoch, iter=it,
+                              est_seed=int(s), elbo=float(elbo[i]), mcc=mcc,
+                              denoise_mcc=float(denoise_mcc[i]),
+                              inference_iters=int(niters), time=time.time())
+                for hook in self.hooks:
+                    hook(record)
+                records.append(record)
+            print_seed_summary(records)
@@ -7,7 +7,7 @@ import jax
 import jax.numpy as jnp
 import jax.random as jrandom
 from jax import vmap, jit
-from jax.lax import scan
+from jax.lax import scan, associative_scan, cond
 from jax.ops import index, index_update, index_add
 from jax.scipy.special import logsumexp
 from jax.experimental import host_callback
@@ -16,7 +16,7 @@ from utils import get_E_likelihood_natparams, get_gauss_params
 from utils import get_resp_wgt_natparams, get_rhos
 from utils import tree_sum, tree_droplast, tree_dropfirst
 from utils import tree_prepend, tree_append, tree_get_idx
-from utils import invmp
+from utils import invmp, invcholp
 
 from data_generation import gen_slds_nica
 
@@ -42,9 +42,44 @@ def hmm_bwd_pass(eta_in, eta_current):
 
 
 #@jit
-def hmm_pw_post(eta_fwd, eta_transition, rho, eta_bwd):
-    pw = eta_fwd[:, None]+eta_transition+(rho+eta_bwd)[None, :]
-    return pw-logsumexp(pw, keepdims=True)
+def hmm_pw_posteriors(fwd_trans_msg, eta_A, rho, bwd_trans_msg):
+    # all pairwise posteriors at once, a constant (K, K) eta_A broadcasts
+    # over time the same as a time-varying (T-1, K, K) one
+    pw = ((fwd_trans_msg+rho)[:-1, :, None]+eta_A
+          + (rho+bwd_trans_msg)[1:, None, :])
+    return pw-logsumexp(pw, (1, 2), keepdims=True)
+
+
+#@jit
+def hmm_messages(eta_pi, eta_A, rho):
+    """Forward and backward transition messages in one scan. eta_A is either
+       a constant (K, K) matrix, which the scan closes over rather than
+       having it copied for every step, or a time-varying (T-1, K, K) one."""
+    fwd_msg_init = eta_pi+rho[0]
+    bwd_msg_init = jnp.zeros(shape=fwd_msg_init.shape)
+    time_varying = eta_A.ndim == 3
+
+    def fwd_bwd_step(msgs, current):
+        fwd_in, bwd_in = msgs
+        if time_varying:
+            rho_fwd, rho_bwd, eta_A_fwd, eta_A_bwd = current
+        else:
+            rho_fwd, rho_bwd = current
+            eta_A_fwd = eta_A_bwd = eta_A
+        fwd_msg, fwd_trans_msg = hmm_fwd_pass(fwd_in, (eta_A_fwd, rho_fwd))
+        bwd_msg, bwd_trans_msg = hmm_bwd_pass(bwd_in, (eta_A_bwd, rho_bwd))
+        return (fwd_msg, bwd_msg), (fwd_trans_msg, bwd_trans_msg)
+
+    # backward pass runs over the flipped sequence in the same scan
+    inputs = (rho[1:], jnp.flip(rho[1:], 0))
+    if time_varying:
+        inputs = inputs+(eta_A, jnp.flip(eta_A, 0))
+    fwd_trans_msg, bwd_trans_msg = scan(fwd_bwd_step,
+                                        (fwd_msg_init, bwd_msg_init),
+                                        inputs)[1]
+    fwd_trans_msg = tree_prepend(eta_pi, fwd_trans_msg)
+    bwd_trans_msg = tree_append(jnp.flip(bwd_trans_msg, 0), bwd_msg_init)
+    return fwd_trans_msg, bwd_trans_msg
 
 
 #@jit
@@ -55,24 +90,55 @@ def hmm_inference(params):
     # get expected natural parameter messages from lds
     rho = get_rhos((eta_prior, eta_transition), (qz, qzlag_z))
 
-    # broadcast transition natparams over time for ease of use
-    eta_A = jnp.repeat(eta_A[None], rho[1:].shape[0], 0)
+    # run message passing
+    fwd_trans_msg, bwd_trans_msg = hmm_messages(eta_pi, eta_A, rho)
+
+    # compute posterior
+    qu = fwd_trans_msg+rho+bwd_trans_msg
+    qu = qu-logsumexp(qu, 1, keepdims=True)
+    quu = hmm_pw_posteriors(fwd_trans_msg, eta_A, rho, bwd_trans_msg)
+    return (qu, quu)
+
+
+#@jit
+def hmm_log_matmul(M_1, M_2):
+    # matrix product in the log-semiring
+    return logsumexp(M_1[:, :, None]+M_2[None, :, :], axis=1)
+
+
+#@jit
+def hmm_inference_assoc(params):
+    """Same as hmm_inference but messages are computed with an associative
+       scan over log-semiring transition products, O(log T) depth."""
+    hmm_natparams, eta_prior, eta_transition, qz, qzlag_z = params
+    eta_pi, eta_A = hmm_natparams
+
+    # get expected natural parameter messages from lds
+    rho = get_rhos((eta_prior, eta_transition), (qz, qzlag_z))
 
     # initialize messages
     fwd_msg_init = eta_pi+rho[0]
     bwd_msg_init = jnp.zeros(shape=fwd_msg_init.shape)
 
-    # run message passing
-    fwd_trans_msg = tree_prepend(eta_pi, scan(hmm_fwd_pass, fwd_msg_init,
-                                              (eta_A, rho[1:]))[1])
-    bwd_trans_msg = tree_append(scan(hmm_bwd_pass, bwd_msg_init,
-                                     (eta_A, rho[1:]),
-                                     reverse=True)[1], bwd_msg_init)
+    # fwd elements carry the incoming evidence on the 'from' state; the first
+    # one absorbs the initial message so that prefix products can be summed
+    # over the 'from' state directly
+    fwd_in = jnp.vstack((fwd_msg_init[None], rho[1:-1]))
+    fwd_elems = fwd_in[:, :, None]+eta_A[None]
+    fwd_prods = associative_scan(vmap(hmm_log_matmul), fwd_elems)
+    fwd_trans_msg = tree_prepend(eta_pi, logsumexp(fwd_prods, axis=1))
+
+    # bwd elements carry the evidence on the 'to' state; suffix products are
+    # obtained by scanning the flipped sequence with flipped operands
+    bwd_elems = jnp.flip(eta_A[None]+rho[1:, None, :], 0)
+    bwd_prods = jnp.flip(associative_scan(
+        vmap(lambda a, b: hmm_log_matmul(b, a)), bwd_elems), 0)
+    bwd_trans_msg = tree_append(logsumexp(bwd_prods, axis=2), bwd_msg_init)
+
     # compute posterior
     qu = fwd_trans_msg+rho+bwd_trans_msg
     qu = qu-logsumexp(qu, 1, keepdims=True)
-    quu = vmap(hmm_pw_post)((fwd_trans_msg+rho)[:-1], eta_A, rho[1:],
-                            bwd_trans_msg[1:])
+    quu = hmm_pw_posteriors(fwd_trans_msg, eta_A, rho, bwd_trans_msg)
     return (qu, quu)
 
 
@@ -115,6 +181,86 @@ def lds_bwd_pass(in_natparams, current_natparams):
     return bwd_trans_msg, bwd_trans_msg
 
 
+#@jit
+def lds_absorb_first(natparams, msg_natparams):
+    # add gaussian message onto the first block of a pairwise potential
+    h, J = natparams
+    eta, P = msg_natparams
+    d = eta.shape[0]
+    return (index_add(h, index[:d], eta), index_add(J, index[:d, :d], P))
+
+
+#@jit
+def lds_absorb_last(natparams, msg_natparams):
+    # add gaussian message onto the last block of a pairwise potential
+    h, J = natparams
+    eta, P = msg_natparams
+    d = eta.shape[0]
+    return (index_add(h, index[d:], eta), index_add(J, index[d:, d:], P))
+
+
+#@jit
+def lds_marginalize_first(natparams):
+    h, J = natparams
+    d = h.shape[0]//2
+    K = invmp(-J[:d, :d], J[:d, d:]).T
+    return (h[d:]+K@h[:d], J[d:, d:]+K@J[:d, d:])
+
+
+#@jit
+def lds_marginalize_last(natparams):
+    h, J = natparams
+    d = h.shape[0]//2
+    K = invmp(-J[d:, d:], J[d:, :d]).T
+    return (h[:d]+K@h[d:], J[:d, :d]+K@J[d:, :d])
+
+
+#@jit
+def lds_assoc_combine(natparams_ab, natparams_bc):
+    """Joins pairwise potentials over (a, b) and (b, c) and marginalizes b,
+       giving a pairwise potential over (a, c) in the same format."""
+    h_ab, J_ab = natparams_ab
+    h_bc, J_bc = natparams_bc
+    d = h_ab.shape[0]//2
+
+    # combined potential on the shared block
+    h_b = h_ab[d:]+h_bc[:d]
+    P_b = -J_ab[d:, d:]-J_bc[:d, :d]
+
+    # marginalize shared block, factoring its precision once
+    L_b = jnp.linalg.cholesky(P_b)
+    K_a = invcholp(L_b, J_ab[d:, :d]).T
+    K_c = invcholp(L_b, J_bc[:d, d:]).T
+    h = jnp.concatenate((h_ab[:d]+K_a@h_b, h_bc[d:]+K_c@h_b))
+    J = jnp.vstack((
+        jnp.hstack((J_ab[:d, :d]+K_a@J_ab[d:, :d], K_a@J_bc[:d, d:])),
+        jnp.hstack((K_c@J_ab[d:, :d], J_bc[d:, d:]+K_c@J_bc[:d, d:]))
+    ))
+    return (h, J)
+
+
+#@jit
+def lds_messages_assoc(fwd_msg_init, trans_natparams, likelih_natparams):
+    """Forward and backward transition messages of lds_inference computed
+       with associative scans (parallel Kalman filter/smoother elements).
+       likelih_natparams are for timesteps 1..T-1."""
+    # fwd elements: evidence on the 'from' block, first one absorbs the
+    # initial message so that prefixes only need their first block removed
+    fwd_in = tree_prepend(fwd_msg_init, tree_droplast(likelih_natparams))
+    fwd_elems = vmap(lds_absorb_first)(trans_natparams, fwd_in)
+    fwd_prefix = associative_scan(vmap(lds_assoc_combine), fwd_elems)
+    fwd_trans_msgs = vmap(lds_marginalize_first)(fwd_prefix)
+
+    # bwd elements: evidence on the 'to' block, suffixes from flipped scan
+    bwd_elems = vmap(lds_absorb_last)(trans_natparams, likelih_natparams)
+    bwd_elems = jax.tree_map(lambda a: jnp.flip(a, 0), bwd_elems)
+    bwd_suffix = associative_scan(
+        vmap(lambda a, b: lds_assoc_combine(b, a)), bwd_elems)
+    bwd_suffix = jax.tree_map(lambda a: jnp.flip(a, 0), bwd_suffix)
+    bwd_trans_msgs = vmap(lds_marginalize_last)(bwd_suffix)
+    return fwd_trans_msgs, bwd_trans_msgs
+
+
 #@jit
 def pw_posterior(natparams):
     eta_f, P_f, h, J, eta_b, P_b = natparams
@@ -125,35 +271,50 @@ def pw_posterior(natparams):
     return (eta_pw, P_pw)
 
 
-#@jit
-def lds_inference(z_posteriors, params):
-    eta_prior, eta_trans, eta_likelih, qu, n = params
-    qu = jnp.exp(qu)
-    qz, qzlag_z = z_posteriors
-
-    # computer responsibility weighted natural parameters
-    eta_prior_r = get_resp_wgt_natparams(eta_prior, qu[0])
-    eta_trans_r = vmap(get_resp_wgt_natparams,
-                       in_axes=(None, 0))(eta_trans, qu[1:])
-
-    # compute expected likelihood natparams instead
-    E_eta_likelih = get_E_likelihood_natparams(eta_likelih, qz[0], n)
+def make_lds_inference(parallel=False):
+    #@jit
+    def lds_inference(z_posteriors, params):
+        eta_prior, eta_trans, eta_likelih, qu, n = params
+        qu = jnp.exp(qu)
+        qz, qzlag_z = z_posteriors
+
+        # computer responsibility weighted natural parameters
+        eta_prior_r = get_resp_wgt_natparams(eta_prior, qu[0])
+        eta_trans_r = vmap(get_resp_wgt_natparams,
+                           in_axes=(None, 0))(eta_trans, qu[1:])
+
+        # compute expected likelihood natparams instead
+        E_eta_likelih = get_E_likelihood_natparams(eta_likelih, qz[0], n)
+
+        # initialize messages
+        fwd_msg_init = tree_sum((eta_prior_r,
+                                 tree_get_idx(0, E_eta_likelih)))
+        bwd_msg_init = (jnp.zeros(shape=fwd_msg_init[0].shape),
+                        jnp.zeros(shape=fwd_msg_init[1].shape))
+
+        # run message passing
+        if parallel:
+            fwd_trans_msgs, bwd_trans_msgs = lds_messages_assoc(
+                fwd_msg_init, eta_trans_r, tree_dropfirst(E_eta_likelih))
+        else:
+            fwd_trans_msgs = scan(lds_fwd_pass, fwd_msg_init,
+                                  (eta_trans_r,
+                                   tree_dropfirst(E_eta_likelih)))[1]
+            bwd_trans_msgs = scan(lds_bwd_pass, bwd_msg_init,
+                                  (eta_trans_r,
+                                   tree_dropfirst(E_eta_likelih)),
+                                  reverse=True)[1]
+        fwd_trans_msgs = tree_prepend(eta_prior_r, fwd_trans_msgs)
+        bwd_trans_msgs = tree_append(bwd_trans_msgs, bwd_msg_init)
+        return lds_posteriors(z_posteriors, fwd_trans_msgs, bwd_trans_msgs,
+                              eta_trans_r, E_eta_likelih, n)
+    return lds_inference
 
-    # initialize messages
-    fwd_msg_init = tree_sum((eta_prior_r, tree_get_idx(0, E_eta_likelih)))
-    bwd_msg_init = (jnp.zeros(shape=fwd_msg_init[0].shape),
-                    jnp.zeros(shape=fwd_msg_init[1].shape))
 
-    # run message passing
-    fwd_trans_msgs = tree_prepend(
-        eta_prior_r, scan(lds_fwd_pass, fwd_msg_init,
-                          (eta_trans_r, tree_dropfirst(E_eta_likelih)))[1]
-    )
-    bwd_trans_msgs = tree_append(
-        scan(lds_bwd_pass, bwd_msg_init,
-             (eta_trans_r, tree_dropfirst(E_eta_likelih)), reverse=True)[1],
-        bwd_msg_init
-    )
+#@jit
+def lds_posteriors(z_posteriors, fwd_trans_msgs, bwd_trans_msgs,
+                   eta_trans_r, E_eta_likelih, n):
+    qz, qzlag_z = z_posteriors
 
     # compute marginal posteriors
     qz_natparams = tree_sum((fwd_trans_msgs, E_eta_likelih,
@@ -175,7 +336,16 @@ def lds_inference(z_posteriors, params):
     return (qz, qzlag_z), None
 
 
-def make_inference(eta_hmm, eta_prior, eta_transition, eta_likelihood):
+lds_inference = make_lds_inference(parallel=False)
+lds_inference_assoc = make_lds_inference(parallel=True)
+
+
+def make_inference(eta_hmm, eta_prior, eta_transition, eta_likelihood,
+                   parallel=False):
+    # associative scan versions have O(log T) depth instead of O(T)
+    _lds_inference = lds_inference_assoc if parallel else lds_inference
+    _hmm_inference = hmm_inference_assoc if parallel else hmm_inference
+
     #@jit
     def inference(posterior, iteration):
         # unpack
@@ -183,15 +353,36 @@ def make_inference(eta_hmm, eta_prior, eta_transition, eta_likelihood):
 
         # run inference
         N = qz[0].shape[0]
-        qz, qzlag_z = scan(lds_inference, (qz, qzlag_z),
+        qz, qzlag_z = scan(_lds_inference, (qz, qzlag_z),
                            (eta_prior, eta_transition, eta_likelihood,
                            qu, jnp.arange(N)))[0]
-        qu, quu = vmap(hmm_inference)(
+        qu, quu = vmap(_hmm_inference)(
                        (eta_hmm, eta_prior, eta_transition, qz, qzlag_z))
         return (qz, qzlag_z, qu, quu), None
     return inference
 
 
+def make_inference_runner(eta_hmm, eta_prior, eta_transition, eta_likelihood,
+                          max_iters, parallel=False):
+    """Runs up to max_iters inference iterations where the actual number of
+       iterations is a traced argument, so changing it never recompiles.
+       Iterations beyond num_iters are skipped with lax.cond (while_loop
+       would not be reverse differentiable).
+    """
+    inference = make_inference(eta_hmm, eta_prior, eta_transition,
+                               eta_likelihood, parallel)
+
+    @jit
+    def run_inference(posterior, num_iters):
+        def _step(posterior, iteration):
+            posterior = cond(iteration < num_iters,
+                             lambda p: inference(p, iteration)[0],
+                             lambda p: p, posterior)
+            return posterior, None
+        return scan(_step, posterior, jnp.arange(max_iters))[0]
+    return run_inference
+
+
 if __name__ == "__main__":
     # generate data
     key = jrandom.PRNGKey(0)
@@ -9,8 +9,10 @@ import jax.random as jrandom
 import matplotlib.pyplot as plt
 from sklearn.decomposition import PCA
 
-from data_generation import gen_slds_nica
+from data_generation import load_or_gen_slds_nica
 from train import full_train
+from train_multiseed import full_train_multiseed
+from utils import init_compilation_cache
 
 # uncomment to debug NaNs
 #config.update("jax_debug_nans", True)
@@ -45,11 +47,16 @@ def parse():
                         help="seed for initializing data generation sampling")
     parser.add_argument('--est-seed', type=int, default=99,
                         help="seed for initializing function estimators")
+    parser.add_argument('--num-est-seeds', type=int, default=1,
+                        help="train this many seeds from --est-seed jointly")
     # inference & training & optimization parameters
     parser.add_argument('--inference-iters', type=int, default=5,
                         help="num. of inference iterations")
     parser.add_argument('--num-samples', type=int, default=1,
                         help="num. of samples for elbo")
+    parser.add_argument('--parallel-inference', action='store_true',
+                        default=False,
+                        help="associative scan message passing (log T depth)")
     parser.add_argument('--hidden-units-enc', type=int, default=128,
                         help="num. of hidden units in encoder estimator MLP")
     parser.add_argument('--hidden-units-dec', type=int, default=64,
@@ -72,11 +79,25 @@ def parse():
                         help="interval (in iterations) for full decay of LR")
     parser.add_argument('--plot-freq', type=int, default=10,
                         help="plotting frequency")
+    parser.add_argument('--eval-freq', type=int, default=1,
+                        help="evaluation frequency")
     # saving and loading
     parser.add_argument('--out-dir', type=str, default="output/",
                         help="location where data is saved")
+    parser.add_argument('--data-cache-dir', type=str,
+                        default="output/data_cache/",
+                        help="location of cached simulated data")
+    parser.add_argument('--jit-cache-dir', type=str,
+                        default="output/jit_cache/",
+                        help="persistent compilation cache location")
+    parser.add_argument('--ckpt-keep', type=int, default=3,
+                        help="number of recent checkpoints kept besides best")
+    parser.add_argument('--ckpt-interval', type=float, default=60.,
+                        help="min. seconds between checkpoint writes")
     parser.add_argument('--resume-best', action='store_true', default=False,
                         help="resume from best chkpoint for current args")
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help="resume from latest chkpoint for current args")
     parser.add_argument('--eval-only', action='store_true', default=False,
                         help="eval only wihtout training")
 
@@ -87,17 +108,13 @@ def parse():
 
 def main():
     args = parse()
+    init_compilation_cache(args.jit_cache_dir)
 
-    # generate data
-    param_key = jrandom.PRNGKey(args.param_seed)
-    data_key = jrandom.PRNGKey(args.data_seed)
-
-    # generate simulated data
+    # generate simulated data (or load it from the cache)
     # !BEWARE d=2, k=2 fixed in data generation code
-    x, f, z, z_mu, states, *params = gen_slds_nica(args.n, args.m, args.t,
-                                                   args.k, args.d, args.l,
-                                                   param_key, data_key,
-                                                   repeat_layers=True)
+    x, f, z, z_mu, states, *params = load_or_gen_slds_nica(
+        args.n, args.m, args.t, args.k, args.d, args.l, args.param_seed,
+        args.data_seed, repeat_layers=True, cache_dir=args.data_cache_dir)
 
     # we have not tried this option but could be useful in some cases
     if args.whiten:
@@ -105,8 +122,13 @@ def main():
         x = pca.fit_transform(x.T).T
 
     # train
-    est_params, posteriors, best_elbo = full_train(x, f, z, z_mu, states,
-                                                   params, args, args.est_seed)
+    if args.num_est_seeds > 1:
+        est_seeds = range(args.est_seed, args.est_seed+args.num_est_seeds)
+        est_params, posteriors, best_elbo = full_train_multiseed(
+            x, f, z, z_mu, states, params, args, est_seeds)
+    else:
+        est_params, posteriors, best_elbo = full_train(
+            x, f, z, z_mu, states, params, args, args.est_seed)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,25 @@
 import argparse
+import os
 import pdb
 import sys
 
+# expose several host (CPU) devices for data parallel training; this has to
+# be set before jax is first imported so --num-devices is read up front
+_dev_parser = argparse.ArgumentParser(add_help=False)
+_dev_parser.add_argument('--num-devices', type=int, default=1)
+_num_devices = _dev_parser.parse_known_args()[0].num_devices
+if _num_devices > 1:
+    os.environ["XLA_FLAGS"] = " ".join([
+        os.environ.get("XLA_FLAGS", ""),
+        "--xla_force_host_platform_device_count={}".format(_num_devices)])
+
 import jax.random as jrandom
 from jax.config import config
 config.update("jax_enable_x64", True)
 
-from data_generation import gen_slds_nica
+from data_generation import load_or_gen_slds_nica
 from train_svi import full_train
+from utils import init_compilation_cache
 from sklearn.decomposition import PCA
 
 import matplotlib.pyplot as plt
@@ -50,6 +62,9 @@ def parse():
                         help="num. of inference iterations")
     parser.add_argument('--num-samples', type=int, default=1,
                         help="num. of samples for elbo")
+    parser.add_argument('--parallel-inference', action='store_true',
+                        default=False,
+                        help="associative scan message passing (log T depth)")
     parser.add_argument('--hidden-units-enc', type=int, default=64,
                         help="num. of hidden units in encoder estimator MLP")
     parser.add_argument('--hidden-units-dec', type=int, default=32,
@@ -78,11 +93,25 @@ def parse():
                         help="plotting frequency")
     parser.add_argument('--eval-freq', type=int, default=10,
                         help="evaluation frequency")
+    parser.add_argument('--num-devices', type=int, default=1,
+                        help="shard minibatches over this many devices")
     # saving and loading 
     parser.add_argument('--out-dir', type=str, default="output/",
                         help="location where data is saved")
+    parser.add_argument('--data-cache-dir', type=str,
+                        default="output/data_cache/",
+                        help="location of cached simulated data")
+    parser.add_argument('--jit-cache-dir', type=str,
+                        default="output/jit_cache/",
+                        help="persistent compilation cache location")
+    parser.add_argument('--ckpt-keep', type=int, default=3,
+                        help="number of recent checkpoints kept besides best")
+    parser.add_argument('--ckpt-interval', type=float, default=60.,
+                        help="min. seconds between checkpoint writes")
     parser.add_argument('--resume-best', action='store_true', default=False,
                         help="resume from best chkpoint for current args")
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help="resume from latest chkpoint for current args")
     parser.add_argument('--eval-only', action='store_true', default=False,
                         help="eval only wihtout training")
     args = parser.parse_args()
@@ -91,17 +120,13 @@ def parse():
 
 def main():
     args = parse()
+    init_compilation_cache(args.jit_cache_dir)
 
-    # generate data
-    param_key = jrandom.PRNGKey(args.param_seed)
-    data_key = jrandom.PRNGKey(args.data_seed)
-
-    # generate simulated data
-    # !BEWARE d=2, k=2 fixed in data generation
-    x, f, z, z_mu, states, *params = gen_slds_nica(args.n, args.m, args.t,
-                                                   args.k, args.d, args.l,
-                                                   param_key, data_key,
-                                                   repeat_layers=True)
+    # generate simulated data (or load it from the cache)
+    # !BEWARE d=2, k=2 fixed in data generation code
+    x, f, z, z_mu, states, *params = load_or_gen_slds_nica(
+        args.n, args.m, args.t, args.k, args.d, args.l, args.param_seed,
+        args.data_seed, repeat_layers=True, cache_dir=args.data_cache_dir)
 
     # we have not tried this option but could be useful in some cases
     if args.whiten:
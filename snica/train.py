@@ -17,34 +17,30 @@ from optax import chain, piecewise_constant_schedule, scale_by_schedule
 from functools import partial
 from elbo import avg_neg_ELBO
 from func_estimators import init_encoder_params, init_decoder_params
-from func_estimators import decoder_mlp
-from utils import matching_sources_corr, plot_ic
+from evaluation import AsyncEvaluator, MetricsLogger, print_record
 from utils import nsym_grad, sym_grad, get_prec_mat
-from utils import save_best, load_best_ckpt
-
-import matplotlib.pyplot as plt
-
-
-def full_train(x, f, z, z_mu, states, params, args, est_key):
-    print("Running with:", args)
-    # unpack some of the args
-    N = z_mu.shape[0]
+from utils import CheckpointManager, ckpt_file_id
+from utils import load_best_ckpt, load_latest_ckpt
+
+
+def init_estimates(x, params, args, est_key):
+    """Random initialization of the graphical model and MLP parameters.
+    Args:
+        x (array): (M, T) observed data.
+        params (tuple): ground truth (mixing, lds, hmm) parameters.
+        args: parsed command line arguments.
+        est_key (int): estimation seed.
+    Returns:
+        all_params (tuple): ((R, lds, hmm), (phi, theta)) estimates.
+        key (PRNGKey): key for the training loop.
+    """
     M, T = x.shape
-    num_epochs = args.num_epochs
-    inference_iters = args.inference_iters
-    num_samples = args.num_samples
     enc_hidden_units = args.hidden_units_enc
     dec_hidden_units = args.hidden_units_dec
     enc_hidden_layers = args.hidden_layers_enc
     dec_hidden_layers = args.hidden_layers_dec
-    lr_nn = args.nn_learning_rate
-    lr_gm = args.gm_learning_rate
-    decay_interval = args.decay_interval
-    decay_rate = args.decay_rate
-    burnin_len = args.burnin
-    plot_freq = args.plot_freq
     mix_params, lds_params, hmm_params = params
-    _, K, d = lds_params[0].shape
+    N, K, d = lds_params[0].shape
 
     # initialize pgm parameters randomly
     est_key = jrandom.PRNGKey(est_key)
@@ -91,25 +87,27 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
         # phi variable is not actually used
         phi = theta
 
-    # initialize training
     gm_params = (R_est, lds_est, hmm_est)
     nn_params = (phi, theta)
-    all_params = (gm_params, nn_params)
+    return (gm_params, nn_params), key
+
+
+def make_optimizer(args):
     param_labels = ('gm', 'nn')
-    schedule_fn = piecewise_constant_schedule(1., {decay_interval: decay_rate})
+    schedule_fn = piecewise_constant_schedule(
+        1., {args.decay_interval: args.decay_rate})
     tx = optax.multi_transform({
-        'gm': chain(optax.adam(lr_gm), scale_by_schedule(schedule_fn)),
-        'nn': chain(optax.adam(lr_nn), scale_by_schedule(schedule_fn))},
+        'gm': chain(optax.adam(args.gm_learning_rate),
+                    scale_by_schedule(schedule_fn)),
+        'nn': chain(optax.adam(args.nn_learning_rate),
+                    scale_by_schedule(schedule_fn))},
         param_labels)
-    opt_state = tx.init(all_params)
-    start_epoch = 0
+    return tx
 
-    # option to resume to checkpoint
-    if args.resume_best:
-        start_epoch, all_params, opt_state, tx = load_best_ckpt(args)
 
+def make_step_fns(tx, args):
     # define training step
-    @partial(jit, static_argnums=(4, 5))
+    @partial(jit, static_argnums=(5,))
     def training_step(epoch_num, params, opt_state, x,
                       inference_iters, num_samples, burnin, key):
         """Performs gradient step on the function estimator
@@ -130,6 +128,8 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
             avg_neg_ELBO, argnums=(1, 2, 3, 4, 5,), has_aux=True)(
                 x, R_est, lds_est, hmm_est, phi, theta, nu,
                 subkey, inference_iters, num_samples,
+                parallel_inference=args.parallel_inference,
+                max_inference_iters=args.inference_iters,
         )
 
         # unpack grads
@@ -157,7 +157,7 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
         return n_elbo, posteriors, params, opt_state
 
 
-    @partial(jit, static_argnums=(4, 5))
+    @partial(jit, static_argnums=(5,))
     def infer_step(epoch_num, params, opt_state, x,
                    inference_iters, num_samples, burnin, key):
         """Perform inference without gradient step for eval purposes
@@ -172,21 +172,56 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
         nu = 1.
 
         # inference step
-        n_elbo, posteriors = avg_neg_ELBO(x, R_est, lds_est, hmm_est, phi,
-                                          theta, nu, subkey, inference_iters,
-                                          num_samples)
+        n_elbo, posteriors = avg_neg_ELBO(
+            x, R_est, lds_est, hmm_est, phi, theta, nu, subkey,
+            inference_iters, num_samples,
+            parallel_inference=args.parallel_inference,
+            max_inference_iters=args.inference_iters)
         return n_elbo, posteriors
 
+    return training_step, infer_step
+
+
+def full_train(x, f, z, z_mu, states, params, args, est_key):
+    print("Running with:", args)
+    # unpack some of the args
+    num_epochs = args.num_epochs
+    inference_iters = args.inference_iters
+    num_samples = args.num_samples
+    burnin_len = args.burnin
+    plot_freq = args.plot_freq
+    eval_freq = args.eval_freq
+
+    # initialize training
+    all_params, key = init_estimates(x, params, args, est_key)
+    tx = make_optimizer(args)
+    opt_state = tx.init(all_params)
+    start_epoch = 0
 
-    # set plot
-    fig, ax = plt.subplots(2, N, figsize=(10 * N, 6),
-                           gridspec_kw={'height_ratios': [1, 2]})
-    ax2 = ax
-    for n in range(N):
-        ax2[1, n] = ax[1, n].twinx()
+    # option to resume to checkpoint
+    if args.resume:
+        start_epoch, all_params, opt_state = load_latest_ckpt(
+            args, all_params, opt_state)
+    elif args.resume_best:
+        start_epoch, all_params, opt_state = load_best_ckpt(
+            args, all_params, opt_state)
+    ckpt = CheckpointManager(args.out_dir, ckpt_file_id(args),
+                             keep_last=args.ckpt_keep,
+                             min_interval=args.ckpt_interval)
+    training_step, infer_step = make_step_fns(tx, args)
+
+    # evaluation, checkpointing and plotting run off the training thread
+    file_id = ckpt_file_id(args)
+    hooks = [print_record,
+             MetricsLogger(os.path.join(args.out_dir,
+                                        file_id+"_metrics.jsonl"))]
+    evaluator = AsyncEvaluator(
+        f, z_mu, states, ckpt, hooks=hooks,
+        plot_dir=os.path.join(args.out_dir, file_id+"_plots"),
+        num_epochs=num_epochs, est_seed=args.est_seed,
+        param_seed=args.param_seed)
 
     # train
-    best_elbo = -jnp.inf
     for epoch in range(start_epoch, num_epochs):
         tic = time.time()
         niters = min(inference_iters, ((epoch // 100) + 1) * 5)
@@ -203,47 +238,15 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
                 epoch, all_params, opt_state, x, niters,
                 num_samples, burnin_len, trainkey)
 
-        # evaluate
-        qz, qzlag_z, qu, quu = posteriors
-        mcc, _, sort_idx = matching_sources_corr(qz[0][:, :, 0], z_mu[:, :, 0])
-        f_mu_est = vmap(decoder_mlp, in_axes=(None, -1),
-                        out_axes=-1)(all_params[1][1], qz[0][:, :, 0])
-        denoise_mcc = jnp.abs(jnp.diag(
-            jnp.corrcoef(f_mu_est, f)[:M, M:])).mean()
-
-        print("*Epoch: [{0}/{1}]\t"
-              "ELBO: {2}\t"
-              "mcc: {corr: .2f}\t"
-              "denoise mcc: {dcorr: .2f}\t"
-              "num. infernce iters: {3}\t"
-              "eseed: {es}\t"
-              "pseed: {ps}".format(epoch, num_epochs, -n_elbo, niters,
-                                   corr=mcc, dcorr=denoise_mcc,
-                                   es=args.est_seed, ps=args.param_seed))
-
-        if epoch % plot_freq == 0 or args.eval_only:
-            # plot
-            plot_start = int(T/2)
-            plot_len = 500
-            plot_end = plot_start+plot_len
-            for n in range(N):
-                qz_mu_n = qz[0][sort_idx][n][plot_start:plot_end]
-                qz_prec_n = qz[1][sort_idx][n][plot_start:plot_end]
-                qu_n = jnp.exp(qu[sort_idx][n][plot_start:plot_end])
-                u_n = states[n][plot_start:plot_end]
-                z_mu_n = z_mu[n][plot_start:plot_end]
-                plot_ic(u_n, z_mu_n, qu_n, qz_mu_n, qz_prec_n,
-                        ax[0, n], ax[1, n], ax2[1, n])
-            plt.pause(.5)
-
-        # saving
-        if -n_elbo > best_elbo:
-            best_elbo = -n_elbo
-            best_params = all_params
-            best_posters = posteriors
-            save_best(epoch, args, all_params, opt_state, tx)
+        # evaluate, track best elbo and plot asynchronously
+        evaluate = epoch % eval_freq == 0 or args.eval_only
+        plot = epoch % plot_freq == 0 or args.eval_only
+        evaluator.submit(epoch, 0, n_elbo, niters, all_params, opt_state,
+                         posteriors, evaluate=evaluate, plot=plot)
 
         if args.eval_only:
-            return best_params, best_posters, best_elbo
+            break
         print("Epoch took: ", time.time()-tic)
+    best_params, best_posters, best_elbo = evaluator.close()
+    ckpt.close()
     return best_params, best_posters, best_elbo
@@ -0,0 +1,114 @@
+import os
+import time
+
+import jax.numpy as jnp
+import jax.random as jrandom
+
+from jax import vmap, jit
+
+from functools import partial
+from evaluation import MetricsLogger, MultiSeedEvaluator
+from train import init_estimates, make_optimizer, make_step_fns
+from utils import CheckpointManager, ckpt_file_id, multi_tree_stack
+from utils import load_ckpt, load_tree
+
+
+def over_seeds(step):
+    """Maps a training or inference step over stacked (leading seed axis)
+        params, opt_state and keys; x and the compiled step are shared.
+    """
+    @partial(jit, static_argnums=(5,))
+    def multi_step(epoch_num, params, opt_state, x, inference_iters,
+                   num_samples, burnin, keys):
+        return vmap(lambda p, s, k: step(
+            epoch_num, p, s, x, inference_iters, num_samples, burnin, k))(
+                params, opt_state, keys)
+    return multi_step
+
+
+def full_train_multiseed(x, f, z, z_mu, states, params, args, est_seeds):
+    """Trains one model per estimation seed on the same data in a single
+        compiled, vmapped training step.
+    Returns:
+        best_params (tuple): stacked best parameters, one per seed.
+        best_posters (tuple): stacked posteriors at best_params.
+        best_elbo (array): (S,) best ELBO of each seed.
+    """
+    print("Running with:", args)
+    print("Estimation seeds:", list(est_seeds))
+    num_epochs = args.num_epochs
+    inference_iters = args.inference_iters
+    num_samples = args.num_samples
+    burnin_len = args.burnin
+    eval_freq = args.eval_freq
+
+    # initialize each seed as in single seed training then stack
+    inits = [init_estimates(x, params, args, s) for s in est_seeds]
+    all_params = multi_tree_stack([p for p, _ in inits])
+    keys = jnp.stack([k for _, k in inits])
+    tx = make_optimizer(args)
+    opt_state = vmap(tx.init)(all_params)
+    start_epoch = 0
+    best = None
+
+    # option to resume to checkpoint
+    file_id = ckpt_file_id(args)+"_S{}".format(len(est_seeds))
+    ckpt_dir = os.path.join(args.out_dir, file_id+"_ckpt")
+    if args.resume:
+        start_epoch, all_params, opt_state = load_ckpt(
+            ckpt_dir, all_params, opt_state, which="latest")
+        if os.path.exists(os.path.join(ckpt_dir, "best_params.npz")):
+            best_params, meta = load_tree(ckpt_dir, "best_params",
+                                          all_params)
+            best = (best_params, meta["epoch"], meta["elbo"])
+    elif args.resume_best:
+        # the best params of each seed come from different epochs and have
+        # no matching optimizer state, so they can only be evaluated
+        if not args.eval_only:
+            raise ValueError("--resume-best with several estimation seeds "
+                             "is only supported with --eval-only, use "
+                             "--resume to continue training")
+        all_params, meta = load_tree(ckpt_dir, "best_params", all_params)
+        best = (all_params, meta["epoch"], meta["elbo"])
+        start_epoch = int(meta["epoch"].max())+1
+    ckpt = CheckpointManager(args.out_dir, file_id,
+                             keep_last=args.ckpt_keep,
+                             min_interval=args.ckpt_interval)
+    training_step, infer_step = make_step_fns(tx, args)
+    multi_training_step = over_seeds(training_step)
+    multi_infer_step = over_seeds(infer_step)
+
+    # evaluation and checkpointing run off the training thread
+    hooks = [MetricsLogger(os.path.join(args.out_dir,
+                                        file_id+"_metrics.jsonl"))]
+    evaluator = MultiSeedEvaluator(
+        f, z_mu, states, ckpt, est_seeds, hooks=hooks, best=best,
+        num_epochs=num_epochs, param_seed=args.param_seed)
+
+    # train
+    for epoch in range(start_epoch, num_epochs):
+        tic = time.time()
+        niters = min(inference_iters, ((epoch // 100) + 1) * 5)
+        keys, trainkeys = jnp.swapaxes(vmap(jrandom.split)(keys), 0, 1)
+
+        if args.eval_only:
+            # infer posteriors for evaluation without grad step
+            n_elbo, posteriors = multi_infer_step(
+                epoch, all_params, opt_state, x, niters,
+                num_samples, burnin_len, trainkeys)
+        else:
+            n_elbo, posteriors, all_params, opt_state = multi_training_step(
+                epoch, all_params, opt_state, x, niters,
+                num_samples, burnin_len, trainkeys)
+
+        # evaluate and track the best of each seed asynchronously
+        evaluate = epoch % eval_freq == 0 or args.eval_only
+        evaluator.submit(epoch, 0, n_elbo, niters, all_params, opt_state,
+                         posteriors, evaluate=evaluate)
+
+        if args.eval_only:
+            break
+        print("Epoch took: ", time.time()-tic)
+    best_params, best_posters, best_elbo = evaluator.close()
+    ckpt.close()
+    return best_params, best_posters, best_elbo
@@ -11,7 +11,7 @@ import jax.numpy as jnp
 import jax.random as jrandom
 import optax
 
-from jax import vmap, jit, value_and_grad, lax
+from jax import vmap, jit, pmap, value_and_grad, lax
 from jax.ops import index, index_update
 from jax.lax import cond
 from optax import chain, piecewise_constant_schedule, scale_by_schedule
@@ -19,13 +19,12 @@ from optax import chain, piecewise_constant_schedule, scale_by_schedule
 from functools import partial
 from elbo import avg_neg_ELBO
 from func_estimators import init_encoder_params, init_decoder_params
-from func_estimators import decoder_mlp
+from evaluation import AsyncEvaluator, MetricsLogger, print_record
 
-from utils import matching_sources_corr, plot_ic
 from utils import nsym_grad, sym_grad, get_prec_mat
-from utils import save_best, load_best_ckpt
-
-import matplotlib.pyplot as plt
+from utils import CheckpointManager, ckpt_file_id
+from utils import load_best_ckpt, load_latest_ckpt
+from utils import subseq_minibatches
 
 
 def full_train(x, f, z, z_mu, states, params, args, est_key):
@@ -110,47 +109,35 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
     start_epoch = 0
 
     # option to resume to checkpoint
-    if args.resume_best:
-        start_epoch, all_params, opt_state, tx = load_best_ckpt(args)
-
-    # functions to define sampling for SVI
-    @jit
-    def get_subseq_data(orig_data, subseq_array_to_fill):
-        """Collects all sub-sequences into an array.
-        """
-        subseq_data = subseq_array_to_fill
-        num_subseqs = subseq_data.shape[0]
-        subseq_len = subseq_data.shape[-1]
-
-        def body_fun(i, subseq_data):
-            """Function to loop over.
-            """
-            subseq_i = lax.dynamic_slice_in_dim(orig_data, i,
-                                                subseq_len, axis=1)
-            subseq_data = index_update(subseq_data, index[i, :, :],
-                                       subseq_i)
-            return subseq_data
-        return lax.fori_loop(0, num_subseqs, body_fun, subseq_data)
-
-    # set up minibatch training
+    if args.resume:
+        start_epoch, all_params, opt_state = load_latest_ckpt(
+            args, all_params, opt_state)
+    elif args.resume_best:
+        start_epoch, all_params, opt_state = load_best_ckpt(
+            args, all_params, opt_state)
+    ckpt = CheckpointManager(args.out_dir, ckpt_file_id(args),
+                             keep_last=args.ckpt_keep,
+                             min_interval=args.ckpt_interval)
+
+    # data parallel training over (host) devices, see --num-devices
+    num_devices = args.num_devices
+    assert num_devices <= jax.local_device_count()
+    assert minib_size % num_devices == 0
+
+    # set up minibatch training, sub-sequences are gathered lazily from x
     num_subseqs = T-subseq_len+1
     assert num_subseqs >= minib_size
     num_full_minibs, remainder = divmod(num_subseqs, minib_size)
     num_minibs = num_full_minibs + bool(remainder)
-    sub_data_holder = jnp.zeros((num_subseqs, M, subseq_len))
-    sub_data = get_subseq_data(x, sub_data_holder)
     print("T: {t}\t"
           "subseq_len: {slen}\t"
           "minibatch size: {mbs}\t"
           "num minibatches: {nbs}".format(
               t=T, slen=subseq_len, mbs=minib_size, nbs=num_minibs))
 
-    @partial(jit, static_argnums=(4, 5))
-    def training_step(epoch_num, params, opt_state, x,
-                      inference_iters, num_samples, burnin, key):
-        """Performs gradient step on the function estimator
-               MLP parameters on the ELBO.
-        """
+    def elbo_grads(epoch_num, params, x, inference_iters, num_samples,
+                   burnin, key):
+        """ELBO gradients on a minibatch, rescaled for subsampling."""
         # unpack
         key, subkey = jrandom.split(key)
         R_est, lds_est, hmm_est = params[0]
@@ -165,7 +152,9 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
         (n_elbo, posteriors), g = value_and_grad(
             avg_neg_ELBO, argnums=(1, 2, 3, 4, 5,), has_aux=True)(
                 x, R_est, lds_est, hmm_est, phi, theta, nu,
-                subkey, inference_iters, num_samples, minibatch=True
+                subkey, inference_iters, num_samples, minibatch=True,
+                parallel_inference=args.parallel_inference,
+                max_inference_iters=args.inference_iters
         )
 
         # overall grad adjustment for all variables due to subsampling
@@ -195,6 +184,36 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
         gm_g = (R_g, lds_g, hmm_g)
         nn_g = (phi_g, theta_g)
         g = (gm_g, nn_g)
+        return n_elbo, posteriors, g
+
+    @partial(jit, static_argnums=(5,))
+    def training_step(epoch_num, params, opt_state, x,
+                      inference_iters, num_samples, burnin, key):
+        """Performs gradient step on the function estimator
+               MLP parameters on the ELBO.
+        """
+        n_elbo, posteriors, g = elbo_grads(epoch_num, params, x,
+                                           inference_iters, num_samples,
+                                           burnin, key)
+
+        # perform gradient updates
+        updates, opt_state = tx.update(g, opt_state, params)
+        params = optax.apply_updates(params, updates)
+        return n_elbo, posteriors, params, opt_state
+
+    @partial(pmap, axis_name="devices", static_broadcasted_argnums=(5,),
+             in_axes=(None, None, None, 0, None, None, None, 0),
+             out_axes=(None, 0, None, None))
+    def sharded_training_step(epoch_num, params, opt_state, x,
+                              inference_iters, num_samples, burnin, key):
+        """Data-parallel training step, x is (devices, minib/devices, M,
+               subseq_len) and gradients are averaged over devices before
+               the same update is applied everywhere.
+        """
+        n_elbo, posteriors, g = elbo_grads(epoch_num, params, x,
+                                           inference_iters, num_samples,
+                                           burnin, key)
+        n_elbo, g = lax.pmean((n_elbo, g), axis_name="devices")
 
         # perform gradient updates
         updates, opt_state = tx.update(g, opt_state, params)
@@ -202,7 +221,7 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
         return n_elbo, posteriors, params, opt_state
 
 
-    @partial(jit, static_argnums=(4, 5))
+    @partial(jit, static_argnums=(5,))
     def infer_step(epoch_num, params, opt_state, x,
                    inference_iters, num_samples, burnin, key):
         """Perform inference without gradient step for eval purposes
@@ -217,94 +236,77 @@ def full_train(x, f, z, z_mu, states, params, args, est_key):
         nu = 1.
 
         # inference step
-        n_elbo, posteriors = avg_neg_ELBO(x, R_est, lds_est, hmm_est, phi,
-                                          theta, nu, subkey, inference_iters,
-                                          num_samples)
+        n_elbo, posteriors = avg_neg_ELBO(
+            x, R_est, lds_est, hmm_est, phi, theta, nu, subkey,
+            inference_iters, num_samples,
+            parallel_inference=args.parallel_inference,
+            max_inference_iters=args.inference_iters)
         return n_elbo, posteriors
 
 
-    # set plot
-    fig, ax = plt.subplots(2, N, figsize=(10 * N, 6),
-                           gridspec_kw={'height_ratios': [1, 2]})
-    ax2 = ax
-    for n in range(N):
-        ax2[1, n] = ax[1, n].twinx()
+    # evaluation, checkpointing and plotting run off the training thread
+    file_id = ckpt_file_id(args)
+    hooks = [print_record,
+             MetricsLogger(os.path.join(args.out_dir,
+                                        file_id+"_metrics.jsonl"))]
+    evaluator = AsyncEvaluator(
+        f, z_mu, states, ckpt, hooks=hooks,
+        plot_dir=os.path.join(args.out_dir, file_id+"_plots"),
+        num_epochs=num_epochs, num_minibs=num_minibs,
+        est_seed=args.est_seed, param_seed=args.param_seed)
 
     # train
-    best_elbo = -jnp.inf
     itercount = itertools.count()
     shuffle_key = jrandom.PRNGKey(9999)
     eval_key = jrandom.PRNGKey(9999999)
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         tic = time.time()
         #niters = min(inference_iters, ((epoch // 100) + 1) * 5)
         shuffle_key, shuffkey = jrandom.split(shuffle_key)
-        sub_data = jrandom.permutation(shuffkey, sub_data)
-        # train over minibatches
-        for it in range(num_minibs):
-            # adjust number of iterations
-            niters = min(inference_iters, ((it // 100) + 1) * 5)
-            # select sub-sequence for current minibatch
-            x_it = sub_data[it*minib_size:(it+1)*minib_size]
-            key, trainkey = jrandom.split(key, 2)
-
-            if not args.eval_only:
-                # training step on minibatch
-                n_elbo, posteriors, all_params, opt_state = training_step(
-                    epoch, all_params, opt_state, x_it, niters,
-                    num_samples, burnin_len, trainkey)
-
-            # evaluate on full data at chosen frequency
-            if it % eval_freq == 0 or args.eval_only:
-                # inference on full data
-                n_elbo, posteriors = infer_step(epoch, all_params,
-                                                opt_state, x, niters,
-                                                num_samples, burnin_len,
-                                                trainkey)
-                # evaluate
-                qz, qzlag_z, qu, quu = posteriors
-                mcc, _, sort_idx = matching_sources_corr(qz[0][:, :, 0],
-                                                         z_mu[:, :, 0])
-                f_mu_est = vmap(decoder_mlp, in_axes=(None, -1),
-                                out_axes=-1)(all_params[1][1], qz[0][:, :, 0])
-                denoise_mcc = jnp.abs(jnp.diag(
-                    jnp.corrcoef(f_mu_est, f)[:M, M:])).mean()
-
-                print("*Epoch: [{0}/{1}]\t"
-                      "Minibatch: [{2}/{3}]\t"
-                      "ELBO: {4}\t"
-                      "mcc: {corr: .2f}\t"
-                      "denoise mcc: {dcorr: .2f}\t"
-                      "num. infernce iters: {5}\t"
-                      "eseed: {es}\t"
-                      "pseed: {ps}".format(epoch, num_epochs, it, num_minibs,
-                                           -n_elbo, niters, corr=mcc,
-                                           dcorr=denoise_mcc, es=args.est_seed,
-                                           ps=args.param_seed))
-
-                if it % plot_freq == 0 or args.eval_only:
-                    # plot
-                    plot_start = int(T/2)
-                    plot_len = 500
-                    plot_end = plot_start+plot_len
-                    for n in range(N):
-                        qz_mu_n = qz[0][sort_idx][n][plot_start:plot_end]
-                        qz_prec_n = qz[1][sort_idx][n][plot_start:plot_end]
-                        qu_n = jnp.exp(qu[sort_idx][n][plot_start:plot_end])
-                        u_n = states[n][plot_start:plot_end]
-                        z_mu_n = z_mu[n][plot_start:plot_end]
-                        plot_ic(u_n, z_mu_n, qu_n, qz_mu_n, qz_prec_n,
-                                ax[0, n], ax[1, n], ax2[1, n])
-                    plt.pause(.5)
-
-                # saving
-                if -n_elbo > best_elbo:
-                    best_elbo = -n_elbo
-                    best_params = all_params
-                    best_posters = posteriors
-                    save_best(epoch, args, all_params, opt_state, tx)
-
-                if args.eval_only:
-                    return best_params, best_posters, best_elbo
+        minibatches = subseq_minibatches(x, subseq_len, minib_size, shuffkey)
+        # train over minibatches; close() stops the prefetch thread also
+        # when the loop is left early (eval-only)
+        try:
+            for it, x_it in enumerate(minibatches):
+                # adjust number of iterations
+                niters = min(inference_iters, ((it // 100) + 1) * 5)
+                key, trainkey = jrandom.split(key, 2)
+
+                if not args.eval_only:
+                    if num_devices > 1 and x_it.shape[0] % num_devices == 0:
+                        # minibatch sharded over devices, grads all-reduced
+                        x_it = x_it.reshape((num_devices, -1)+x_it.shape[1:])
+                        trainkeys = jrandom.split(trainkey, num_devices)
+                        n_elbo, posteriors, all_params, opt_state = \
+                            sharded_training_step(epoch, all_params, opt_state,
+                                                  x_it, niters, num_samples,
+                                                  burnin_len, trainkeys)
+                    else:
+                        # training step on minibatch (also an uneven remainder)
+                        n_elbo, posteriors, all_params, opt_state = \
+                            training_step(epoch, all_params, opt_state, x_it,
+                                          niters, num_samples, burnin_len,
+                                          trainkey)
+
+                # evaluate on full data at chosen frequency
+                if it % eval_freq == 0 or args.eval_only:
+                    # inference on full data
+                    n_elbo, posteriors = infer_step(epoch, all_params,
+                                                    opt_state, x, niters,
+                                                    num_samples, burnin_len,
+                                                    trainkey)
+                    # evaluate, track best elbo and plot asynchronously
+                    plot = it % plot_freq == 0 or args.eval_only
+                    evaluator.submit(epoch, it, n_elbo, niters, all_params,
+                                     opt_state, posteriors, plot=plot)
+
+                    if args.eval_only:
+                        break
+        finally:
+            minibatches.close()
+        if args.eval_only:
+            break
         print("Epoch took: ", time.time()-tic)
+    best_params, best_posters, best_elbo = evaluator.close()
+    ckpt.close()
     return best_params, best_posters, best_elbo
@@ -3,6 +3,10 @@ config.update("jax_enable_x64", True)
 
 import os
 import pdb
+import queue
+import tempfile
+import threading
+import time
 
 from functools import partial
 
@@ -16,12 +20,22 @@ from jax import jit, lax
 from jax.ops import index_update, index_add, index
 from jax.lax import scan
 
-import pickle
-import cloudpickle
 import scipy as sp
 import matplotlib.pyplot as plt
 
 
+def init_compilation_cache(cache_dir):
+    '''Keep compiled XLA executables on disk so that reruns with the same
+        shapes skip compilation.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        from jax.experimental.compilation_cache import compilation_cache as cc
+        cc.initialize_cache(cache_dir)
+    except (ImportError, AttributeError):
+        config.update("jax_compilation_cache_dir", cache_dir)
+
+
 #@partial(jit, static_argnums=(0,))
 def get_prec_mat(n, prec_scale, key):
     '''Create a random covariance matrix
@@ -131,9 +145,10 @@ def get_likelihood_natparams(C, R, x):
 def get_E_prior_natparams(qz_prior, eta_prior):
     h_prior, J_prior = eta_prior
     Ez, Ez_outer = get_expected_suffstats(qz_prior)
-    lognorm = 0.25*jnp.trace(invmp(-J_prior, jnp.outer(h_prior, h_prior)))
-    lognorm = lognorm+0.5*jnp.linalg.slogdet(
-        jnp.pi*invmp(-J_prior, jnp.eye(J_prior.shape[0])))[1]
+    d = h_prior.shape[0]
+    L = jnp.linalg.cholesky(-J_prior)
+    lognorm = 0.25*chol_quad(L, h_prior)
+    lognorm = lognorm+0.5*(d*jnp.log(jnp.pi)-chol_logdet(L))
     rho_prior = h_prior@Ez+jnp.trace(J_prior@Ez_outer)-lognorm
     return rho_prior
 
@@ -143,10 +158,8 @@ def get_E_transition_natparams(qzlag_z, eta_transition):
     h_a, h_b = jnp.split(h, 2)
     d = h_a.shape[0]
     Ezlag_z, Ezlag_z_outer = get_expected_suffstats(qzlag_z)
-    _Q = -2*J[d:, d:]
-    _V = invmp(_Q, jnp.eye(_Q.shape[0]))
-    _b = _V@h_b
-    lognorm = 0.5*(_b.T@_Q@_b+jnp.linalg.slogdet(2*jnp.pi*_V)[1])
+    L = jnp.linalg.cholesky(-2*J[d:, d:])
+    lognorm = 0.5*(chol_quad(L, h_b)+d*jnp.log(2*jnp.pi)-chol_logdet(L))
     rho = h@Ezlag_z+jnp.trace(J@Ezlag_z_outer)-lognorm
     return rho
 
@@ -182,14 +195,14 @@ def get_resp_wgt_natparams(natparams, qu):
 
 def get_gauss_params(natparams):
     eta, P = natparams
-    mu = 0.5*invmp(-P, jnp.eye(P.shape[0]))@eta
+    mu = 0.5*invmp(-P, eta)
     prec = -2*P
     return (mu, prec)
 
 
 def get_expected_suffstats(qz):
     Ez = qz[0]
-    Ez_outer = invmp(qz[1], jnp.eye(qz[1].shape[0])) + jnp.outer(Ez, Ez)
+    Ez_outer = chol_inv(jnp.linalg.cholesky(qz[1])) + jnp.outer(Ez, Ez)
     return (Ez, Ez_outer)
 
 
@@ -241,6 +254,71 @@ def multi_tree_stack(trees):
     return jax.tree_multimap(lambda *a: jnp.stack(a), *trees)
 
 
+@partial(jit, static_argnums=(2,))
+def gather_subseqs(x, starts, subseq_len):
+    '''Gather windows x[:, s:s+subseq_len] for each start index s'''
+    return vmap(lambda s: lax.dynamic_slice_in_dim(x, s, subseq_len,
+                                                   axis=1))(starts)
+
+
+def subseq_minibatches(x, subseq_len, minib_size, key, prefetch=2):
+    '''Iterate over one epoch of minibatches of overlapping sub-sequences.
+        Sub-sequences are shuffled without replacement and gathered lazily
+        from x, with the next minibatches prepared in a background thread,
+        so memory is O(minib_size) instead of O(T*subseq_len). Call
+        close() on the generator when leaving the loop early so the
+        prefetch thread exits and releases its minibatches.
+        x: data, shape (M, T)
+        key: JAX PRNG key for shuffling
+        prefetch: number of minibatches to prepare ahead
+    '''
+    num_subseqs = x.shape[1]-subseq_len+1
+    num_minibs = -(-num_subseqs // minib_size)
+    starts = jrandom.permutation(key, num_subseqs)
+    minibs = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def _put(item):
+        # never block forever on a full queue: give up once stopped
+        while not stop.is_set():
+            try:
+                minibs.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _producer():
+        try:
+            for it in range(num_minibs):
+                if stop.is_set():
+                    return
+                x_it = gather_subseqs(
+                    x, starts[it*minib_size:(it+1)*minib_size], subseq_len)
+                if not _put(x_it.block_until_ready()):
+                    return
+        except Exception as e:
+            _put(e)
+        finally:
+            stop.set()
+
+    producer = threading.Thread(target=_producer, daemon=True)
+    producer.start()
+    try:
+        for it in range(num_minibs):
+            x_it = minibs.get()
+            if isinstance(x_it, Exception):
+                raise x_it
+            yield x_it
+    finally:
+        # stop the producer if iteration ended early (close() or an error)
+        # and drop the minibatches it had prepared
+        stop.set()
+        producer.join()
+        while not minibs.empty():
+            minibs.get_nowait()
+
+
 # inv(L*L.T)*Y
 def invcholp(L, Y):
     D = jax.scipy.linalg.solve_triangular(L, Y, lower=True)
@@ -253,13 +331,51 @@ def invmp(X, Y):
     return invcholp(jnp.linalg.cholesky(X), Y)
 
 
-def gaussian_sample_from_mu_prec(mu, prec, key):
-    # reparametrization trick but sampling using precision matrix instead
-    L = jnp.linalg.cholesky(prec)
+# Helpers below take the cholesky factor L of an SPD matrix X = L*L.T so
+# that a precision is factored once and reused for solves, log-determinants,
+# quadratic forms and sampling. Like the rest of this module they act on
+# single matrices and are vmapped over (N, T) at the call sites.
+
+# log|L*L.T|
+def chol_logdet(L):
+    return 2*jnp.sum(jnp.log(jnp.diag(L)))
+
+
+# y.T*inv(L*L.T)*y
+def chol_quad(L, y):
+    D = jax.scipy.linalg.solve_triangular(L, y, lower=True)
+    return jnp.sum(D*D)
+
+
+# inv(L*L.T)
+def chol_inv(L):
+    return invcholp(L, jnp.eye(L.shape[0]))
+
+
+def gaussian_entropy_from_chol(L):
+    '''Entropy of a gaussian given cholesky factor of its precision'''
+    d = L.shape[0]
+    return 0.5*(d*jnp.log(2*jnp.pi*jnp.e)-chol_logdet(L))
+
+
+def gaussian_logpdf_from_chol(x, mu, L):
+    '''Gaussian log-density given cholesky factor of its precision'''
+    d = L.shape[0]
+    r = L.T@(x-mu)
+    return 0.5*(chol_logdet(L)-d*jnp.log(2*jnp.pi)-r@r)
+
+
+def gaussian_sample_from_chol(mu, L, key):
+    # reparametrization trick with cholesky factor of the precision matrix
     z = jrandom.normal(key, mu.shape)
     return mu+jax.scipy.linalg.solve_triangular(L.T, z, lower=False)
 
 
+def gaussian_sample_from_mu_prec(mu, prec, key):
+    # reparametrization trick but sampling using precision matrix instead
+    return gaussian_sample_from_chol(mu, jnp.linalg.cholesky(prec), key)
+
+
 def matching_sources_corr(est_sources, true_sources, method="pearson"):
     """Finding matching indices between true and estimated sources.
     Args:
@@ -304,7 +420,7 @@ def sym_grad(cov_g):
 
 def plot_ic(u, z_mu, qu, qz_mu, qz_prec, ax0, ax1, ax2):
     T, K = qu.shape
-    qz_var = vmap(lambda a: invmp(a, jnp.eye(a.shape[0])))(qz_prec)
+    qz_var = vmap(lambda a: chol_inv(jnp.linalg.cholesky(a)))(qz_prec)
     qz_sd = jnp.sqrt(qz_var[:, 0, 0])
 
     ax0.clear()
@@ -330,7 +446,7 @@ def plot_ic(u, z_mu, qu, qz_mu, qz_prec, ax0, ax1, ax2):
     #ax2.set_xlim([0, T])
 
 
-def save_best(epoch, args, params, optimizer_state, optimizer):
+def ckpt_file_id(args):
     name_dict = {"n": args.n,
                  "m": args.m,
                  "l": args.l,
@@ -352,51 +468,203 @@ def save_best(epoch, args, params, optimizer_state, optimizer):
                  "gtGM": args.gt_gm_params}
     file_id = [str(i)+str(j) for i,j in zip(name_dict.keys(),
                name_dict.values())]
-    file_id = "_".join(file_id)
-    params_filename = file_id+"_params_ckpt.pkl"
-    state_filename = file_id+"_state_ckpt.pkl"
-    optx_filename = file_id+"_tx_ckpt.pkl"
-    pickle.dump(params, open(os.path.join(args.out_dir,
-                                          params_filename), "wb"))
-    cloudpickle.dump((epoch, optimizer_state), open(os.path.join(args.out_dir,
-                                                   state_filename), "wb"))
-    cloudpickle.dump(optimizer, open(os.path.join(args.out_dir,
-                                                  optx_filename), "wb"))
-
-
-def load_best_ckpt(args):
-    name_dict = {"n": args.n,
-                 "m": args.m,
-                 "l": args.l,
-                 "t": args.t,
-                 "es": args.est_seed,
-                 "ps": args.param_seed,
-                 "ds": args.data_seed,
-                 "nLR": args.nn_learning_rate,
-                 "gLR": args.gm_learning_rate,
-                 "uenc": args.hidden_units_enc,
-                 "udec": args.hidden_units_dec,
-                 "lenc": args.hidden_layers_enc,
-                 "ldec": args.hidden_layers_dec,
-                 "bin": args.burnin,
-                 "din": args.decay_interval,
-                 "dra": args.decay_rate,
-                 "inf": args.inference_iters,
-                 "sam": args.num_samples,
-                 "gtGM": args.gt_gm_params}
-    file_id = [str(i)+str(j) for i,j in zip(name_dict.keys(),
-               name_dict.values())]
-    file_id = "_".join(file_id)
-    params_filename = file_id+"_params_ckpt.pkl"
-    state_filename = file_id+"_state_ckpt.pkl"
-    optx_filename = file_id+"_tx_ckpt.pkl"
-    params = pickle.load(open(os.path.join(args.out_dir,
-                                           params_filename), "rb"))
-    epoch, opt_state = pickle.load(open(os.path.join(args.out_dir,
-                                        state_filename), "rb"))
-    optimizer = pickle.load(open(os.path.join(args.out_dir,
-                                              optx_filename), "rb"))
-    return epoch+1, params, opt_state, optimizer
+    return "_".join(file_id)
+
+
+def atomic_savez(path, **arrays):
+    # write next to the target and rename so readers never see partial files
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class CheckpointManager:
+    """Writes (params, opt_state) checkpoints in a background thread.
+
+    Leaves of the flattened pytree are stored in a single .npz per epoch
+    and renamed into place, so an interrupted write never corrupts the
+    previous checkpoint. Callers save the current state periodically
+    (every evaluation) and flag it with `is_best` when it improves on the
+    best ELBO so far; "best.npz" points to the best checkpoint. Only the
+    last `keep_last` checkpoints plus the best one are kept on disk and
+    writes are issued at most once every `min_interval` seconds (a pending
+    best is never dropped); the newest pending checkpoint is flushed on
+    `close()`. Other pytrees (e.g. per-seed best params) can be written
+    next to the checkpoints with `save_tree`.
+    """
+    def __init__(self, out_dir, file_id, keep_last=3, min_interval=60.):
+        self.ckpt_dir = os.path.join(out_dir, file_id+"_ckpt")
+        os.makedirs(self.ckpt_dir, exist_ok=True)
+        self.keep_last = keep_last
+        self.min_interval = min_interval
+        self._last_write = -np.inf
+        self._pending = None
+        self._pending_trees = {}
+        self._error = None
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._write_loop, daemon=True)
+        self._worker.start()
+
+    def save(self, epoch, params, opt_state, is_best=False):
+        # jax arrays are immutable so holding references is enough here;
+        # the device to host copy happens on the writer thread
+        if self._error is not None:
+            raise self._error
+        if self._pending is not None and self._pending[3] and not is_best:
+            # never let a newer non-best checkpoint displace a pending best
+            self._queue.put((self._write, self._pending))
+        self._pending = (epoch, params, opt_state, is_best)
+        if time.time()-self._last_write >= self.min_interval:
+            self._flush()
+
+    def save_tree(self, name, tree, **meta):
+        """Queues a write of tree (and the meta arrays) to <name>.npz in
+            the checkpoint dir. Only the newest pending tree per name is
+            kept; it is written with the next checkpoint or on `close()`.
+        """
+        if self._error is not None:
+            raise self._error
+        self._pending_trees[name] = (name, tree, meta)
+
+    def close(self):
+        if self._pending is not None or self._pending_trees:
+            self._flush()
+        self._queue.put(None)
+        self._worker.join()
+        if self._error is not None:
+            raise self._error
+
+    def _flush(self):
+        if self._pending is not None:
+            self._queue.put((self._write, self._pending))
+            self._pending = None
+        for item in self._pending_trees.values():
+            self._queue.put((self._write_tree, item))
+        self._pending_trees = {}
+        self._last_write = time.time()
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            write, args = item
+            try:
+                write(*args)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, epoch, params, opt_state, is_best):
+        leaves = jax.tree_leaves((params, opt_state))
+        arrays = {"leaf_%05d" % i: np.asarray(l) for i, l in
+                  enumerate(leaves)}
+        filename = "ckpt_%08d.npz" % epoch
+        atomic_savez(os.path.join(self.ckpt_dir, filename),
+                      epoch=np.asarray(epoch), **arrays)
+        if is_best:
+            atomic_savez(os.path.join(self.ckpt_dir, "best.npz"),
+                          epoch=np.asarray(epoch), filename=filename)
+        self._prune()
+
+    def _write_tree(self, name, tree, meta):
+        arrays = {"leaf_%05d" % i: np.asarray(l) for i, l in
+                  enumerate(jax.tree_leaves(tree))}
+        meta = {k: np.asarray(v) for k, v in meta.items()}
+        atomic_savez(os.path.join(self.ckpt_dir, name+".npz"),
+                     **meta, **arrays)
+
+    def _prune(self):
+        best_file = best_ckpt_filename(self.ckpt_dir)
+        ckpts = sorted(f for f in os.listdir(self.ckpt_dir)
+                       if f.startswith("ckpt_") and f.endswith(".npz"))
+        for f in ckpts[:max(len(ckpts)-self.keep_last, 0)]:
+            if f != best_file:
+                os.remove(os.path.join(self.ckpt_dir, f))
+
+
+def best_ckpt_filename(ckpt_dir):
+    best_path = os.path.join(ckpt_dir, "best.npz")
+    if not os.path.exists(best_path):
+        return None
+    with np.load(best_path, allow_pickle=False) as best:
+        return str(best["filename"])
+
+
+def latest_ckpt_filename(ckpt_dir):
+    ckpts = sorted(f for f in os.listdir(ckpt_dir)
+                   if f.startswith("ckpt_") and f.endswith(".npz"))
+    return ckpts[-1] if ckpts else None
+
+
+def load_ckpt(ckpt_dir, params, opt_state, which="best"):
+    """Restores the "best" or "latest" checkpoint in ckpt_dir into the
+        structure of the freshly initialized params and opt_state (the
+        optimizer itself is rebuilt from args, nothing is unpickled).
+    Returns:
+        start_epoch (int): epoch after the one checkpointed.
+        params, opt_state: restored pytrees.
+    """
+    if which == "best":
+        filename = best_ckpt_filename(ckpt_dir)
+    elif which == "latest":
+        filename = latest_ckpt_filename(ckpt_dir)
+    else:
+        raise ValueError("which must be 'best' or 'latest'")
+    if filename is None:
+        raise FileNotFoundError("no {} checkpoint in {}".format(which,
+                                                                ckpt_dir))
+    leaves, treedef = jax.tree_flatten((params, opt_state))
+    with np.load(os.path.join(ckpt_dir, filename),
+                 allow_pickle=False) as ckpt:
+        epoch = int(ckpt["epoch"])
+        saved = [ckpt["leaf_%05d" % i] for i in range(len(ckpt.files)-1)]
+    assert len(saved) == len(leaves), "checkpoint does not match model"
+    for s, l in zip(saved, leaves):
+        assert s.shape == jnp.shape(l), "checkpoint does not match model"
+    params, opt_state = jax.tree_unflatten(treedef,
+                                           [jnp.asarray(s) for s in saved])
+    return epoch+1, params, opt_state
+
+
+def load_tree(ckpt_dir, name, tree):
+    """Restores a pytree written by CheckpointManager.save_tree into the
+        structure of tree.
+    Returns:
+        tree: restored pytree.
+        meta (dict): the other arrays saved with it.
+    """
+    leaves, treedef = jax.tree_flatten(tree)
+    with np.load(os.path.join(ckpt_dir, name+".npz"),
+                 allow_pickle=False) as saved:
+        meta = {k: saved[k] for k in saved.files
+                if not k.startswith("leaf_")}
+        saved = [saved["leaf_%05d" % i] for i in range(len(saved.files)
+                                                      - len(meta))]
+    assert len(saved) == len(leaves), "saved tree does not match model"
+    for s, l in zip(saved, leaves):
+        assert s.shape == jnp.shape(l), "saved tree does not match model"
+    return jax.tree_unflatten(treedef, [jnp.asarray(s) for s in saved]), meta
+
+
+def load_best_ckpt(args, params, opt_state):
+    """Restores the best checkpoint for args, see load_ckpt."""
+    ckpt_dir = os.path.join(args.out_dir, ckpt_file_id(args)+"_ckpt")
+    return load_ckpt(ckpt_dir, params, opt_state, which="best")
+
+
+def load_latest_ckpt(args, params, opt_state):
+    """Restores the most recent checkpoint for args, see load_ckpt."""
+    ckpt_dir = os.path.join(args.out_dir, ckpt_file_id(args)+"_ckpt")
+    return load_ckpt(ckpt_dir, params, opt_state, which="latest")
 
 
 if __name__ == "__main__":
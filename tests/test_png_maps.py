@@ -0,0 +1,41 @@
+"""The fused PNG maps must fill any `out` buffer, including non-contiguous ones and x itself."""
+
+import numpy as np
+import pytest
+
+from ica.modules import fields_nong
+from ica.modules.jaafar import jaafar_peaks
+
+MAPS = [
+    (jaafar_peaks.map_sinh, (1.3, 3.)),
+    (jaafar_peaks.map_bypart, (0.2, 3.)),
+    (jaafar_peaks.map_bump, (-0.3, 0.5)),
+    (jaafar_peaks.map_smooth_bump, (0.3, 0.5)),
+    (jaafar_peaks.sq_ng, (0.7, 1.)),
+    (jaafar_peaks.kth_root, (3,)),
+    (fields_nong.png_map_asymsinh, (1.3, 2.)),
+]
+
+
+@pytest.fixture
+def x():
+    return np.random.default_rng(0).standard_normal((5, 4))
+
+
+@pytest.mark.parametrize("fn, args", MAPS, ids=lambda m: getattr(m, '__name__', ''))
+def test_non_contiguous_out(fn, args, x):
+    expected = fn(x.copy(), *args)
+    out = np.zeros((4, 5)).T
+    assert not out.flags.c_contiguous
+    res = fn(x, *args, out=out)
+    assert res is out
+    np.testing.assert_allclose(out, expected)
+
+
+@pytest.mark.parametrize("fn, args", MAPS, ids=lambda m: getattr(m, '__name__', ''))
+def test_out_is_non_contiguous_x(fn, args, x):
+    expected = fn(x.copy(), *args)
+    xt = np.asfortranarray(x)
+    res = fn(xt, *args, out=xt)
+    assert res is xt
+    np.testing.assert_allclose(xt, expected)